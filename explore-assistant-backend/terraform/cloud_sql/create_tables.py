@@ -12,6 +12,7 @@ sys.path.insert(0, os.path.join(root_dir, 'explore-assistant-cloud-run'))
 
 # this will now import the foreign models table from cloud run folder
 import models
+import migrations
 
 def get_table_info():
     """Extract information about all tables defined in SQLModel metadata"""
@@ -41,6 +42,12 @@ def main():
     print(f"Using database URL: {get_database_url()}")
     create_db_and_tables()
     print("Tables created successfully!")
+
+    # bring existing databases up to date (indexes, new columns) without dropping tables
+    applied = migrations.upgrade(engine)
+    print(f"Applied {len(applied)} migration(s)")
+    for missing in migrations.missing_indexes(engine):
+        print(f"WARNING: missing index - {missing}")
     
     # save a simple list of tables for Terraform to use
     table_names = list(get_table_info().keys())
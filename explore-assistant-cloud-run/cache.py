@@ -0,0 +1,169 @@
+# cache.py
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries also expire after a time to live.
+
+    Entries are evicted least-recently-used first once maxsize is reached,
+    and an expired entry is treated as a miss on read. Every cache keeps
+    hit/miss/eviction counters so the saved round trips can be reported.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 300):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[1] > time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Read a live entry without counting a lookup or refreshing its LRU position"""
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return default
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class _Call:
+    __slots__ = ("future", "waiters")
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls for the same key into a single awaited call.
+
+    The first caller for a key starts the work; every caller arriving while
+    it is still running awaits the same result (or exception) instead of
+    repeating it. A caller that is cancelled stops waiting without
+    cancelling the shared call for the others. With cancel_abandoned, the
+    call itself is cancelled once every caller has gone, and the next caller
+    for the key starts a fresh one.
+    """
+
+    def __init__(self, cancel_abandoned: bool = False):
+        self.cancel_abandoned = cancel_abandoned
+        self._in_flight: Dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.shared = 0
+        self.failed = 0
+        self.abandoned = 0
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._in_flight.get(key)
+        if call is not None:
+            self.shared += 1
+        else:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._in_flight[key] = call
+            self.calls += 1
+            call.future.add_done_callback(lambda future: self._done(key, call))
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.future)
+        finally:
+            call.waiters -= 1
+            if self.cancel_abandoned and not call.waiters and not call.future.done():
+                self._forget(key, call)
+                call.future.cancel()
+                self.abandoned += 1
+
+    def _forget(self, key: Hashable, call: _Call) -> None:
+        # a fresh call may already have replaced an abandoned one
+        if self._in_flight.get(key) is call:
+            del self._in_flight[key]
+
+    def _done(self, key: Hashable, call: _Call) -> None:
+        self._forget(key, call)
+        if not call.future.cancelled() and call.future.exception() is not None:
+            # retrieved here too, so a failure nobody waited for isn't reported as unhandled
+            self.failed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._in_flight),
+            "calls": self.calls,
+            "shared": self.shared,
+            "failed": self.failed,
+            "abandoned": self.abandoned,
+        }
+
+
+# registry used by the admin stats endpoint
+_caches: Dict[str, TTLCache] = {}
+
+def register_cache(cache: TTLCache) -> TTLCache:
+    _caches[cache.name] = cache
+    return cache
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: cache.stats() for name, cache in _caches.items()}
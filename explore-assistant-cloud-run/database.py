@@ -1,5 +1,12 @@
-from sqlmodel import create_engine, Session
+from sqlmodel import create_engine, Session, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.util.queue import AsyncAdaptedQueue
+from typing import Any, Dict, Optional
 import os
+import time
 from dotenv import load_dotenv
 from urllib.parse import quote_plus
 
@@ -10,13 +17,158 @@ CLOUD_SQL_USER = os.getenv("CLOUD_SQL_USER")
 CLOUD_SQL_PASSWORD = os.getenv("CLOUD_SQL_PASSWORD")
 CLOUD_SQL_DATABASE = os.getenv("CLOUD_SQL_DATABASE")
 
-ENCODED_PASSWORD = quote_plus(CLOUD_SQL_PASSWORD)  # Encodes special characters
+ENCODED_PASSWORD = quote_plus(CLOUD_SQL_PASSWORD or "")  # Encodes special characters
 
 
-DATABASE_URL = f"mysql+pymysql://{CLOUD_SQL_USER}:{ENCODED_PASSWORD}@{CLOUD_SQL_HOST}/{CLOUD_SQL_DATABASE}"
+# DATABASE_URL overrides the Cloud SQL settings, e.g. sqlite:///local.db for local testing
+DATABASE_URL = os.getenv("DATABASE_URL") or f"mysql+pymysql://{CLOUD_SQL_USER}:{ENCODED_PASSWORD}@{CLOUD_SQL_HOST}/{CLOUD_SQL_DATABASE}"
 
-engine = create_engine(DATABASE_URL, echo=False)
+def to_async_url(url: str) -> str:
+    """Swap the sync driver of a database url for its asyncio counterpart"""
+    if url.startswith("mysql+pymysql://"):
+        return url.replace("mysql+pymysql://", "mysql+aiomysql://", 1)
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+
+# Connection pool settings. Size the pool against the Cloud SQL connection limit
+# divided by the max number of Cloud Run instances.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# seconds to wait for a free pooled connection before giving up
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+# recycle connections before Cloud SQL drops them for being idle
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# test connections on checkout so server-side disconnects don't surface as request errors
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+
+
+class PoolMetrics:
+    """
+    Counters for the async engine's connection pool, reported on the admin endpoint.
+    Wait time is the time checkouts spent waiting on the pool's queue, connect
+    time the time spent opening database connections, so pool exhaustion and
+    slow connects show up separately.
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.connect_time_total = 0.0
+        self.connect_time_max = 0.0
+
+    def record_wait(self, seconds: float) -> None:
+        self.wait_time_total += seconds
+        self.wait_time_max = max(self.wait_time_max, seconds)
+
+    def record_connect(self, seconds: float) -> None:
+        self.connects += 1
+        self.connect_time_total += seconds
+        self.connect_time_max = max(self.connect_time_max, seconds)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "checkouts": self.checkouts,
+            "connects": self.connects,
+            "invalidations": self.invalidations,
+            "wait_time_total_ms": round(self.wait_time_total * 1000, 3),
+            "wait_time_avg_ms": round(self.wait_time_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+            "wait_time_max_ms": round(self.wait_time_max * 1000, 3),
+            "connect_time_total_ms": round(self.connect_time_total * 1000, 3),
+            "connect_time_avg_ms": round(self.connect_time_total * 1000 / self.connects, 3) if self.connects else 0.0,
+            "connect_time_max_ms": round(self.connect_time_max * 1000, 3),
+        }
+
+pool_metrics = PoolMetrics()
+
+
+class _TimedQueue(AsyncAdaptedQueue):
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        started = time.perf_counter()
+        try:
+            return super().get(block, timeout)
+        finally:
+            pool_metrics.record_wait(time.perf_counter() - started)
+
+class InstrumentedAsyncPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited on its queue for a free connection"""
+
+    _queue_class = _TimedQueue
+
+
+def _engine_options(url: str, is_async: bool = False) -> Dict[str, Any]:
+    if url.startswith("sqlite"):
+        # sqlite keeps its own pool defaults, used for local testing only
+        return {}
+
+    options = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "connect_args": {"connect_timeout": DB_CONNECT_TIMEOUT},
+    }
+    if is_async:
+        options["poolclass"] = InstrumentedAsyncPool
+    return options
+
+# sync engine for scripts and table management
+engine = create_engine(DATABASE_URL, echo=False, **_engine_options(DATABASE_URL))
+# async engine used by the API so DB round trips don't block the event loop
+async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=False, **_engine_options(ASYNC_DATABASE_URL, is_async=True))
+
+def instrument_pool(bind) -> None:
+    """Count the checkouts, connects and invalidations of an async engine's pool into pool_metrics"""
+    @event.listens_for(bind.sync_engine, "do_connect")
+    def _on_do_connect(dialect, conn_rec, cargs, cparams):
+        conn_rec.info["connect_started"] = time.perf_counter()
+
+    @event.listens_for(bind.sync_engine.pool, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        started = connection_record.info.pop("connect_started", None)
+        pool_metrics.record_connect(time.perf_counter() - started if started is not None else 0.0)
+
+    @event.listens_for(bind.sync_engine.pool, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_metrics.checkouts += 1
+
+    @event.listens_for(bind.sync_engine.pool, "invalidate")
+    def _on_invalidate(dbapi_connection, connection_record, exception):
+        pool_metrics.invalidations += 1
+
+instrument_pool(async_engine)
+
+def pool_stats() -> Dict[str, Any]:
+    """Live state of the async engine's connection pool"""
+    pool = async_engine.sync_engine.pool
+    stats = {"pool_class": type(pool).__name__, **pool_metrics.as_dict()}
+    if hasattr(pool, "checkedout"):
+        stats.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "max_overflow": DB_MAX_OVERFLOW,
+        })
+    return stats
 
 def get_session():
     with Session(engine) as session:
-        yield session 
\ No newline at end of file
+        yield session
+
+async def get_async_session():
+    # objects stay usable after commit; lazy loading is not available on async sessions
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+async def create_db_and_tables(bind=async_engine):
+    """Create all tables of the imported models, used for local sqlite databases"""
+    async with bind.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
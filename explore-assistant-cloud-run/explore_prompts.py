@@ -0,0 +1,176 @@
+# explore_prompts.py
+"""
+Server-side assembly of the generateExploreUrl prompt.
+
+The extension used to build this prompt itself (every visible dimension and
+measure of the explore plus every generation example) and upload it with
+each question. The prompt is now assembled here from the explore_key: the
+static part, everything up to the user's question, is built once per
+explore from the LookML metadata (Looker API) and the examples table
+(BigQuery), cached for EXPLORE_PROMPT_TTL seconds and shared by every user.
+Only the question changes between requests.
+"""
+
+import asyncio
+import json
+import os
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from google.cloud import bigquery
+
+from cache import SingleFlight, TTLCache, register_cache
+
+# seconds the assembled prompt prefix of an explore is reused
+EXPLORE_PROMPT_TTL = int(os.environ.get("EXPLORE_PROMPT_TTL", "3600"))
+EXPLORE_PROMPT_CACHE_SIZE = int(os.environ.get("EXPLORE_PROMPT_CACHE_SIZE", "100"))
+# the dataset the extension loads its examples from (BIGQUERY_EXAMPLE_PROMPTS_DATASET_NAME)
+BIGQUERY_EXAMPLES_DATASET = os.environ.get("BIGQUERY_EXAMPLES_DATASET", "explore_assistant")
+EXAMPLES_TABLE = "explore_assistant_examples"
+
+# generation parameters the extension sends with generateExploreUrl
+EXPLORE_URL_PARAMETERS = {"max_output_tokens": 1000}
+
+PROMPT_PREFIX = """Context
+----------
+
+You are a developer who would transalate questions to a structured Looker URL query based on the following instructions.
+
+Instructions:
+  - choose only the fields in the below lookml metadata
+  - prioritize the field description, label, tags, and name for what field(s) to use for a given description
+  - generate only one answer, no more.
+  - use the Examples (at the bottom) for guidance on how to structure the Looker url query
+  - try to avoid adding dynamic_fields, provide them when very similar example is found in the bottom
+  - never respond with sql, always return an looker explore url as a single string
+  - response should start with fields= , as in the Examples section at the bottom
+
+LookML Metadata
+----------
+
+Dimensions Used to group by information (follow the instructions in tags when using a specific field; if map used include a location or lat long dimension;):
+
+{dimensions}
+
+Measures are used to perform calculations (if top, bottom, total, sum, etc. are used include a measure):
+
+{measures}
+
+Example
+----------
+
+{examples}
+
+Input
+----------
+"""
+
+PROMPT_SUFFIX = """
+
+Output
+----------
+"""
+
+
+def format_field(field: Any) -> str:
+    """One field of the LookML metadata, formatted like the extension does"""
+    parts = []
+    for attribute in ("name", "type", "label", "description"):
+        value = getattr(field, attribute, None)
+        if value:
+            parts.append(f"{attribute}: {value}")
+    tags = getattr(field, "tags", None)
+    if tags:
+        parts.append(f"tags: {', '.join(tags)}")
+    return ", ".join(parts)
+
+
+def format_examples(examples: Sequence[Dict[str, Any]]) -> str:
+    return "\n".join(f'input: "{example["input"]}" ; output: {example["output"]}' for example in examples)
+
+
+def build_prefix(dimensions: Sequence[Any], measures: Sequence[Any], examples: Sequence[Dict[str, Any]]) -> str:
+    return PROMPT_PREFIX.format(
+        dimensions="\n".join(format_field(field) for field in dimensions if not getattr(field, "hidden", False)),
+        measures="\n".join(format_field(field) for field in measures if not getattr(field, "hidden", False)),
+        examples=format_examples(examples),
+    )
+
+
+def parse_explore_key(explore_key: str) -> Tuple[str, str]:
+    """
+    Split an explore_key into its model and explore name.
+
+    Raises:
+        ValueError: If the key is not of the form model:explore
+    """
+    parts = (explore_key or "").split(":")
+    if len(parts) != 2 or not all(parts):
+        raise ValueError(f"Invalid explore_key {explore_key!r}, expected model:explore")
+    return parts[0], parts[1]
+
+
+def assemble_prompt(prefix: str, prompt: str) -> str:
+    return f"{prefix}{prompt}{PROMPT_SUFFIX}"
+
+
+class ExplorePromptBuilder:
+    """
+    Prompt prefixes per explore, built from the explore's fields and
+    generation examples and kept in memory. Concurrent first requests for
+    an explore share one build.
+    """
+
+    def __init__(
+        self,
+        load_fields: Callable[[str, str], Tuple[List[Any], List[Any]]],
+        load_examples: Callable[[str], List[Dict[str, Any]]],
+        maxsize: int = EXPLORE_PROMPT_CACHE_SIZE,
+        ttl: float = EXPLORE_PROMPT_TTL,
+    ):
+        # both loaders are blocking calls and run in a worker thread
+        self.load_fields = load_fields
+        self.load_examples = load_examples
+        self.cache = register_cache(TTLCache("explore_prompts", maxsize=maxsize, ttl=ttl))
+        self._builds = SingleFlight()
+
+    async def prefix(self, explore_key: str) -> str:
+        prefix = self.cache.get(explore_key)
+        if prefix is None:
+            prefix = await self._builds.do(explore_key, lambda: self._build(explore_key))
+        return prefix
+
+    async def prompt(self, explore_key: str, prompt: str) -> str:
+        return assemble_prompt(await self.prefix(explore_key), prompt)
+
+    async def _build(self, explore_key: str) -> str:
+        model_name, explore_name = parse_explore_key(explore_key)
+        (dimensions, measures), examples = await asyncio.gather(
+            asyncio.to_thread(self.load_fields, model_name, explore_name),
+            asyncio.to_thread(self.load_examples, explore_key),
+        )
+        prefix = build_prefix(dimensions, measures, examples)
+        self.cache.set(explore_key, prefix)
+        return prefix
+
+
+def looker_fields_loader(sdk) -> Callable[[str, str], Tuple[List[Any], List[Any]]]:
+    def load_fields(model_name: str, explore_name: str) -> Tuple[List[Any], List[Any]]:
+        explore = sdk.lookml_model_explore(lookml_model_name=model_name, explore_name=explore_name, fields="fields")
+        return list(explore.fields.dimensions or []), list(explore.fields.measures or [])
+    return load_fields
+
+
+def bigquery_examples_loader(project: str, dataset: str = BIGQUERY_EXAMPLES_DATASET) -> Callable[[str], List[Dict[str, Any]]]:
+    def load_examples(explore_key: str) -> List[Dict[str, Any]]:
+        client = bigquery.Client(project=project)
+        job = client.query(
+            f"SELECT examples FROM `{project}.{dataset}.{EXAMPLES_TABLE}` WHERE explore_id = @explore_id",
+            job_config=bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ScalarQueryParameter("explore_id", "STRING", explore_key)]
+            ),
+        )
+        examples = []
+        for row in job.result():
+            examples.extend(json.loads(row["examples"]))
+        return examples
+    return load_examples
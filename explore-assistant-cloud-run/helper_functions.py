@@ -1,7 +1,14 @@
 # helper_functions.py
 
 import os
+import asyncio
+import base64
+import hashlib
+import json
 import logging
+from collections import Counter
+import httpx
+import jwt
 import requests
 import vertexai
 from requests.auth import HTTPBasicAuth
@@ -10,9 +17,18 @@ from google.cloud import bigquery
 from vertexai.preview.generative_models import GenerativeModel, GenerationConfig
 from dotenv import load_dotenv
 from typing import Dict, Any, List, Optional, Tuple, Sequence
-from sqlmodel import Session, select, func, desc, asc
-from models import User, Thread, Message, Feedback
-from database import engine
+from datetime import datetime, timedelta
+from sqlmodel import select, update, delete, func, desc, asc, or_, and_
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.orm import selectinload
+from models import User, Thread, Message, Feedback, load_json_or_default
+from cache import TTLCache, SingleFlight, register_cache
+from jwks import GOOGLE_JWKS_URL, JWKSCache, looks_like_jwt, verify_id_token
+from search import SEARCH_FIELDS, MessageEntry, search_index, search_messages
+import prompt_store
+import llm_cache
+from semantic_cache import semantic_cache
+from explore_prompts import ExplorePromptBuilder, bigquery_examples_loader, looker_fields_loader
 import looker_sdk
 from looker_sdk.sdk.api40.models import User as LookerUser
 from looker_sdk.error import SDKError
@@ -37,6 +53,27 @@ VERTEX_CF_AUTH_TOKEN = os.environ.get("VERTEX_CF_AUTH_TOKEN")
 ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 RESTRICT_GROUP_ACCESS = os.environ.get("RESTRICT_GROUP_ACCESS") == "1"
 RESTRICT_GROUP_ID = os.environ.get("RESTRICT_GROUP_ID")
+# max number of Gemini generations allowed in flight on a single instance
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "32"))
+# validated bearer tokens are cached for at most this many seconds (and never past their exp)
+TOKEN_CACHE_TTL = int(os.environ.get("TOKEN_CACHE_TTL", "300"))
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "10000"))
+# "tokeninfo" validates every token against Google's tokeninfo endpoint,
+# "jwt" verifies Google-signed ID tokens locally and only falls back to tokeninfo for opaque access tokens
+TOKEN_VALIDATION_MODE = os.environ.get("TOKEN_VALIDATION_MODE", "tokeninfo")
+# Looker user -> group membership is served from memory for LOOKER_USER_CACHE_TTL seconds,
+# and refreshed in the background once an entry is older than LOOKER_USER_REFRESH_AFTER
+LOOKER_USER_CACHE_TTL = int(os.environ.get("LOOKER_USER_CACHE_TTL", "3600"))
+LOOKER_USER_REFRESH_AFTER = int(os.environ.get("LOOKER_USER_REFRESH_AFTER", "300"))
+LOOKER_USER_CACHE_SIZE = int(os.environ.get("LOOKER_USER_CACHE_SIZE", "10000"))
+# bulk load every member of RESTRICT_GROUP_ID on startup and every LOOKER_USER_REFRESH_AFTER seconds
+LOOKER_GROUP_PREFETCH = os.environ.get("LOOKER_GROUP_PREFETCH") == "1"
+# serialized thread snapshots are kept for this many seconds, 0 disables the cache
+THREAD_SNAPSHOT_TTL = int(os.environ.get("THREAD_SNAPSHOT_TTL", "0"))
+THREAD_SNAPSHOT_CACHE_SIZE = int(os.environ.get("THREAD_SNAPSHOT_CACHE_SIZE", "1000"))
+# soft deleted threads are hard deleted by the purge job after this many days, PURGE_BATCH_SIZE rows at a time
+PURGE_RETENTION_DAYS = int(os.environ.get("PURGE_RETENTION_DAYS", "30"))
+PURGE_BATCH_SIZE = int(os.environ.get("PURGE_BATCH_SIZE", "500"))
 
 if (
     not PROJECT or
@@ -52,6 +89,12 @@ logging.basicConfig(level=logging.INFO)
 # Initialize the Vertex AI model globally
 vertexai.init(project=PROJECT, location=REGION)
 model = GenerativeModel(MODEL_NAME)
+# bounds the concurrent async generations so a burst of prompts queues here
+# instead of piling up on the Vertex AI quota
+llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+# a double click or retry of the same prompt waits on the generation already running,
+# which is cancelled once every request waiting on it is gone
+llm_calls = SingleFlight(cancel_abandoned=True)
 
 
 # init looker sdk
@@ -60,6 +103,33 @@ os.environ["LOOKERSDK_CLIENT_SECRET"] = LOOKER_CLIENT_SECRET
 os.environ["LOOKERSDK_BASE_URL"] = LOOKER_API_URL
 sdk = looker_sdk.init40()
 
+# the static part of the generateExploreUrl prompt of each explore, shared by every user
+explore_prompt_builder = ExplorePromptBuilder(looker_fields_loader(sdk), bigquery_examples_loader(PROJECT))
+
+# a chat turn makes several backend calls with the same token,
+# so only the first one goes out to tokeninfo
+token_cache = register_cache(TTLCache("bearer_tokens", maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL))
+token_validations = SingleFlight()
+tokeninfo_calls = 0
+http_client = httpx.AsyncClient(timeout=10)
+jwks_cache = JWKSCache(GOOGLE_JWKS_URL, http_client)
+
+# user_id -> (group_ids, fetched_at); keeps /login off the Looker API rate limits
+looker_user_cache = register_cache(TTLCache("looker_users", maxsize=LOOKER_USER_CACHE_SIZE, ttl=LOOKER_USER_CACHE_TTL))
+looker_user_lookups = SingleFlight()
+
+# thread_id -> serialized /thread/{id}/snapshot document
+thread_snapshot_cache = register_cache(TTLCache("thread_snapshots", maxsize=THREAD_SNAPSHOT_CACHE_SIZE, ttl=THREAD_SNAPSHOT_TTL))
+
+# strong references to fire-and-forget tasks so they are not garbage collected mid-flight
+_background_tasks = set()
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 
 
 
@@ -68,14 +138,51 @@ class DatabaseError(Exception):
         super().__init__(message)
         self.details = details
 
-def validate_bearer_token(token: str) -> bool:
+async def validate_bearer_token(token: str) -> bool:
     if not token:
         logging.error("Empty token provided")
         return False
     if token == ADMIN_TOKEN:
         return True
+
+    # key on a digest so raw tokens are not kept around in memory
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    if token_cache.get(cache_key):
+        return True
+
+    if TOKEN_VALIDATION_MODE == "jwt" and looks_like_jwt(token):
+        return await _validate_id_token(token, cache_key)
+
+    # concurrent requests carrying the same token share one tokeninfo call
+    return await token_validations.do(cache_key, lambda: _validate_with_tokeninfo(token, cache_key))
+
+async def _validate_id_token(token: str, cache_key: str) -> bool:
+    try:
+        token_info = await verify_id_token(token, jwks_cache, audience=OAUTH_CLIENT_ID)
+    except jwt.InvalidTokenError as e:
+        logging.error(f"ID token verification failed: {str(e)}")
+        return False
+    except Exception as e:
+        logging.error(f"Token validation failed with unexpected error: {str(e)}")
+        return False
+
+    if token_info.get('azp', token_info.get('aud')) != OAUTH_CLIENT_ID:
+        logging.error(f"Token was issued for different client ID: {token_info.get('azp')}")
+        return False
+    if int(token_info['exp']) < int(time.time()):
+        logging.error("Token has expired")
+        return False
+    token_cache.set(cache_key, True, ttl=int(token_info['exp']) - time.time())
+    return True
+
+async def _validate_with_tokeninfo(token: str, cache_key: str) -> bool:
+    global tokeninfo_calls
+    tokeninfo_calls += 1
     try:
-        response = requests.get(f'https://oauth2.googleapis.com/tokeninfo?access_token={token}')
+        response = await http_client.get(
+            'https://oauth2.googleapis.com/tokeninfo',
+            params={'access_token': token}
+        )
 
         if response.status_code == 200:
             token_info = response.json()
@@ -85,19 +192,31 @@ def validate_bearer_token(token: str) -> bool:
             if int(token_info['exp']) < int(time.time()):
                 logging.error("Token has expired")
                 return False
+            # a cached token must never outlive its own expiry
+            token_cache.set(cache_key, True, ttl=int(token_info['exp']) - time.time())
             return True
         
     except Exception as e:
         logging.error(f"Token validation failed with unexpected error: {str(e)}")
     return False
 
-def verify_looker_user(user_id: str) -> bool:
+def token_validation_stats() -> Dict[str, Any]:
+    return {
+        **token_cache.stats(),
+        "coalesced": token_validations.shared,
+        "tokeninfo_calls": tokeninfo_calls,
+    }
+
+def llm_call_stats() -> Dict[str, Any]:
+    return llm_calls.stats()
+
+async def verify_looker_user(user_id: str) -> bool:
     try :
-        user : LookerUser = sdk.user(user_id=user_id)
+        group_ids = await _get_looker_user_groups(user_id)
         if not RESTRICT_GROUP_ACCESS:
             return True
 
-        elif user.group_ids and RESTRICT_GROUP_ID in user.group_ids:
+        elif group_ids and RESTRICT_GROUP_ID in group_ids:
             return True
         else:
             # User is NOT in the approved group, raise an error
@@ -111,138 +230,351 @@ def verify_looker_user(user_id: str) -> bool:
         logging.warning(f"Looker user verification failed for user {user_id}: {e.message}")
         return False
 
-def get_user_from_db(user_id: str) -> Optional[Dict]:
-    with Session(engine) as session:
-        user = session.get(User, user_id)
-        if user:
-            return {"user_id": user.user_id, "name": user.name, "email": user.email}
+async def _get_looker_user_groups(user_id: str) -> List[str]:
+    cached = looker_user_cache.get(user_id)
+    if cached is not None:
+        group_ids, fetched_at = cached
+        if time.monotonic() - fetched_at >= LOOKER_USER_REFRESH_AFTER:
+            run_in_background(_refresh_looker_user(user_id))
+        return group_ids
+
+    return await looker_user_lookups.do(user_id, lambda: _fetch_looker_user_groups(user_id))
+
+async def _fetch_looker_user_groups(user_id: str) -> List[str]:
+    # the Looker SDK is synchronous, keep it off the event loop
+    user : LookerUser = await asyncio.to_thread(sdk.user, user_id=user_id, fields="id,group_ids")
+    group_ids = list(user.group_ids or [])
+    looker_user_cache.set(user_id, (group_ids, time.monotonic()))
+    return group_ids
+
+async def _refresh_looker_user(user_id: str) -> None:
+    try:
+        await looker_user_lookups.do(user_id, lambda: _fetch_looker_user_groups(user_id))
+    except SDKError as e:
+        # the user no longer resolves in Looker, stop serving the cached membership
+        looker_user_cache.pop(user_id)
+        logging.warning(f"Looker user refresh failed for user {user_id}: {e.message}")
+    except Exception as e:
+        logging.error(f"Looker user refresh failed for user {user_id}: {str(e)}")
+
+def _fetch_all_group_users(group_id: str, page_size: int = 500) -> List[LookerUser]:
+    users = []
+    offset = 0
+    while True:
+        page = sdk.all_group_users(
+            group_id=group_id,
+            fields="id,group_ids",
+            limit=page_size,
+            offset=offset
+        )
+        users.extend(page)
+        if len(page) < page_size:
+            return users
+        offset += page_size
+
+async def prefetch_group_members() -> int:
+    """
+    Load every member of RESTRICT_GROUP_ID into the Looker user cache.
+
+    Returns:
+        int: Number of users cached
+    """
+    users = await asyncio.to_thread(_fetch_all_group_users, RESTRICT_GROUP_ID)
+    fetched_at = time.monotonic()
+    for user in users:
+        looker_user_cache.set(user.id, (list(user.group_ids or []), fetched_at))
+    return len(users)
+
+async def prefetch_group_members_periodically() -> None:
+    while True:
+        try:
+            count = await prefetch_group_members()
+            logging.info(f"Prefetched {count} members of Looker group {RESTRICT_GROUP_ID}")
+        except Exception as e:
+            logging.error(f"Looker group prefetch failed: {str(e)}")
+        await asyncio.sleep(LOOKER_USER_REFRESH_AFTER)
+
+async def get_user_from_db(session: AsyncSession, user_id: str) -> Optional[Dict]:
+    user = await session.get(User, user_id)
+    if user:
+        return {"user_id": user.user_id, "name": user.name, "email": user.email}
     return None
 
-def create_new_user(user_id: str, name: str, email: str) -> Dict:
+async def create_new_user(session: AsyncSession, user_id: str, name: str, email: str) -> Dict:
     try:
-        with Session(engine) as session:
-            user = User(user_id=user_id, name=name, email=email)
-            session.add(user)
-            session.commit()
-            return {"user_id": user_id, "status": "created"}
+        user = User(user_id=user_id, name=name, email=email)
+        session.add(user)
+        await session.commit()
+        return {"user_id": user_id, "status": "created"}
     except Exception as e:
         raise DatabaseError("Failed to create user", str(e))
 
-def create_chat_thread(user_id: str, explore_key: str) -> int | None:
+async def create_chat_thread(session: AsyncSession, user_id: str, explore_key: str) -> int | None:
     try:
-        with Session(engine) as session:
-            thread = Thread(user_id=user_id, explore_key=explore_key)
-            session.add(thread)
-            session.commit()
-            session.refresh(thread)
-            return thread.thread_id
+        thread = Thread(user_id=user_id, explore_key=explore_key)
+        session.add(thread)
+        # keep the user's thread counter in the same transaction as the insert
+        await session.exec(
+            update(User)
+            .where(User.user_id == user_id)
+            .values(active_thread_count=User.active_thread_count + 1)
+        )
+        await session.commit()
+        await session.refresh(thread)
+        search_index.add_thread(thread)
+        return thread.thread_id
     except Exception as e:
         raise DatabaseError("Failed to create thread", str(e))
 
-def retrieve_thread_history(thread_id: int) -> Dict:
+THREAD_SNAPSHOT_FIELDS = [
+    "thread_id", "user_id", "explore_key", "explore_id", "model_name",
+    "explore_url", "summarized_prompt", "created_at", "chat_message_count",
+]
+FEEDBACK_SNAPSHOT_FIELDS = ["feedback_id", "feedback_text", "is_positive", "category", "timestamp"]
+
+def _snapshot_value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+async def _load_thread_snapshot(session: AsyncSession, thread_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Load a live thread with its visible (chatMessage) messages and their feedback,
+    oldest message first. The messages and feedback come in with one selectinload
+    query each, without the heavy logging columns.
+
+    Returns:
+        The snapshot, or None when the thread doesn't exist or is deleted
+    """
+    thread = (await session.exec(
+        select(Thread)
+        .where(Thread.thread_id == thread_id)
+        .where(Thread.is_deleted == False)
+        .options(
+            selectinload(Thread.messages.and_(Message.prompt_type == 'chatMessage'))
+            .load_only(*(getattr(Message, field) for field in LIGHT_MESSAGE_FIELDS))
+            .selectinload(Message.feedback)
+        )
+    )).first()
+    if thread is None:
+        return None
+
+    messages = []
+    for message in sorted(thread.messages, key=lambda message: (message.created_at, message.message_id)):
+        message_data = {field: _snapshot_value(getattr(message, field)) for field in LIGHT_MESSAGE_FIELDS}
+        message_data["parameters"] = message.parameters
+        message_data["feedback"] = message.feedback and {
+            field: _snapshot_value(getattr(message.feedback, field)) for field in FEEDBACK_SNAPSHOT_FIELDS
+        }
+        messages.append(message_data)
+
+    return {
+        "thread": {
+            **{field: _snapshot_value(getattr(thread, field)) for field in THREAD_SNAPSHOT_FIELDS},
+            "prompt_list": thread.prompt_list,
+        },
+        "messages": messages,
+    }
+
+async def get_thread_snapshot(session: AsyncSession, thread_id: int) -> Optional[str]:
+    """
+    The thread snapshot serialized to JSON, served from thread_snapshot_cache
+    when THREAD_SNAPSHOT_TTL is set. Every write to the thread drops its entry.
+
+    Returns:
+        The JSON document, or None when the thread doesn't exist or is deleted
+    """
+    snapshot_json = thread_snapshot_cache.get(thread_id)
+    if snapshot_json is not None:
+        return snapshot_json
+    try:
+        snapshot = await _load_thread_snapshot(session, thread_id)
+    except Exception as e:
+        raise DatabaseError("Failed to retrieve thread snapshot", str(e))
+    if snapshot is None:
+        return None
+
+    snapshot_json = json.dumps(snapshot)
+    thread_snapshot_cache.set(thread_id, snapshot_json)
+    return snapshot_json
+
+def invalidate_thread_snapshots(thread_ids: Sequence[int]) -> None:
+    for thread_id in thread_ids:
+        thread_snapshot_cache.pop(thread_id)
+
+async def retrieve_thread_history(session: AsyncSession, thread_id: int) -> Dict:
     try:
-        with Session(engine) as session:
-            messages = session.exec(
-                select(Message)
-                .where(Message.thread_id == thread_id)
-                .order_by(desc(Message.created_at))
-            ).all()
-            
-            thread_history = []
-            for msg in messages:
-                message_data = {
-                    "message_id": msg.message_id,
-                    "content": msg.content,
-                    "is_user_message": msg.is_user_message,
-                    "created_at": msg.created_at,
-                    "feedback_text": None,
-                    "is_positive": None
-                }
-                
-                if msg.feedback:
-                    message_data.update({
-                        "feedback_text": msg.feedback.feedback_text,
-                        "is_positive": msg.feedback.is_positive
-                    })
-                    
-                thread_history.append(message_data)
-                
-            return {"data": thread_history}
+        snapshot = await _load_thread_snapshot(session, thread_id)
+        return {"data": snapshot["messages"] if snapshot else []}
     except Exception as e:
         raise DatabaseError("Failed to retrieve thread history", str(e))
 
-def _get_user_threads(
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """Opaque keyset cursor pointing at the last row of a page"""
+    payload = json.dumps([created_at.isoformat(), row_id])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Raises:
+        ValueError: If the cursor was not produced by encode_cursor
+    """
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def _after_cursor(query, cursor: Optional[str], created_at_column, id_column):
+    """Keyset condition for pages ordered by (created_at DESC, id DESC)"""
+    if not cursor:
+        return query
+    created_at, row_id = decode_cursor(cursor)
+    return query.where(or_(
+        created_at_column < created_at,
+        and_(created_at_column == created_at, id_column < row_id)
+    ))
+
+async def _get_user_threads(
+    session: AsyncSession,
     user_id: str,
-    limit: Optional[int] = 10,
-    offset: Optional[int] = 0,
+    limit: int = 10,
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    include_total: bool = True,
     ) -> Tuple:
+    """
+    Page through a user's threads, newest first.
+
+    Pass the returned next_cursor back as cursor to get the following page;
+    offset is ignored when a cursor is given.
+
+    Returns:
+        Tuple of (threads, total_count or None, next_cursor or None)
+    """
     try:
-        with Session(engine) as session:
-            count_query = (select(func.count())
-                           .select_from(Thread)
-                           .where(Thread.user_id == user_id)
-                           .where(Thread.is_deleted == False)
-                           )
-            total_count = session.exec(count_query).one()
-            
-            
-            # Get thread summaries
-            threads_query = (
-                select(Thread)
-                .where(Thread.user_id == user_id)
-                .where(Thread.is_deleted == False)
-                .order_by(desc(Thread.created_at))
-                .offset(offset)
-                .limit(limit)
-            )    
-            thread_results = session.exec(threads_query).all()
-            # manually get prompt_list list from  prompt_list_str
-            thread_response = [
-                {
-                    **thread.model_dump(), 
-                    "prompt_list": thread.prompt_list
-                }
-                for thread in thread_results
-            ]
-            return thread_response, total_count
+        total_count = None
+        if include_total:
+            # maintained counter instead of a COUNT(*) over the user's threads
+            total_count = (await session.exec(
+                select(User.active_thread_count).where(User.user_id == user_id)
+            )).first() or 0
+        
+        
+        # Get thread summaries
+        threads_query = (
+            select(Thread)
+            .where(Thread.user_id == user_id)
+            .where(Thread.is_deleted == False)
+            .order_by(desc(Thread.created_at), desc(Thread.thread_id))
+        )
+        if cursor:
+            threads_query = _after_cursor(threads_query, cursor, Thread.created_at, Thread.thread_id)
+        else:
+            threads_query = threads_query.offset(offset)
+        # one extra row tells whether there is a next page
+        thread_results = (await session.exec(threads_query.limit(limit + 1))).all()
+        next_cursor = None
+        if len(thread_results) > limit:
+            thread_results = thread_results[:limit]
+            next_cursor = encode_cursor(thread_results[-1].created_at, thread_results[-1].thread_id)
+
+        # manually get prompt_list list from  prompt_list_str
+        thread_response = [
+            {
+                **thread.model_dump(), 
+                "prompt_list": thread.prompt_list
+            }
+            for thread in thread_results
+        ]
+        return thread_response, total_count, next_cursor
+    except ValueError:
+        raise
     except Exception as e:
         raise DatabaseError("Failed to retrieve user threads", str(e))
 
 
-def _get_thread_messages(
+# LONGTEXT logging columns (the full prompt and LLM output) that the thread view never renders.
+# Message listings leave them out unless they are asked for through include=
+HEAVY_MESSAGE_FIELDS = ("contents", "raw_prompt", "llm_response")
+LIGHT_MESSAGE_FIELDS = [
+    name for name in Message.model_fields
+    if name not in HEAVY_MESSAGE_FIELDS and name not in prompt_store.PAYLOAD_FIELDS.values()
+]
+
+def _message_fields(include: Optional[Sequence[str]] = None) -> List[str]:
+    """
+    Raises:
+        ValueError: If include names something other than a heavy message field
+    """
+    include = [field for field in (include or []) if field]
+    unknown = set(include) - set(HEAVY_MESSAGE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown include field(s): {', '.join(sorted(unknown))}. Allowed: {', '.join(HEAVY_MESSAGE_FIELDS)}")
+    heavy = [field for field in HEAVY_MESSAGE_FIELDS if field in include]
+    # chunk references, replaced by the reassembled text before returning
+    refs = [prompt_store.PAYLOAD_FIELDS[field] for field in heavy if field in prompt_store.PAYLOAD_FIELDS]
+    return LIGHT_MESSAGE_FIELDS + heavy + refs
+
+async def _get_thread_messages(
+        session: AsyncSession,
         thread_id: int,
-        limit: Optional[int] = 50,
-        offset: Optional[int] = 0,
+        limit: int = 50,
+        offset: int = 0,
+        cursor: Optional[str] = None,
+        include_total: bool = True,
+        include: Optional[Sequence[str]] = None,
         ) -> Tuple:
+    """
+    Page through the chat messages of a thread, newest first.
+
+    Only the columns the thread view renders are selected; pass any of
+    HEAVY_MESSAGE_FIELDS in include to also get the logged prompt/response.
+
+    Returns:
+        Tuple of (messages, total_count or None, next_cursor or None)
+    """
+    fields = _message_fields(include)
     try: 
-        with Session(engine) as session:
-            count_query = select(func.count()).select_from(Message).where(Message.thread_id == thread_id)
-            total_count = session.exec(count_query).one()            
-            message_results = (
-                session.exec(
-                    select(Message)
-                    .where(Message.thread_id == thread_id)
-                    # filter only relevant messages for FE to load thread content
-                    .where(Message.prompt_type == 'chatMessage') 
-                    .limit(limit)
-                    .offset(offset)
-                    .order_by(desc(Message.created_at))
-                ).all()
-            )
-            
-            # manually get parameters from parameters_str
-            message_response = [
-                {
-                    **message.model_dump(),
-                    "parameters": message.parameters
-                }
-                for message in message_results
-            ] 
-            return message_response, total_count
+        total_count = None
+        if include_total:
+            # maintained counter of the chat messages this endpoint pages through
+            total_count = (await session.exec(
+                select(Thread.chat_message_count).where(Thread.thread_id == thread_id)
+            )).first() or 0
+
+        # plain column rows, no ORM hydration of the deferred LONGTEXT payloads
+        messages_query = (
+            select(*(getattr(Message, field) for field in fields))
+            .where(Message.thread_id == thread_id)
+            # filter only relevant messages for FE to load thread content
+            .where(Message.prompt_type == 'chatMessage') 
+            .order_by(desc(Message.created_at), desc(Message.message_id))
+        )
+        if cursor:
+            messages_query = _after_cursor(messages_query, cursor, Message.created_at, Message.message_id)
+        else:
+            messages_query = messages_query.offset(offset)
+        message_results = (await session.exec(messages_query.limit(limit + 1))).all()
+        next_cursor = None
+        if len(message_results) > limit:
+            message_results = message_results[:limit]
+            next_cursor = encode_cursor(message_results[-1].created_at, message_results[-1].message_id)
+        
+        # manually get parameters from parameters_str
+        message_response = [
+            {
+                **message._asdict(),
+                "parameters": load_json_or_default(message.parameters_str, {})
+            }
+            for message in message_results
+        ] 
+        message_response = await prompt_store.load_payloads(session, message_response)
+        return message_response, total_count, next_cursor
+    except ValueError:
+        raise
     except Exception as e:
         raise DatabaseError("Failed to retrieve thread history", str(e))        
         
-def soft_delete_specific_threads(user_id: str, thread_ids: List[int]) -> Dict[str, Any]:
+async def soft_delete_specific_threads(session: AsyncSession, user_id: str, thread_ids: List[int]) -> Dict[str, Any]:
     """
     Mark specific threads for a user as deleted (soft delete)
     
@@ -254,111 +586,494 @@ def soft_delete_specific_threads(user_id: str, thread_ids: List[int]) -> Dict[st
     - Dictionary with count of affected threads
     """
     try:
-        with Session(engine) as session:
-            # Find all specified threads for the user that aren't already deleted
-            threads = session.query(Thread).filter(
-                Thread.user_id == user_id,
-                Thread.thread_id.in_(thread_ids),
-                Thread.is_deleted == False
-            ).all()
-            
-            # Mark them as deleted
-            count = 0
-            for thread in threads:
-                thread.is_deleted = True
-                count += 1
-            
-            session.commit()
-            return {"affected_count": count, "thread_ids": thread_ids}
+        # one set-based UPDATE, threads that are already deleted (or not the user's) are not counted
+        result = await session.exec(
+            update(Thread)
+            .where(Thread.user_id == user_id)
+            .where(Thread.thread_id.in_(thread_ids))
+            .where(Thread.is_deleted == False)
+            .values(is_deleted=True, deleted_at=datetime.utcnow())
+        )
+        count = result.rowcount
+        
+        if count:
+            await session.exec(
+                update(User)
+                .where(User.user_id == user_id)
+                .values(active_thread_count=User.active_thread_count - count)
+            )
+        await session.commit()
+        search_index.remove_threads(user_id, thread_ids)
+        invalidate_thread_snapshots(thread_ids)
+        return {"affected_count": count, "thread_ids": thread_ids}
     except Exception as e:
         raise DatabaseError("Failed to soft delete threads", {str(e)})
 
-def add_message(**kwargs) -> int | None:
+async def purge_deleted_threads(
+        session: AsyncSession,
+        retention_days: int = PURGE_RETENTION_DAYS,
+        batch_size: int = PURGE_BATCH_SIZE,
+        ) -> Dict[str, int]:
+    """
+    Hard delete threads that were soft deleted more than retention_days ago,
+    together with their messages and feedback, and then the prompt chunks
+    that no remaining message references.
+
+    Rows are deleted in chunks of at most batch_size, each in its own short
+    transaction, so the purge never holds long locks on the messages table.
+
+    Returns:
+        Dict with the number of threads, messages, feedbacks and prompt chunks deleted
+    """
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    purged = {"threads": 0, "messages": 0, "feedbacks": 0, "chunks": 0}
     try:
-        with Session(engine) as session:
-            message = Message(**kwargs)
-            session.add(message)
-            session.commit()
-            session.refresh(message)
-            return message.message_id
+        while True:
+            thread_ids = (await session.exec(
+                select(Thread.thread_id)
+                .where(Thread.is_deleted == True)
+                .where(Thread.deleted_at < cutoff)
+                .limit(batch_size)
+            )).all()
+            if not thread_ids:
+                break
+
+            while True:
+                message_ids = (await session.exec(
+                    select(Message.message_id)
+                    .where(Message.thread_id.in_(thread_ids))
+                    .limit(batch_size)
+                )).all()
+                if not message_ids:
+                    break
+                feedbacks = await session.exec(delete(Feedback).where(Feedback.message_id.in_(message_ids)))
+                messages = await session.exec(delete(Message).where(Message.message_id.in_(message_ids)))
+                await session.commit()
+                purged["feedbacks"] += feedbacks.rowcount
+                purged["messages"] += messages.rowcount
+
+            threads = await session.exec(delete(Thread).where(Thread.thread_id.in_(thread_ids)))
+            await session.commit()
+            purged["threads"] += threads.rowcount
+
+        if purged["messages"]:
+            purged["chunks"] = await prompt_store.delete_unreferenced_chunks(session, batch_size)
+        return purged
+    except Exception as e:
+        await session.rollback()
+        logging.error(f"Purge stopped after {purged}: {e}")
+        raise DatabaseError("Failed to purge deleted threads", str(e))
+
+async def reconcile_counters(session: AsyncSession) -> Dict[str, int]:
+    """
+    Recompute the denormalized counters from the source rows and fix any drift.
+
+    Returns:
+        Dict with the number of users and threads whose counter was corrected
+    """
+    try:
+        active_threads = (
+            select(func.count())
+            .select_from(Thread)
+            .where(Thread.user_id == User.user_id)
+            .where(Thread.is_deleted == False)
+            .scalar_subquery()
+        )
+        chat_messages = (
+            select(func.count())
+            .select_from(Message)
+            .where(Message.thread_id == Thread.thread_id)
+            .where(Message.prompt_type == 'chatMessage')
+            .scalar_subquery()
+        )
+        users_fixed = await session.exec(
+            update(User)
+            .where(User.active_thread_count != active_threads)
+            .values(active_thread_count=active_threads)
+        )
+        threads_fixed = await session.exec(
+            update(Thread)
+            .where(Thread.chat_message_count != chat_messages)
+            .values(chat_message_count=chat_messages)
+        )
+        await session.commit()
+        return {"users": users_fixed.rowcount, "threads": threads_fixed.rowcount}
+    except Exception as e:
+        raise DatabaseError("Failed to reconcile counters", str(e))
+
+def new_message(**kwargs) -> Message:
+    # parameters is a property over parameters_str, the model constructor drops it
+    parameters = kwargs.pop("parameters", None)
+    message = Message(**kwargs)
+    message.parameters = parameters
+    return message
+
+async def _add_chat_message_counts(session: AsyncSession, deltas: Dict[int, int]) -> None:
+    """Apply per-thread changes to chat_message_count, in the session's transaction"""
+    for thread_id, delta in deltas.items():
+        if delta:
+            await session.exec(
+                update(Thread)
+                .where(Thread.thread_id == thread_id)
+                .values(chat_message_count=Thread.chat_message_count + delta)
+            )
+
+async def prepare_logged_messages(session: AsyncSession, messages: Sequence[Message]) -> None:
+    """
+    Write-behind prepare step for queued messages: pack their payloads and
+    count the chat messages, in the transaction that inserts them
+    """
+    await prompt_store.pack_messages(session, messages)
+    await _add_chat_message_counts(session, Counter(
+        message.thread_id for message in messages if message.prompt_type == 'chatMessage'
+    ))
+
+async def add_message(session: AsyncSession, **kwargs) -> int | None:
+    try:
+        message = new_message(**kwargs)
+        await prompt_store.pack_messages(session, [message])
+        session.add(message)
+        if message.prompt_type == 'chatMessage':
+            await _add_chat_message_counts(session, {message.thread_id: 1})
+        # no refresh: the insert already filled in message_id and the defaults are set client side
+        await session.commit()
+        search_index.add_message(message)
+        invalidate_thread_snapshots([message.thread_id])
+        return message.message_id
     except Exception as e:
         raise DatabaseError("Failed to add message", str(e))
 
-def _update_message(**kwargs) -> Message:
+# JSON properties of the table models and the text column each one is stored in
+JSON_PROPERTY_COLUMNS = {
+    Message: {"parameters": "parameters_str"},
+    Thread: {"prompt_list": "prompt_list_str"},
+}
+
+# fields the update endpoints may set; keys, owners, timestamps and the delete flag are not among them
+UPDATABLE_FIELDS = {
+    Message: {
+        "actor", "type", "message", "summarized_prompt", "explore_url", "summary",
+        "prompt_type", "contents", "raw_prompt", "parameters", "llm_response",
+    },
+    Thread: {"explore_key", "explore_id", "model_name", "explore_url", "summarized_prompt", "prompt_list"},
+}
+
+def _update_values(model, fields: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Map update fields to column values, serializing the JSON properties.
+
+    Raises:
+        ValueError: If a field is not one of the UPDATABLE_FIELDS of the model
+    """
+    values = {}
+    for key, value in fields.items():
+        if key not in UPDATABLE_FIELDS[model]:
+            raise ValueError(f"{model.__name__} field cannot be updated: {key}")
+        column = JSON_PROPERTY_COLUMNS[model].get(key)
+        if column:
+            values[column] = None if value is None else json.dumps(value)
+        else:
+            values[key] = value
+    return values
+
+async def _sync_message_caches(session: AsyncSession, message_ids: Sequence[int], fields: Dict[str, Any]) -> None:
+    """Bring the search index and thread snapshots in line with a partial message update"""
+    reindex = search_index.enabled and set(fields) & set(SEARCH_FIELDS + ("thread_id",))
+    if not (reindex or len(thread_snapshot_cache)):
+        return
+    # only the columns the caches need, and only when one of them is in use
+    for message in await session.exec(
+        select(Message.user_id, *(getattr(Message, field) for field in MessageEntry._fields))
+        .where(Message.message_id.in_(message_ids))
+    ):
+        if reindex:
+            search_index.add_message(message)
+        invalidate_thread_snapshots([message.thread_id])
+
+async def _update_messages(
+        session: AsyncSession,
+        message_ids: Sequence[int],
+        fields: Dict[str, Any],
+        user_id: Optional[str] = None,
+        ) -> int:
+    """
+    Set the same fields on many messages with one UPDATE. With a user_id,
+    only the messages of that user are updated.
+
+    Returns:
+        The number of messages updated
+
+    Raises:
+        ValueError: If a field cannot be updated
+    """
+    values = _update_values(Message, fields)
+    if not values or not message_ids:
+        return 0
     try:
-        with Session(engine) as session:
-            message = session.get(Message, kwargs['message_id'])
-            if not message:
-                raise DatabaseError("Failed to update message", "Message not found")
-            
-            for key, value in kwargs.items():
-                setattr(message, key, value)
-            session.add(message)
-            session.commit()
-            session.refresh(message)
-            return message
+        values = await prompt_store.pack_values(session, values)
+        statement = update(Message).where(Message.message_id.in_(message_ids))
+        if user_id is not None:
+            statement = statement.where(Message.user_id == user_id)
+        if "prompt_type" in values:
+            # messages moved in or out of chatMessage change their threads' counters
+            current = select(Message.thread_id, Message.prompt_type).where(Message.message_id.in_(message_ids))
+            if user_id is not None:
+                current = current.where(Message.user_id == user_id)
+            deltas = Counter()
+            for row in await session.exec(current.with_for_update()):
+                deltas[row.thread_id] += (values["prompt_type"] == 'chatMessage') - (row.prompt_type == 'chatMessage')
+            await _add_chat_message_counts(session, deltas)
+        result = await session.exec(statement.values(**values))
+        await session.commit()
+        await _sync_message_caches(session, message_ids, fields)
+        return result.rowcount
     except Exception as e:
-        raise DatabaseError("Failed to update message", str(e))
+        raise DatabaseError("Failed to update messages", str(e))
 
+async def _update_message(session: AsyncSession, **kwargs) -> Dict[str, Any]:
+    """
+    Partial update of a message: one UPDATE of the given fields, nothing is read back.
+
+    Returns:
+        The message_id and the fields that were set
+    """
+    message_id = kwargs.pop('message_id')
+    user_id = kwargs.pop('user_id', None)
+    if await _update_messages(session, [message_id], kwargs, user_id) == 0 and kwargs:
+        raise DatabaseError("Failed to update message", "Message not found")
+    return {"message_id": message_id, **kwargs}
+
+
+async def set_llm_response(session: AsyncSession, message_id: int, llm_response: str) -> None:
+    """Store the LLM output of a logged message with a single UPDATE"""
+    try:
+        await session.exec(
+            update(Message)
+            .where(Message.message_id == message_id)
+            .values(llm_response=llm_response)
+        )
+        await session.commit()
+    except Exception as e:
+        raise DatabaseError("Failed to update message", str(e))
 
-def add_feedback(**kwargs) -> Feedback:
+async def add_feedback(session: AsyncSession, **kwargs) -> Feedback:
     try:
-        with Session(engine) as session:
-            feedback = Feedback(**kwargs)
-            session.add(feedback)
-            session.commit()
-            return feedback
+        feedback = Feedback(**kwargs)
+        session.add(feedback)
+        await session.commit()
+        if len(thread_snapshot_cache):
+            thread_id = (await session.exec(
+                select(Message.thread_id).where(Message.message_id == feedback.message_id)
+            )).first()
+            invalidate_thread_snapshots([thread_id])
+        if not feedback.is_positive and semantic_cache.enabled:
+            # stop serving the rejected URL to similar questions
+            rated = (await session.exec(
+                select(Thread.explore_key, Message.explore_url)
+                .join(Thread, Thread.thread_id == Message.thread_id)
+                .where(Message.message_id == feedback.message_id)
+            )).first()
+            if rated is not None and rated.explore_key:
+                semantic_cache.exclude(rated.explore_key, rated.explore_url)
+        return feedback
     except Exception as e:
         raise DatabaseError("Failed to add feedback", str(e))
 
-def generate_looker_query(contents, parameters=None):
-    default_parameters = {"temperature": 0.2, "max_output_tokens": 500, "top_p": 0.8, "top_k": 40}
-    if parameters:
-        default_parameters.update(parameters)
+async def lookup_explore_url(session: AsyncSession, thread_id: int, raw_prompt: str, use_cache: bool = True) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Look up a generated URL for a similar question on the thread's explore.
+
+    Returns:
+        Tuple of (explore_key, cached URL); explore_key is None when the semantic cache
+        doesn't apply, and the URL is None on a miss or when use_cache is False
+    """
+    if not semantic_cache.enabled or not raw_prompt:
+        return None, None
+    explore_key = (await session.exec(select(Thread.explore_key).where(Thread.thread_id == thread_id))).first()
+    if not explore_key or not use_cache:
+        return explore_key, None
+    url = await semantic_cache.lookup(explore_key, raw_prompt)
+    if url is not None:
+        logging.info({
+            "severity": "INFO",
+            "message": {"request": raw_prompt, "response": url, "semantic_cache_hit": True},
+            "component": "explore-assistant-metadata",
+        })
+    return explore_key, url
+
+async def get_thread_explore_key(session: AsyncSession, user_id: str, thread_id: int) -> Optional[str]:
+    """The explore_key of a live thread of the user, None when there is no such thread"""
+    return (await session.exec(
+        select(Thread.explore_key)
+        .where(Thread.thread_id == thread_id)
+        .where(Thread.user_id == user_id)
+        .where(Thread.is_deleted == False)
+    )).first()
+
+DEFAULT_GENERATION_PARAMETERS = {"temperature": 0.2, "max_output_tokens": 500, "top_p": 0.8, "top_k": 40}
 
-    response = model.generate_content(
-        contents=contents,
-        generation_config=GenerationConfig(**default_parameters),
-    )
+async def _generate_content(contents, parameters=None):
+    """
+    Send the prompt to Gemini without blocking the event loop.
+
+    Generations are awaited through the native async Vertex AI client and
+    capped by LLM_MAX_CONCURRENCY, so one slow response no longer stalls
+    every other request served by this instance.
+    """
+    generation_parameters = {**DEFAULT_GENERATION_PARAMETERS, **(parameters or {})}
 
+    async with llm_semaphore:
+        return await model.generate_content_async(
+            contents=contents,
+            generation_config=GenerationConfig(**generation_parameters),
+        )
+
+async def _generate_text(contents, parameters, component, prompt_type=None, use_cache=True, session=None):
+    """
+    Generate a response, serving it from the LLM response cache when the same
+    prompt was answered with the same model and generation config before.
+    The per-prompt_type TTL decides whether the response is cached, and
+    use_cache=False always calls the model (the fresh response is still cached).
+    Identical prompts generated at the same time share one model call, unless
+    use_cache=False asked for a fresh one.
+    """
+    generation_parameters = {**DEFAULT_GENERATION_PARAMETERS, **(parameters or {})}
+    ttl = llm_cache.ttl_for(prompt_type)
+    prompt_key = llm_cache.cache_key(MODEL_NAME, contents, generation_parameters)
+    key = prompt_key if ttl > 0 else None
+
+    if key and use_cache:
+        cached = await llm_cache.lookup(session, key)
+        if cached is not None:
+            logging.info({
+                "severity": "INFO",
+                "message": {
+                    "request": contents,
+                    "response": cached.text,
+                    "cache_hit": True,
+                    "saved_input_tokens": cached.input_tokens,
+                    "saved_output_tokens": cached.output_tokens,
+                },
+                "component": component,
+            })
+            return cached.text
+
+    async def call_model():
+        response = await _generate_content(contents, parameters)
+
+        metadata = response._raw_response.usage_metadata
+        log_entry = {
+            "severity": "INFO",
+            "message": {
+                "request": contents,
+                "response": response.text,
+                "input_characters": metadata.prompt_token_count,
+                "output_characters": metadata.candidates_token_count,
+            },
+            "component": component,
+        }
+        logging.info(log_entry)
+        return response
+
+    # a bypass must not be answered by a generation that was already running
+    response = await (llm_calls.do(prompt_key, call_model) if use_cache else call_model())
     metadata = response._raw_response.usage_metadata
-    log_entry = {
-        "severity": "INFO",
-        "message": {
-            "request": contents,
-            "response": response.text,
-            "input_characters": metadata.prompt_token_count,
-            "output_characters": metadata.candidates_token_count,
-        },
-        "component": "explore-assistant-metadata",
-    }
-    logging.info(log_entry)
+
+    if key:
+        await llm_cache.store(
+            session,
+            key,
+            llm_cache.CachedResponse(response.text, metadata.prompt_token_count, metadata.candidates_token_count),
+            ttl,
+            MODEL_NAME,
+            prompt_type,
+        )
     return response.text
 
-def generate_response(contents, parameters=None):
-    default_parameters = {"temperature": 0.2, "max_output_tokens": 500, "top_p": 0.8, "top_k": 40}
-    if parameters:
-        default_parameters.update(parameters)
+async def generate_looker_query(contents, parameters=None, prompt_type=None, use_cache=True, session=None):
+    return await _generate_text(contents, parameters, "explore-assistant-metadata", prompt_type, use_cache, session)
 
-    response = model.generate_content(
-        contents=contents,
-        generation_config=GenerationConfig(**default_parameters)
-    )
+async def generate_response(contents, parameters=None, prompt_type=None, use_cache=True, session=None):
+    return await _generate_text(contents, parameters, "prompt-response-metadata", prompt_type, use_cache, session)
 
-    metadata = response._raw_response.usage_metadata
+async def _stream_generation(contents, generation_parameters, queue: asyncio.Queue) -> None:
+    """
+    Run a streamed generation under llm_semaphore, handing every response
+    chunk to the queue, then None (or the exception) once it is over.
+    The queue is unbounded, so a slow client never holds the semaphore.
+    """
+    try:
+        async with llm_semaphore:
+            responses = await model.generate_content_async(
+                contents=contents,
+                generation_config=GenerationConfig(**generation_parameters),
+                stream=True,
+            )
+            async for response in responses:
+                queue.put_nowait(response)
+    except Exception as e:
+        queue.put_nowait(e)
+    else:
+        queue.put_nowait(None)
+
+async def generate_response_stream(contents, parameters=None, prompt_type=None, use_cache=True, session=None):
+    """
+    Yield the response text chunk by chunk as Gemini streams it. A cached
+    response is yielded whole, and a completed stream is cached like a
+    generate_response result. The generation runs in its own task, so the
+    semaphore is released as soon as the model is done, however fast the
+    chunks are consumed.
+    """
+    generation_parameters = {**DEFAULT_GENERATION_PARAMETERS, **(parameters or {})}
+    ttl = llm_cache.ttl_for(prompt_type)
+    key = llm_cache.cache_key(MODEL_NAME, contents, generation_parameters) if ttl > 0 else None
+
+    if key and use_cache:
+        cached = await llm_cache.lookup(session, key)
+        if cached is not None:
+            yield cached.text
+            return
+
+    chunks = []
+    metadata = None
+    queue = asyncio.Queue()
+    generation = asyncio.ensure_future(_stream_generation(contents, generation_parameters, queue))
+    try:
+        while (response := await queue.get()) is not None:
+            if isinstance(response, Exception):
+                raise response
+            # the token counts come with the last chunk
+            metadata = response._raw_response.usage_metadata
+            try:
+                text = response.text
+            except ValueError:
+                # a chunk without text parts, e.g. only the finish reason
+                continue
+            if text:
+                chunks.append(text)
+                yield text
+    finally:
+        # the client went away mid-stream: stop generating
+        generation.cancel()
 
-    entry = {
+    text = "".join(chunks)
+    input_tokens = metadata.prompt_token_count if metadata else 0
+    output_tokens = metadata.candidates_token_count if metadata else 0
+    logging.info({
         "severity": "INFO",
         "message": {
-            "request": contents, 
-            "response": response.text,
-            "input_characters": metadata.prompt_token_count,
-            "output_characters": metadata.candidates_token_count
-            },
+            "request": contents,
+            "response": text,
+            "input_characters": input_tokens,
+            "output_characters": output_tokens,
+            "streamed": True,
+        },
         "component": "prompt-response-metadata",
-    }
-    logging.info(entry)
-    return response.text
+    })
+    if key:
+        await llm_cache.store(
+            session, key, llm_cache.CachedResponse(text, input_tokens, output_tokens), ttl, MODEL_NAME, prompt_type
+        )
 
 def record_message(data):
     client = bigquery.Client()
@@ -371,7 +1086,7 @@ def record_message(data):
     except Exception as e:
       logging.error(f"BigQuery load job failed: {e}")
 
-def search_thread_history(user_id: str, search_query: str, limit: int = 10, offset: int = 0) -> Dict[str, Any]:
+async def search_thread_history(session: AsyncSession, user_id: str, search_query: str, limit: int = 10, offset: int = 0) -> Dict[str, Any]:
     """
     Search through thread history for messages containing the search keywords.
     
@@ -384,55 +1099,11 @@ def search_thread_history(user_id: str, search_query: str, limit: int = 10, offs
     Returns:
         Dict containing:
             - total (int): Total number of matching threads
-            - matches (List[Dict]): List of matching threads with messages
+            - matches (List[Dict]): Matching threads ranked by relevance, each
+              with its matched messages and a highlighted snippet
     """
     try:
-        with Session(engine) as session:
-            # Get total count
-            total_count = session.exec(
-                select([Thread])
-                .join(Message)
-                .where(Thread.user_id == user_id)
-                .where(Message.content.contains(search_query))
-                .distinct()
-            ).count()
-            
-            # Get matching threads with messages
-            threads = session.exec(
-                select(Thread)
-                .join(Message)
-                .where(Thread.user_id == user_id)
-                .where(Message.content.contains(search_query))
-                .distinct()
-                .order_by(Thread.created_at.desc())
-                .offset(offset)
-                .limit(limit)
-            ).all()
-            
-            matches = []
-            for thread in threads:
-                thread_data = {
-                    'thread_id': thread.thread_id,
-                    'explore_key': thread.explore_key,
-                    'created_at': thread.created_at.isoformat(),
-                    'messages': []
-                }
-                
-                for message in thread.messages:
-                    thread_data['messages'].append({
-                        'message_id': message.message_id,
-                        'content': message.content,
-                        'timestamp': message.created_at.isoformat(),
-                        'is_user': message.is_user_message,
-                        'matches_search': search_query.lower() in message.content.lower()
-                    })
-                    
-                matches.append(thread_data)
-                
-            return {
-                "total": total_count,
-                "matches": matches
-            }
+        return await search_messages(session, user_id, search_query, limit=limit, offset=offset)
 
     except Exception as e:
         logging.error(f"Database error in search_thread_history: {e}")
@@ -441,41 +1112,97 @@ def search_thread_history(user_id: str, search_query: str, limit: int = 10, offs
 
 
 
-def _update_thread(**kwargs) -> Thread:
+async def _update_threads(
+        session: AsyncSession,
+        thread_ids: Sequence[int],
+        fields: Dict[str, Any],
+        user_id: Optional[str] = None,
+        ) -> int:
+    """
+    Set the same fields on many threads with one UPDATE. With a user_id,
+    only the threads of that user are updated. is_deleted=True deletes the
+    threads through soft_delete_specific_threads, which needs the user_id.
+
+    Returns:
+        The number of threads updated
+
+    Raises:
+        ValueError: If a field cannot be updated
+    """
+    fields = dict(fields)
+    is_deleted = fields.pop("is_deleted", None)
+    if is_deleted is not None and (is_deleted is not True or user_id is None):
+        raise ValueError("is_deleted can only be set to true, for the threads of a user_id")
+    values = _update_values(Thread, fields)
+    if not thread_ids or not (values or is_deleted):
+        return 0
+    try:
+        rowcount = 0
+        if values:
+            statement = update(Thread).where(Thread.thread_id.in_(thread_ids))
+            if user_id is not None:
+                statement = statement.where(Thread.user_id == user_id)
+            result = await session.exec(statement.values(**values))
+            await session.commit()
+            rowcount = result.rowcount
+            if search_index.enabled:
+                # explore_key may have changed, rebuild on the next search
+                for owner in (await session.exec(
+                    select(Thread.user_id).where(Thread.thread_id.in_(thread_ids)).distinct()
+                )).all():
+                    search_index.invalidate(owner)
+            invalidate_thread_snapshots(thread_ids)
+        if is_deleted:
+            deleted = await soft_delete_specific_threads(session, user_id, list(thread_ids))
+            rowcount = rowcount or deleted["affected_count"]
+        return rowcount
+    except Exception as e:
+        logging.error(f"Error updating threads: {str(e)}")
+        raise DatabaseError("Failed to update threads", str(e))
+
+async def append_thread_prompt(session: AsyncSession, user_id: str, thread_id: int, prompt: str) -> int:
     """
-    Update an existing thread in the database.
+    Append a prompt to one of the user's threads' prompt_list in the database,
+    without reading the list back (JSON_ARRAY_APPEND on MySQL, json_insert on sqlite).
+
+    Returns:
+        The number of threads updated, 0 when the user has no such thread
+    """
+    try:
+        if session.bind.dialect.name == "mysql":
+            appended = func.JSON_ARRAY_APPEND(func.coalesce(Thread.prompt_list_str, func.JSON_ARRAY()), "$", prompt)
+        else:
+            appended = func.json_insert(func.coalesce(Thread.prompt_list_str, "[]"), "$[#]", prompt)
+        result = await session.exec(
+            update(Thread)
+            .where(Thread.thread_id == thread_id)
+            .where(Thread.user_id == user_id)
+            .values(prompt_list_str=appended)
+        )
+        await session.commit()
+        invalidate_thread_snapshots([thread_id])
+        return result.rowcount
+    except Exception as e:
+        raise DatabaseError("Failed to append thread prompt", str(e))
+
+async def _update_thread(session: AsyncSession, **kwargs) -> Dict[str, Any]:
+    """
+    Update an existing thread in the database with one UPDATE of the given fields.
     
     Args:
         thread_id: The ID of the thread to update
+        user_id: The owner of the thread, when given the thread must be theirs
         update_fields: Fields to update (explore_key, etc.)
         
     Returns:
-        Thread
+        The thread_id and the fields that were set
         
     Raises:
         DatabaseError: If the thread doesn't exist
+        ValueError: If a field cannot be updated
     """
-    try:
-        with Session(engine) as session:
-            # Get the thread
-            thread = session.get(Thread, kwargs['thread_id'])
-            
-            if not thread:
-                raise DatabaseError("Failed to update message",f"Thread with ID {kwargs['thread_id']} not found")
-                
-            
-            # Update fields
-            for key, value in kwargs.items():
-                setattr(thread, key, value)
-            
-            session.add(thread)
-            session.commit()
-            session.refresh(thread)
-            
-            # Return updated thread data
-            return thread
-
-
-    except Exception as e:
-        logging.error(f"Error updating thread: {str(e)}")
-        raise DatabaseError("Failed to update thread", str(e))
+    thread_id = kwargs.pop('thread_id')
+    user_id = kwargs.pop('user_id', None)
+    if await _update_threads(session, [thread_id], kwargs, user_id) == 0 and kwargs:
+        raise DatabaseError("Failed to update thread", f"Thread with ID {thread_id} not found")
+    return {"thread_id": thread_id, **kwargs}
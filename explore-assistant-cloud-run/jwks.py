@@ -0,0 +1,124 @@
+# jwks.py
+
+import asyncio
+import logging
+import re
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+import jwt
+
+GOOGLE_JWKS_URL = "https://www.googleapis.com/oauth2/v3/certs"
+GOOGLE_ISSUERS = ["accounts.google.com", "https://accounts.google.com"]
+
+
+class JWKSCache:
+    """
+    Signing keys fetched from a JWKS endpoint and kept in memory.
+
+    Keys are fetched once on first use and then refreshed in the background
+    when the Cache-Control max-age of the last response runs out, so token
+    verification never waits on the network once the cache is warm. A token
+    signed with an unknown key id forces a refresh (at most once per
+    min_refresh_interval) to pick up rotated keys.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        http_client: httpx.AsyncClient,
+        default_max_age: int = 3600,
+        min_refresh_interval: int = 60,
+    ):
+        self.url = url
+        self.http_client = http_client
+        self.default_max_age = default_max_age
+        self.min_refresh_interval = min_refresh_interval
+        self._keys: Dict[str, Any] = {}
+        self._expires_at = 0.0
+        self._fetched_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def load(self, jwks: Dict[str, Any], max_age: Optional[int] = None) -> None:
+        """Replace the cached keys with the ones from a JWKS document"""
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            try:
+                keys[jwk["kid"]] = jwt.PyJWK.from_dict(jwk).key
+            except (KeyError, jwt.PyJWKError) as e:
+                logging.warning(f"Skipping unusable JWK {jwk.get('kid')}: {e}")
+
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        self._expires_at = self._fetched_at + (self.default_max_age if max_age is None else max_age)
+
+    async def refresh(self) -> None:
+        # concurrent callers share the in-flight fetch
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._fetch())
+        await asyncio.shield(self._refresh_task)
+
+    async def _fetch(self) -> None:
+        response = await self.http_client.get(self.url)
+        response.raise_for_status()
+        self.load(response.json(), _max_age(response.headers.get("cache-control")))
+        logging.info(f"Refreshed {len(self._keys)} signing keys from {self.url}")
+
+    def _refresh_in_background(self) -> None:
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+
+        async def refresh_quietly():
+            try:
+                await self._fetch()
+            except Exception as e:
+                # keep serving the stale keys, the next lookup retries
+                logging.error(f"Background JWKS refresh failed: {e}")
+
+        self._refresh_task = asyncio.ensure_future(refresh_quietly())
+
+    async def get_signing_key(self, kid: str) -> Any:
+        if not self._keys:
+            await self.refresh()
+        elif time.monotonic() >= self._expires_at:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and time.monotonic() - self._fetched_at >= self.min_refresh_interval:
+            await self.refresh()
+            key = self._keys.get(kid)
+
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unknown signing key id: {kid}")
+        return key
+
+
+def _max_age(cache_control: Optional[str]) -> Optional[int]:
+    if not cache_control:
+        return None
+    match = re.search(r"max-age=(\d+)", cache_control)
+    return int(match.group(1)) if match else None
+
+
+def looks_like_jwt(token: str) -> bool:
+    return token.count(".") == 2
+
+
+async def verify_id_token(token: str, jwks_cache: JWKSCache, audience: str) -> Dict[str, Any]:
+    """
+    Verify a Google-signed ID token locally and return its claims.
+
+    Raises:
+        jwt.InvalidTokenError: If the signature, issuer, audience or expiry is invalid
+    """
+    header = jwt.get_unverified_header(token)
+    key = await jwks_cache.get_signing_key(header.get("kid"))
+    return jwt.decode(
+        token,
+        key,
+        algorithms=["RS256"],
+        audience=audience,
+        issuer=GOOGLE_ISSUERS,
+        options={"require": ["exp", "iat", "aud", "iss"]},
+    )
@@ -0,0 +1,187 @@
+# llm_cache.py
+"""
+Cache of Gemini responses for repeated prompts.
+
+The extension re-sends identical prompts (thread titles, prompt summaries)
+all the time, and at the default temperature of 0.2 a fresh generation
+adds nothing. Responses are cached under a hash of the model name, the
+whitespace-normalized prompt and the generation config, in memory with LRU
+eviction. With LLM_CACHE_PERSIST=1 they are also written to the
+llm_responses table, so an instance that scaled to zero starts warm.
+
+The cache is off until LLM_CACHE_TTL is set. Every prompt_type can have its
+own TTL (LLM_CACHE_PROMPT_TTLS) and a TTL of 0 disables caching for it.
+generateExploreUrl defaults to 0, so a repeated question is generated again
+against the current explore metadata unless it is opted in explicitly. A
+request sent with the X-LLM-Cache: bypass header always goes to the model.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Any, Dict, NamedTuple, Optional
+
+from sqlmodel import delete, insert, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from cache import TTLCache, register_cache
+from models import LLMResponse
+
+
+def parse_prompt_ttls(value: str) -> Dict[str, int]:
+    """Parse "prompt_type=seconds,..." into a dict"""
+    ttls = {}
+    for item in value.split(","):
+        if "=" in item:
+            prompt_type, seconds = item.split("=", 1)
+            ttls[prompt_type.strip()] = int(seconds)
+    return ttls
+
+
+# seconds a response is served from the cache, 0 disables the cache
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", "0"))
+LLM_CACHE_SIZE = int(os.environ.get("LLM_CACHE_SIZE", "1000"))
+# generated URLs have to follow changes to the explore's fields
+DEFAULT_PROMPT_TTLS = {"generateExploreUrl": 0}
+# per prompt_type overrides of LLM_CACHE_TTL, e.g. "summarizePrompts=86400,generateExploreUrl=600"
+LLM_CACHE_PROMPT_TTLS = {**DEFAULT_PROMPT_TTLS, **parse_prompt_ttls(os.environ.get("LLM_CACHE_PROMPT_TTLS", ""))}
+# also keep the responses in the llm_responses table
+LLM_CACHE_PERSIST = os.environ.get("LLM_CACHE_PERSIST") == "1"
+
+BYPASS_HEADER = "X-LLM-Cache"
+BYPASS_VALUE = "bypass"
+
+
+class CachedResponse(NamedTuple):
+    text: str
+    input_tokens: int
+    output_tokens: int
+
+
+# cache_key -> CachedResponse; sized for the longest TTL, entries get their own
+response_cache = register_cache(TTLCache(
+    "llm_responses",
+    maxsize=LLM_CACHE_SIZE,
+    ttl=max([LLM_CACHE_TTL, *LLM_CACHE_PROMPT_TTLS.values()]),
+))
+persistent_hits = 0
+saved_input_tokens = 0
+saved_output_tokens = 0
+
+
+def ttl_for(prompt_type: Optional[str]) -> int:
+    return LLM_CACHE_PROMPT_TTLS.get(prompt_type, LLM_CACHE_TTL)
+
+
+def is_bypass(header_value: Optional[str]) -> bool:
+    return (header_value or "").strip().lower() == BYPASS_VALUE
+
+
+def cache_key(model_name: str, contents: Any, generation_config: Dict[str, Any]) -> str:
+    if isinstance(contents, str):
+        prompt = re.sub(r"\s+", " ", contents).strip()
+    else:
+        prompt = json.dumps(contents, sort_keys=True, default=str)
+    payload = json.dumps([model_name, prompt, generation_config], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _record_hit(cached: CachedResponse) -> None:
+    global saved_input_tokens, saved_output_tokens
+    saved_input_tokens += cached.input_tokens
+    saved_output_tokens += cached.output_tokens
+
+
+async def lookup(session: Optional[AsyncSession], key: str) -> Optional[CachedResponse]:
+    """
+    Find a live cached response, in memory first and then in llm_responses.
+    A persistent hit is copied back into memory for the rest of its TTL.
+    """
+    global persistent_hits
+    cached = response_cache.get(key)
+    if cached is not None:
+        _record_hit(cached)
+        return cached
+    if not LLM_CACHE_PERSIST or session is None:
+        return None
+
+    now = datetime.utcnow()
+    try:
+        row = (await session.exec(
+            select(LLMResponse).where(LLMResponse.cache_key == key, LLMResponse.expires_at > now)
+        )).first()
+    except Exception as e:
+        logging.error(f"LLM response cache lookup failed: {e}")
+        return None
+    if row is None:
+        return None
+
+    cached = CachedResponse(row.response, row.input_tokens, row.output_tokens)
+    response_cache.set(key, cached, (row.expires_at - now).total_seconds())
+    persistent_hits += 1
+    _record_hit(cached)
+    return cached
+
+
+async def store(
+    session: Optional[AsyncSession],
+    key: str,
+    cached: CachedResponse,
+    ttl: int,
+    model_name: str,
+    prompt_type: Optional[str] = None,
+) -> None:
+    """Cache a response for ttl seconds; a failed database write only loses the persistent copy"""
+    response_cache.set(key, cached, ttl)
+    if not LLM_CACHE_PERSIST or session is None or ttl <= 0:
+        return
+
+    now = datetime.utcnow()
+    try:
+        # replaces an expired row; a concurrent writer of the same key wins
+        await session.exec(delete(LLMResponse).where(LLMResponse.cache_key == key))
+        await session.exec(
+            insert(LLMResponse).prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite"),
+            params=[{
+                "cache_key": key,
+                "model_name": model_name,
+                "prompt_type": prompt_type,
+                "response": cached.text,
+                "input_tokens": cached.input_tokens,
+                "output_tokens": cached.output_tokens,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=ttl),
+            }],
+        )
+        await session.commit()
+    except Exception as e:
+        await session.rollback()
+        logging.error(f"LLM response cache write failed: {e}")
+
+
+async def purge_expired(session: AsyncSession) -> int:
+    """
+    Delete the expired rows of llm_responses.
+
+    Returns:
+        The number of rows deleted
+    """
+    if not LLM_CACHE_PERSIST:
+        return 0
+    result = await session.exec(delete(LLMResponse).where(LLMResponse.expires_at <= datetime.utcnow()))
+    await session.commit()
+    return result.rowcount
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        **response_cache.stats(),
+        "persistent": LLM_CACHE_PERSIST,
+        "persistent_hits": persistent_hits,
+        "saved_input_tokens": saved_input_tokens,
+        "saved_output_tokens": saved_output_tokens,
+        "prompt_ttls": {"default": LLM_CACHE_TTL, **LLM_CACHE_PROMPT_TTLS},
+    }
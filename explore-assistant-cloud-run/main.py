@@ -1,58 +1,160 @@
 import os
+import asyncio
 import logging
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from typing import Optional, Dict, Any, Union, Tuple
-from fastapi import FastAPI, Request, HTTPException, Response, Depends, Security
+from fastapi import FastAPI, Request, HTTPException, Response, Depends, Security, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import json
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from models import (
     LoginRequest, ThreadRequest, MessageRequest, FeedbackRequest,
     BaseResponse, SearchResponse, UserThreadsResponse, ThreadMessagesResponse,
-    ThreadMessagesRequest, UserThreadsRequest, ThreadDeleteRequest
+    ThreadMessagesRequest, UserThreadsRequest, ThreadDeleteRequest, BatchUpdateRequest, ThreadPromptRequest,
+    ExploreUrlRequest, MAX_PAGE_SIZE,
+    Message
 )
-from database import get_session
+from database import async_engine, get_async_session, pool_stats
+from cache import cache_stats
+from write_behind import WriteBehindBuffer
+import prompt_store
+import llm_cache
+from semantic_cache import EXPLORE_URL_PROMPT_TYPE, semantic_cache
+from explore_prompts import EXPLORE_URL_PARAMETERS, parse_explore_key
+from looker_sdk.error import SDKError
 from helper_functions import (
+    ADMIN_TOKEN,
+    LOOKER_GROUP_PREFETCH,
+    RESTRICT_GROUP_ACCESS,
+    prefetch_group_members_periodically,
     validate_bearer_token,
+    token_validation_stats,
+    llm_call_stats,
     verify_looker_user,
     get_user_from_db,
     create_new_user,
     create_chat_thread,
     retrieve_thread_history,
+    get_thread_snapshot,
     add_message,
+    new_message,
+    set_llm_response,
     add_feedback,
     generate_response,
+    generate_response_stream,
     generate_looker_query,
+    lookup_explore_url,
+    get_thread_explore_key,
+    explore_prompt_builder,
     DatabaseError,
     _update_message,
+    _update_messages,
     _update_thread,
+    _update_threads,
+    append_thread_prompt,
     _get_user_threads,
     _get_thread_messages,
     search_thread_history,
-    soft_delete_specific_threads
+    soft_delete_specific_threads,
+    purge_deleted_threads,
+    reconcile_counters,
+    prepare_logged_messages,
+    invalidate_thread_snapshots
 )
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# seconds between background runs of the counter reconciliation job, 0 disables it
+COUNTER_RECONCILE_INTERVAL = int(os.environ.get("COUNTER_RECONCILE_INTERVAL", "0"))
+# seconds between background runs of the deleted thread purge, 0 disables it
+PURGE_INTERVAL = int(os.environ.get("PURGE_INTERVAL", "0"))
+# one-shot system prompt logs are queued and inserted in batches off the request path
+WRITE_BEHIND_ENABLED = os.environ.get("WRITE_BEHIND_ENABLED") == "1"
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get("WRITE_BEHIND_MAX_ROWS", "10000"))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "200"))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL", "1.0"))
+
+message_log = WriteBehindBuffer(
+    lambda: AsyncSession(async_engine, expire_on_commit=False),
+    Message,
+    max_rows=WRITE_BEHIND_MAX_ROWS,
+    batch_size=WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+    prepare=prepare_logged_messages,
+    on_flushed=lambda messages: invalidate_thread_snapshots({message.thread_id for message in messages}),
+) if WRITE_BEHIND_ENABLED else None
+
 # Security scheme
 security = HTTPBearer()
 
 # OAuth validation dependency
 async def validate_token(credentials: HTTPAuthorizationCredentials = Security(security)) -> bool:
-    if not validate_bearer_token(credentials.credentials):
+    if not await validate_bearer_token(credentials.credentials):
         raise HTTPException(
             status_code=403,
             detail="Invalid token"
         )
     return True
 
-app = FastAPI()
+# Admin-only dependency for operational endpoints
+async def validate_admin_token(credentials: HTTPAuthorizationCredentials = Security(security)) -> bool:
+    if not ADMIN_TOKEN or credentials.credentials != ADMIN_TOKEN:
+        raise HTTPException(
+            status_code=403,
+            detail="Invalid admin token"
+        )
+    return True
+
+async def reconcile_counters_periodically():
+    while True:
+        await asyncio.sleep(COUNTER_RECONCILE_INTERVAL)
+        try:
+            async with AsyncSession(async_engine, expire_on_commit=False) as session:
+                fixed = await reconcile_counters(session)
+            logger.info(f"Counter reconciliation fixed {fixed}")
+        except Exception as e:
+            logger.error(f"Counter reconciliation failed: {str(e)}")
+
+async def purge_deleted_threads_periodically():
+    while True:
+        await asyncio.sleep(PURGE_INTERVAL)
+        try:
+            async with AsyncSession(async_engine, expire_on_commit=False) as session:
+                purged = await purge_deleted_threads(session)
+                expired = await llm_cache.purge_expired(session)
+            logger.info(f"Deleted thread purge removed {purged}, expired LLM responses removed {expired}")
+        except Exception as e:
+            logger.error(f"Deleted thread purge failed: {str(e)}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    background_tasks = []
+    if LOOKER_GROUP_PREFETCH and RESTRICT_GROUP_ACCESS:
+        # warm the Looker user cache so logins are a dictionary lookup
+        background_tasks.append(asyncio.create_task(prefetch_group_members_periodically()))
+    if COUNTER_RECONCILE_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(reconcile_counters_periodically()))
+    if PURGE_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(purge_deleted_threads_periodically()))
+    if message_log is not None:
+        message_log.start()
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+    if message_log is not None:
+        # don't lose the queued prompt logs on scale down
+        await message_log.close()
+
+app = FastAPI(lifespan=lifespan)
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -74,15 +176,21 @@ app.add_middleware(
 @app.post("/")
 async def base(
     request: Request,
+    llm_cache_header: Optional[str] = Header(None, alias=llm_cache.BYPASS_HEADER),
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
 ):
     incoming_request = await request.json()
     contents = incoming_request.get("contents")
     parameters = incoming_request.get("parameters")
 
     try:
-        response_text = generate_looker_query(contents, parameters)
+        response_text = await generate_looker_query(
+            contents,
+            parameters,
+            use_cache=not llm_cache.is_bypass(llm_cache_header),
+            session=db
+            )
         logger.info(f"endpoint root - LLM response : {response_text}")
 
         data = [{
@@ -102,17 +210,17 @@ async def base(
 async def login(
     request: LoginRequest,
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
 ):
-    if not verify_looker_user(request.user_id):
+    if not await verify_looker_user(request.user_id):
         raise HTTPException(status_code=403, detail="User is not a validated Looker user")
     
     try: 
-        user_data = get_user_from_db(request.user_id)
+        user_data = await get_user_from_db(db, request.user_id)
         if user_data:
             return BaseResponse(message="User already exists", data=user_data)
 
-        result = create_new_user(request.user_id, request.name, request.email)
+        result = await create_new_user(db, request.user_id, request.name, request.email)
         return BaseResponse(message="User created successfully", data=result)
     except DatabaseError as e:
         raise HTTPException(status_code=500, detail={"error": e.args[0], "details": e.details})
@@ -121,10 +229,10 @@ async def login(
 async def create_thread(
     request: ThreadRequest,
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
 ):
     try:
-        thread_id = create_chat_thread(request.user_id, request.explore_key)
+        thread_id = await create_chat_thread(db, request.user_id, request.explore_key)
         if not thread_id:
             raise HTTPException(status_code=500, detail="Failed to create chat thread")
             
@@ -138,26 +246,35 @@ async def create_thread(
 @app.get("/user/thread")
 async def get_user_threads(
     user_id: str,
-    limit: Optional[int] = 10,
-    offset: Optional[int] = 0,
+    limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = None,
+    include_total: bool = True,
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
     ) -> UserThreadsResponse:
     """
     Get threads for a user with pagination.
     
     Parameters:
     - user_id: The ID of the user
-    - limit: Maximum number of threads to return (default: 10)
-    - offset: Offset for pagination (default: 0)
+    - limit: Maximum number of threads to return (default: 10, at most MAX_PAGE_SIZE)
+    - offset: Offset for pagination (default: 0), ignored when cursor is set
+    - cursor: next_cursor from the previous page, for keyset pagination
+    - include_total: Whether to count all of the user's threads (default: true)
     """
     try:
-        user_threads, total_count = _get_user_threads(user_id, limit, offset)
+        user_threads, total_count, next_cursor = await _get_user_threads(
+            db, user_id, limit, offset, cursor=cursor, include_total=include_total
+        )
         
         return UserThreadsResponse(
             threads=user_threads, 
-            total_count=total_count
+            total_count=total_count,
+            next_cursor=next_cursor
             )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except DatabaseError as e:
         raise HTTPException(
             status_code=503, 
@@ -180,26 +297,39 @@ async def get_user_threads(
 @app.get("/thread/{thread_id}/messages")
 async def get_thread_messages(
     thread_id: int,
-    limit: Optional[int] = 50,
-    offset: Optional[int] = 0,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = None,
+    include_total: bool = True,
+    include: Optional[str] = None,
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
     ) -> ThreadMessagesResponse:
     """
     Get messages for a thread with pagination.
     
     Parameters:
     - thread_id: The ID of the thread
-    - limit: Maximum number of messages to return (default: 50)
-    - offset: Offset for pagination (default: 0)
+    - limit: Maximum number of messages to return (default: 50, at most MAX_PAGE_SIZE)
+    - offset: Offset for pagination (default: 0), ignored when cursor is set
+    - cursor: next_cursor from the previous page, for keyset pagination
+    - include_total: Whether to count all of the thread's messages (default: true)
+    - include: Comma separated heavy columns to add to each message
+      (contents, raw_prompt, llm_response); left out by default
     """
     try:
-        messages, total_count = _get_thread_messages(thread_id, limit, offset)
+        messages, total_count, next_cursor = await _get_thread_messages(
+            db, thread_id, limit, offset, cursor=cursor, include_total=include_total,
+            include=include.split(",") if include else None
+        )
         
         return ThreadMessagesResponse(
             messages=messages,
-            total_count=total_count
+            total_count=total_count,
+            next_cursor=next_cursor
         )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -212,32 +342,91 @@ async def get_thread_messages(
 
 
 
+@app.get("/thread/{thread_id}/snapshot")
+async def get_thread_snapshot_endpoint(
+    thread_id: int,
+    authorized: bool = Depends(validate_token),
+    db: AsyncSession = Depends(get_async_session)
+    ) -> Response:
+    """
+    Everything needed to open a thread in one request: the thread metadata and
+    its visible messages, oldest first, each with its feedback attached.
+    """
+    try:
+        snapshot_json = await get_thread_snapshot(db, thread_id)
+    except DatabaseError as e:
+        raise HTTPException(
+            status_code=500,
+            detail={"error": "Failed to retrieve thread snapshot", "details": str(e)}
+        )
+    if snapshot_json is None:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    # already serialized, possibly from the snapshot cache
+    return Response(content=snapshot_json, media_type="application/json")
+
+
 @app.put("/thread/update")
 async def update_thread(
     update_fields: dict,
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
 ):
     try:
-        updated_thread = _update_thread(**update_fields)
+        updated_thread = await _update_thread(db, **update_fields)
         
         return BaseResponse(
             message="Thread updated successfully",
             data={"response": updated_thread}
             )
     
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/thread/{thread_id}/prompts")
+async def append_prompt(
+    thread_id: int,
+    request: ThreadPromptRequest,
+    authorized: bool = Depends(validate_token),
+    db: AsyncSession = Depends(get_async_session)
+):
+    try:
+        updated_count = await append_thread_prompt(db, request.user_id, thread_id, request.prompt)
+    except DatabaseError as e:
+        raise HTTPException(status_code=500, detail={"error": e.args[0], "details": e.details})
+    if not updated_count:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    return BaseResponse(
+        message="Prompt appended successfully",
+        data={"thread_id": thread_id}
+        )
+
+@app.put("/threads/update")
+async def update_threads(
+    request: BatchUpdateRequest,
+    authorized: bool = Depends(validate_token),
+    db: AsyncSession = Depends(get_async_session)
+):
+    try:
+        updated_count = await _update_threads(db, request.ids, request.fields, request.user_id)
+        return BaseResponse(
+            message="Threads updated successfully",
+            data={"updated_count": updated_count}
+            )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DatabaseError as e:
+        raise HTTPException(status_code=500, detail={"error": e.args[0], "details": e.details})
 
 @app.post("/threads/delete")
 async def delete_specific_threads(
     request: ThreadDeleteRequest,
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
 ):
     try:
-        result = soft_delete_specific_threads(request.user_id, request.thread_ids)
+        result = await soft_delete_specific_threads(db, request.user_id, request.thread_ids)
         return BaseResponse(
             message="Threads marked as deleted successfully",
             data=result
@@ -249,22 +438,75 @@ async def delete_specific_threads(
         )
 
 
+async def generate_message_response(db: AsyncSession, request: MessageRequest, cache_options: Dict[str, Any]) -> str:
+    # explore URLs of similar questions on the same explore come from the semantic cache
+    explore_key = None
+    if request.prompt_type == EXPLORE_URL_PROMPT_TYPE:
+        explore_key, cached_url = await lookup_explore_url(db, request.thread_id, request.raw_prompt, cache_options["use_cache"])
+        if cached_url is not None:
+            return cached_url
+
+    response_text = await generate_response(
+        request.contents,
+        request.parameters,
+        **cache_options
+        )
+    if explore_key:
+        semantic_cache.add(explore_key, request.raw_prompt, response_text)
+    return response_text
+
 @app.post("/message")
 async def process_message(
     request: MessageRequest,
+    llm_cache_header: Optional[str] = Header(None, alias=llm_cache.BYPASS_HEADER),
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
 ):
+    # identical prompts are answered from the LLM response cache unless the FE bypasses it
+    cache_options = {
+        "prompt_type": request.prompt_type,
+        "use_cache": not llm_cache.is_bypass(llm_cache_header),
+        "session": db,
+    }
     try:
 
 
-        request_dict = request.model_dump()
-        if not request.message_id:
+        request_dict = request.model_dump(exclude={"one_shot"})
+        if not request.message_id and request.one_shot and request.actor == "system" and message_log is not None:
+            # scenario : same as below for a system prompt, which only exists for logging.
+            # the log row is queued with the response and inserted in the background,
+            # so there is no message id to return.
+            response_text = None
+            try:
+                response_text = await generate_message_response(db, request, cache_options)
+            finally:
+                await message_log.put(new_message(**request_dict, llm_response=response_text))
+
+            return BaseResponse(
+                message="Message handled successfully",
+                data={"message_id": None, "response": response_text}
+            )
+
+        elif not request.message_id and request.one_shot:
+            # scenario : FE sends the message once; it is logged, passed to the LLM
+            # and the response is stored, all in this request.
+            new_id = await add_message(db, **request_dict)
+            response_text = await generate_message_response(db, request, cache_options)
+            await set_llm_response(db, new_id, response_text)
+
+            logger.info(f"LLM Response: {response_text}")
+
+            return BaseResponse(
+                message="Message handled successfully",
+                data={"message_id": new_id, "response": response_text}
+            )
+
+        elif not request.message_id:
             # scenario : FE send request to generate a message ID
             # the endpoint will return a message id of the logged data
             # WITHOUT any LLM processing; FE will the resend the message with new id
             # to continue the process.
-            new_id = add_message(**request_dict)
+            new_id = await add_message(db, **request_dict)
             
             return BaseResponse(
                 message="Message ID generated successfully",
@@ -274,14 +516,12 @@ async def process_message(
         elif request.message_id:
             # scenario : FE sends the message with valid message id to LLM.
             # the endpoint will now pass the message to LLM and return the results
-            response_text = generate_response(
-                request.contents,
-                request.parameters
-                )
+            response_text = await generate_message_response(db, request, cache_options)
             
-            # update the logged message record with LLM response
+            # update the logged message record (of this user) with LLM response
+            request_dict.pop('thread_id')
             request_dict['llm_response'] = response_text
-            updated_message = _update_message(**request_dict)
+            updated_message = await _update_message(db, **request_dict)
 
             logger.info(f"LLM Response: {response_text}")
             
@@ -295,33 +535,145 @@ async def process_message(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/message/explore_url")
+async def generate_explore_url(
+    request: ExploreUrlRequest,
+    llm_cache_header: Optional[str] = Header(None, alias=llm_cache.BYPASS_HEADER),
+    authorized: bool = Depends(validate_token),
+    db: AsyncSession = Depends(get_async_session)
+):
+    # scenario : FE sends only the question; the generateExploreUrl prompt is assembled
+    # here for the thread's explore and handled like a one_shot system /message.
+    explore_key = await get_thread_explore_key(db, request.user_id, request.thread_id)
+    if explore_key is None:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    if request.explore_key is not None and request.explore_key != explore_key:
+        raise HTTPException(
+            status_code=400,
+            detail=f"explore_key {request.explore_key} is not the thread's explore_key {explore_key}"
+        )
+    try:
+        parse_explore_key(explore_key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        contents = await explore_prompt_builder.prompt(explore_key, request.prompt)
+    except SDKError as e:
+        raise HTTPException(status_code=404, detail=f"Explore {explore_key} not found: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={"error": "Failed to assemble the explore prompt", "details": str(e)})
+
+    message_request = MessageRequest(
+        user_id=request.user_id,
+        thread_id=request.thread_id,
+        actor="system",
+        contents=contents,
+        prompt_type=EXPLORE_URL_PROMPT_TYPE,
+        raw_prompt=request.prompt,
+        parameters=request.parameters or EXPLORE_URL_PARAMETERS,
+        one_shot=True,
+    )
+    return await process_message(message_request, llm_cache_header, authorized, db)
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/message/stream")
+async def stream_message(
+    request: MessageRequest,
+    llm_cache_header: Optional[str] = Header(None, alias=llm_cache.BYPASS_HEADER),
+    authorized: bool = Depends(validate_token),
+    db: AsyncSession = Depends(get_async_session)
+):
+    # scenario : same as a one_shot /message, but the LLM response is relayed
+    # as Server-Sent Events while it is generated:
+    #   event: chunk  data: {"text": ...}             for every streamed piece
+    #   event: done   data: {"message_id", "response"} once the response is stored
+    #   event: error  data: {"detail": ...}            if the generation fails midway
+    try:
+        message_id = request.message_id
+        if not message_id:
+            message_id = await add_message(db, **request.model_dump(exclude={"one_shot"}))
+    except DatabaseError as e:
+        raise HTTPException(status_code=500, detail={"error": e.args[0], "details": e.details})
+
+    async def events():
+        # the body is sent after the endpoint returns, when the request's session
+        # may already be closed, so the stream has a session of its own
+        chunks = []
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            try:
+                async for text in generate_response_stream(
+                    request.contents,
+                    request.parameters,
+                    prompt_type=request.prompt_type,
+                    use_cache=not llm_cache.is_bypass(llm_cache_header),
+                    session=session
+                    ):
+                    chunks.append(text)
+                    yield sse_event("chunk", {"text": text})
+
+                response_text = "".join(chunks)
+                # same update as the message_id scenario of /message
+                await _update_message(session, message_id=message_id, user_id=request.user_id, llm_response=response_text)
+                logger.info(f"LLM Response: {response_text}")
+                yield sse_event("done", {"message_id": message_id, "response": response_text})
+            except Exception as e:
+                logger.error(f"Streaming message {message_id} failed: {str(e)}")
+                yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.put("/message/update")
 async def update_message(
     update_fields: dict,
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
 ):
     try:
 
-        updated_message = _update_message(**update_fields)
+        updated_message = await _update_message(db, **update_fields)
         
         return BaseResponse(
             message="Message updated successfully",
             data={"response": updated_message}
             )
     
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.put("/messages/update")
+async def update_messages(
+    request: BatchUpdateRequest,
+    authorized: bool = Depends(validate_token),
+    db: AsyncSession = Depends(get_async_session)
+):
+    try:
+        updated_count = await _update_messages(db, request.ids, request.fields, request.user_id)
+        return BaseResponse(
+            message="Messages updated successfully",
+            data={"updated_count": updated_count}
+            )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DatabaseError as e:
+        raise HTTPException(status_code=500, detail={"error": e.args[0], "details": e.details})
+
 
 @app.post("/feedback")
 async def give_feedback(
     request: FeedbackRequest,
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
 ):
     try:
-        result = add_feedback(**request.model_dump())
+        result = await add_feedback(db, **request.model_dump())
         if result:
             return BaseResponse(
                 message="Feedback submitted successfully",
@@ -339,10 +691,11 @@ async def search_threads(
     limit: int = 10,
     offset: int = 0,
     authorized: bool = Depends(validate_token),
-    db: Session = Depends(get_session)
+    db: AsyncSession = Depends(get_async_session)
 ) -> SearchResponse:
     try:
-        search_results = search_thread_history(
+        search_results = await search_thread_history(
+            db,
             user_id=user_id,
             search_query=search_query,
             limit=limit,
@@ -361,6 +714,91 @@ async def search_threads(
             detail={"error": "Failed to search thread history", "details": str(e)}
         )
 
+@app.get("/admin/cache/stats")
+async def get_cache_stats(
+    authorized: bool = Depends(validate_admin_token)
+):
+    return BaseResponse(
+        message="Cache statistics retrieved successfully",
+        data={
+            "caches": cache_stats(),
+            "token_validation": token_validation_stats(),
+            "llm_responses": llm_cache.stats(),
+            "llm_calls": llm_call_stats(),
+            "semantic_explore_urls": semantic_cache.stats()
+        }
+    )
+
+@app.get("/admin/db/pool")
+async def get_pool_stats(
+    authorized: bool = Depends(validate_admin_token)
+):
+    return BaseResponse(
+        message="Connection pool statistics retrieved successfully",
+        data=pool_stats()
+    )
+
+@app.post("/admin/counters/reconcile")
+async def reconcile_counters_endpoint(
+    authorized: bool = Depends(validate_admin_token),
+    db: AsyncSession = Depends(get_async_session)
+):
+    try:
+        fixed = await reconcile_counters(db)
+        return BaseResponse(
+            message="Counters reconciled successfully",
+            data={"fixed": fixed}
+        )
+    except DatabaseError as e:
+        raise HTTPException(status_code=500, detail={"error": e.args[0], "details": e.details})
+
+@app.get("/admin/write_behind/stats")
+async def get_write_behind_stats(
+    authorized: bool = Depends(validate_admin_token)
+):
+    return BaseResponse(
+        message="Write-behind stats retrieved successfully",
+        data={"message_log": message_log.stats() if message_log is not None else None}
+    )
+
+@app.post("/admin/prompts/compact")
+async def compact_prompts_endpoint(
+    batch_size: int = 100,
+    max_batches: Optional[int] = None,
+    authorized: bool = Depends(validate_admin_token),
+    db: AsyncSession = Depends(get_async_session)
+):
+    if not prompt_store.PROMPT_CHUNK_STORE:
+        raise HTTPException(status_code=400, detail="PROMPT_CHUNK_STORE is not enabled")
+    try:
+        compacted = await prompt_store.compact_messages(db, batch_size=batch_size, max_batches=max_batches)
+        # payloads replaced by message updates leave chunks behind without any purge
+        chunks = await prompt_store.delete_unreferenced_chunks(db)
+        return BaseResponse(
+            message="Prompt payloads compacted successfully",
+            data={"compacted": compacted, "chunks_deleted": chunks}
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={"error": "Failed to compact prompt payloads", "details": str(e)})
+
+@app.post("/admin/threads/purge")
+async def purge_deleted_threads_endpoint(
+    retention_days: Optional[int] = None,
+    authorized: bool = Depends(validate_admin_token),
+    db: AsyncSession = Depends(get_async_session)
+):
+    try:
+        if retention_days is None:
+            purged = await purge_deleted_threads(db)
+        else:
+            purged = await purge_deleted_threads(db, retention_days=retention_days)
+        return BaseResponse(
+            message="Deleted threads purged successfully",
+            data={"purged": purged}
+        )
+    except DatabaseError as e:
+        raise HTTPException(status_code=500, detail={"error": e.args[0], "details": e.details})
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8080))
@@ -0,0 +1,224 @@
+# migrations.py
+"""
+Versioned schema migrations for the chat tables.
+
+Applied versions are recorded in the schema_migrations table, so every
+migration runs once per database and existing tables are altered in place,
+never dropped. Migration steps are idempotent (they check the live schema
+first), which also lets them run against databases that were created with
+SQLModel.metadata.create_all.
+
+Usage:
+    python migrations.py upgrade   # apply pending migrations
+    python migrations.py status    # list applied and pending migrations
+    python migrations.py check     # report indexes declared in models.py that are missing
+"""
+
+import logging
+import sys
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Sequence
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, Text, inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateColumn, Index
+from sqlmodel import SQLModel
+
+import models  # registers the chat tables on SQLModel.metadata
+import search
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    upgrade: Callable[[Connection], None]
+
+
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("name", String(255), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+# Idempotent building blocks for migrations
+
+def create_index_if_missing(conn: Connection, table_name: str, index_name: str, columns: Sequence[str], **kwargs) -> None:
+    existing = {index["name"] for index in inspect(conn).get_indexes(table_name)}
+    if index_name in existing:
+        return
+    table = Table(table_name, MetaData(), autoload_with=conn)
+    Index(index_name, *(table.c[column] for column in columns), **kwargs).create(conn)
+    logging.info(f"Created index {index_name} on {table_name}")
+
+def add_column_if_missing(conn: Connection, table_name: str, column: Column) -> None:
+    existing = {c["name"] for c in inspect(conn).get_columns(table_name)}
+    if column.name in existing:
+        return
+    column_spec = CreateColumn(column).compile(dialect=conn.dialect)
+    conn.exec_driver_sql(f"ALTER TABLE {table_name} ADD COLUMN {column_spec}")
+    logging.info(f"Added column {column.name} to {table_name}")
+
+
+# Migrations, in order. Never edit an applied migration, append a new one.
+
+def _baseline(conn: Connection) -> None:
+    # the tables as they existed before versioned migrations
+    SQLModel.metadata.create_all(
+        conn,
+        tables=[models.User.__table__, models.Thread.__table__, models.Message.__table__, models.Feedback.__table__],
+        checkfirst=True,
+    )
+
+def _add_chat_indexes(conn: Connection) -> None:
+    create_index_if_missing(conn, "threads", "ix_threads_user_id_is_deleted_created_at", ["user_id", "is_deleted", "created_at"])
+    create_index_if_missing(conn, "messages", "ix_messages_thread_id_prompt_type_created_at", ["thread_id", "prompt_type", "created_at"])
+    create_index_if_missing(conn, "feedbacks", "ix_feedbacks_message_id", ["message_id"])
+
+def _add_counter_columns(conn: Connection) -> None:
+    add_column_if_missing(conn, "users", Column("active_thread_count", Integer, nullable=False, server_default="0"))
+    add_column_if_missing(conn, "threads", Column("chat_message_count", Integer, nullable=False, server_default="0"))
+    # backfill from the current rows
+    conn.execute(text(
+        "UPDATE users SET active_thread_count = ("
+        " SELECT COUNT(*) FROM threads"
+        " WHERE threads.user_id = users.user_id AND threads.is_deleted = 0)"
+    ))
+    conn.execute(text(
+        "UPDATE threads SET chat_message_count = ("
+        " SELECT COUNT(*) FROM messages"
+        " WHERE messages.thread_id = threads.thread_id AND messages.prompt_type = 'chatMessage')"
+    ))
+
+def _add_message_fulltext_index(conn: Connection) -> None:
+    # search.py falls back to an in-memory index on other backends
+    if conn.dialect.name != "mysql":
+        return
+    create_index_if_missing(conn, "messages", search.FULLTEXT_INDEX, list(search.SEARCH_FIELDS), mysql_prefix="FULLTEXT")
+
+
+def _add_thread_deleted_at(conn: Connection) -> None:
+    add_column_if_missing(conn, "threads", Column("deleted_at", DateTime, nullable=True))
+    # threads deleted before this migration get a full retention window from now
+    conn.execute(
+        text("UPDATE threads SET deleted_at = :now WHERE is_deleted = 1 AND deleted_at IS NULL"),
+        {"now": datetime.utcnow()},
+    )
+    create_index_if_missing(conn, "threads", "ix_threads_is_deleted_deleted_at", ["is_deleted", "deleted_at"])
+
+def _add_prompt_chunk_store(conn: Connection) -> None:
+    SQLModel.metadata.create_all(conn, tables=[models.PromptChunk.__table__], checkfirst=True)
+    add_column_if_missing(conn, "messages", Column("contents_ref", Text, nullable=True))
+    add_column_if_missing(conn, "messages", Column("raw_prompt_ref", Text, nullable=True))
+
+def _use_native_json_columns(conn: Connection) -> None:
+    # other backends keep storing the JSON as text
+    if conn.dialect.name != "mysql":
+        return
+    for table, column in [("threads", "prompt_list"), ("messages", "param")]:
+        # MODIFY fails on invalid documents, they were already read back as the default
+        conn.execute(text(f"UPDATE {table} SET {column} = NULL WHERE {column} IS NOT NULL AND JSON_VALID({column}) = 0"))
+        conn.exec_driver_sql(f"ALTER TABLE {table} MODIFY {column} JSON NULL")
+
+def _add_llm_response_cache(conn: Connection) -> None:
+    SQLModel.metadata.create_all(conn, tables=[models.LLMResponse.__table__], checkfirst=True)
+
+def _add_prompt_chunk_last_referenced_at(conn: Connection) -> None:
+    add_column_if_missing(conn, "prompt_chunks", Column("last_referenced_at", DateTime, nullable=True))
+    # existing chunks get a full grace period from now
+    conn.execute(
+        text("UPDATE prompt_chunks SET last_referenced_at = :now WHERE last_referenced_at IS NULL"),
+        {"now": datetime.utcnow()},
+    )
+    create_index_if_missing(conn, "prompt_chunks", "ix_prompt_chunks_last_referenced_at", ["last_referenced_at"])
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline", _baseline),
+    Migration(2, "add chat indexes", _add_chat_indexes),
+    Migration(3, "add denormalized thread and message counters", _add_counter_columns),
+    Migration(4, "add message fulltext index", _add_message_fulltext_index),
+    Migration(5, "add thread deleted_at for the purge job", _add_thread_deleted_at),
+    Migration(6, "add content-addressed prompt chunk storage", _add_prompt_chunk_store),
+    Migration(7, "use native JSON columns for prompt_list and param", _use_native_json_columns),
+    Migration(8, "add persistent LLM response cache", _add_llm_response_cache),
+    Migration(9, "add prompt chunk last_referenced_at for the chunk sweep", _add_prompt_chunk_last_referenced_at),
+]
+
+
+def applied_versions(conn: Connection) -> List[int]:
+    schema_migrations.create(conn, checkfirst=True)
+    return sorted(row.version for row in conn.execute(schema_migrations.select()))
+
+def upgrade(engine: Engine) -> List[Migration]:
+    """
+    Apply every pending migration, each in its own transaction.
+
+    Returns:
+        List[Migration]: The migrations that were applied
+    """
+    applied = []
+    with engine.begin() as conn:
+        done = set(applied_versions(conn))
+
+    for migration in MIGRATIONS:
+        if migration.version in done:
+            continue
+        with engine.begin() as conn:
+            logging.info(f"Applying migration {migration.version}: {migration.name}")
+            migration.upgrade(conn)
+            conn.execute(schema_migrations.insert().values(
+                version=migration.version,
+                name=migration.name,
+                applied_at=datetime.utcnow(),
+            ))
+        applied.append(migration)
+    return applied
+
+def missing_indexes(engine: Engine) -> List[str]:
+    """
+    Compare the indexes declared on the models with the ones in the database.
+
+    Returns:
+        List[str]: Description of every declared index that is missing
+    """
+    missing = []
+    with engine.connect() as conn:
+        inspector = inspect(conn)
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                missing.append(f"{table.name}: table does not exist")
+                continue
+            existing = {tuple(index["column_names"]) for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                columns = tuple(column.name for column in index.columns)
+                if columns not in existing:
+                    missing.append(f"{table.name}: {index.name} ({', '.join(columns)})")
+    return missing
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+
+    if command == "upgrade":
+        applied = upgrade(engine)
+        print(f"Applied {len(applied)} migration(s)")
+    elif command == "status":
+        with engine.begin() as conn:
+            done = set(applied_versions(conn))
+        for migration in MIGRATIONS:
+            print(f"[{'x' if migration.version in done else ' '}] {migration.version:04d} {migration.name}")
+    elif command == "check":
+        missing = missing_indexes(engine)
+        for line in missing:
+            print(f"missing index - {line}")
+        print("All declared indexes are present" if not missing else f"{len(missing)} missing")
+        sys.exit(1 if missing else 0)
+    else:
+        print(__doc__)
+        sys.exit(2)
@@ -4,8 +4,47 @@ from enum import Enum
 from datetime import datetime
 from sqlmodel import SQLModel, Field, Relationship
 import json
-from sqlalchemy import Column, JSON
-from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlalchemy import Column, Index, JSON, LargeBinary, Text
+from sqlalchemy.dialects.mysql import LONGBLOB, LONGTEXT
+from sqlalchemy.types import UserDefinedType
+
+class JSONString(UserDefinedType):
+    """
+    A native JSON column whose values stay JSON strings on the Python side, so the
+    *_str fields keep their meaning while MySQL validates the documents and can
+    modify them in place (JSON_ARRAY_APPEND).
+    """
+    cache_ok = True
+
+    def get_col_spec(self, **kw):
+        return "JSON"
+
+# LONGTEXT on MySQL, plain TEXT on other backends (e.g. sqlite for local testing)
+LongText = Text().with_variant(LONGTEXT(), "mysql")
+LongBlob = LargeBinary().with_variant(LONGBLOB(), "mysql")
+JSONText = Text().with_variant(JSONString(), "mysql")
+
+def load_json_or_default(value: Optional[str], default: Any) -> Any:
+    """Parse a JSON string column, falling back to default when empty or malformed"""
+    if not value:
+        return default
+    try:
+        return json.loads(value)
+    except:
+        return default
+
+def memoized_json(instance: SQLModel, field: str, default: Any) -> Any:
+    """
+    Parse the JSON string in instance.<field> once and reuse the result until
+    the field is assigned again. Treat the result as read only: assign a new
+    value through the property to change it.
+    """
+    raw = getattr(instance, field)
+    memo = instance.__dict__.get(f"_{field}_parsed")
+    if memo is None or memo[0] is not raw:
+        memo = (raw, load_json_or_default(raw, default))
+        instance.__dict__[f"_{field}_parsed"] = memo
+    return memo[1]
 
 class User(SQLModel, table=True):
     __tablename__ = "users"
@@ -14,44 +53,51 @@ class User(SQLModel, table=True):
     name: str
     email: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    # denormalized count of threads with is_deleted = false, maintained by the thread helpers
+    active_thread_count: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
     threads: List["Thread"] = Relationship(back_populates="user")
 
 class Thread(SQLModel, table=True):
     __tablename__ = "threads"
+    __table_args__ = (
+        # _get_user_threads: user_id = ? AND is_deleted = false ORDER BY created_at DESC
+        Index("ix_threads_user_id_is_deleted_created_at", "user_id", "is_deleted", "created_at"),
+        # purge_deleted_threads: is_deleted = true AND deleted_at < ?
+        Index("ix_threads_is_deleted_deleted_at", "is_deleted", "deleted_at"),
+    )
 
     thread_id: Optional[int] = Field(default=None, primary_key=True)
     user_id: str = Field(foreign_key="users.user_id")
     explore_key: Optional[str]
     explore_id: Optional[str]
     model_name: Optional[str]
-    explore_url: Optional[str] = Field(sa_column=Column(LONGTEXT))
+    explore_url: Optional[str] = Field(sa_column=Column(LongText))
     summarized_prompt: Optional[str] = Field(
         description="""
         The last user prompt summarized by LLM.
         This is also the thread title shown on sidebar
         Gets updated with every new prompt from user.
         """,
-        sa_column=Column(LONGTEXT)
+        sa_column=Column(LongText)
         )
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_deleted: bool = Field(default=False)
+    # set by soft_delete_specific_threads, the purge job hard deletes the thread once it is past retention
+    deleted_at: Optional[datetime] = Field(default=None)
+    # denormalized count of messages with prompt_type 'chatMessage', maintained by add_message
+    chat_message_count: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
     
     
-    # Store as LONGTEXT and handle JSON conversion manually
+    # Stored as a native JSON column on MySQL, parsed on first access
     prompt_list_str: Optional[str] = Field(
-        sa_column=Column(LONGTEXT, name='prompt_list'), 
+        sa_column=Column(JSONText, name='prompt_list'), 
         default=None
         )
 
     @property
     def prompt_list(self) -> List[str]:
         """Get the prompt list as a Python list"""
-        if not self.prompt_list_str:
-            return []
-        try:
-            return json.loads(self.prompt_list_str)
-        except:
-            return []
+        return memoized_json(self, "prompt_list_str", [])
     
     @prompt_list.setter
     def prompt_list(self, value: List[str]):
@@ -102,6 +148,10 @@ class Thread(SQLModel, table=True):
 
 class Message(SQLModel, table=True):
     __tablename__ = "messages"
+    __table_args__ = (
+        # _get_thread_messages: thread_id = ? AND prompt_type = 'chatMessage' ORDER BY created_at DESC
+        Index("ix_messages_thread_id_prompt_type_created_at", "thread_id", "prompt_type", "created_at"),
+    )
     
     # general fields reused across Message and useSendVertexMessage requests
     message_id: Optional[int] = Field(
@@ -148,7 +198,7 @@ class Message(SQLModel, table=True):
         Rendered in UI.
         The generated looker url LLM return for given summarized_prompt.
         """,
-        sa_column=Column(LONGTEXT)
+        sa_column=Column(LongText)
     )
     
     # Fields for SummarizeMessage only
@@ -158,7 +208,7 @@ class Message(SQLModel, table=True):
         The LLM executive summary rendered in Thread UI.
         Used when user 'message_type' is 'summarize' i.e. 'show me the data'
         """,
-        sa_column=Column(LONGTEXT)
+        sa_column=Column(LongText)
     )
 
 
@@ -175,14 +225,14 @@ class Message(SQLModel, table=True):
         From useSendVertexMessage.
         The prompt sent to LLM to generate required content for vertex related workflow.
         """,
-        sa_column=Column(LONGTEXT)
+        sa_column=Column(LongText)
     )
     raw_prompt: Optional[str] = Field(
         description="""
         From useSendVertexMessage.
         The context generated by useSendVertexMessage passed to the prompt 'contents'.
         """,
-        sa_column=Column(LONGTEXT)
+        sa_column=Column(LongText)
     )
     parameters_str: Optional[str] = Field(
         description="""
@@ -191,14 +241,25 @@ class Message(SQLModel, table=True):
         Currently only generateExploreUrl uses this with default
         max_output_tokens = 1000
         """,
-        sa_column=Column(LONGTEXT, name="param")
+        sa_column=Column(JSONText, name="param")
     )
     llm_response: Optional[str] = Field(
         description="""
         From useSendVertexMessage.
         The LLM response to the prompt from 'contents'.
         """
-        ,sa_column=Column(LONGTEXT)
+        ,sa_column=Column(LongText)
+    )
+    # set instead of contents / raw_prompt when prompt_store.PROMPT_CHUNK_STORE is on
+    contents_ref: Optional[str] = Field(
+        default=None,
+        description="Comma separated prompt_chunks hashes that make up contents",
+        sa_column=Column(Text)
+    )
+    raw_prompt_ref: Optional[str] = Field(
+        default=None,
+        description="Comma separated prompt_chunks hashes that make up raw_prompt",
+        sa_column=Column(Text)
     )
 
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -216,12 +277,7 @@ class Message(SQLModel, table=True):
     # converter for param str
     @property
     def parameters(self) -> Dict[str, Any]:
-        if not self.parameters_str:
-            return {}
-        try:
-            return json.loads(self.parameters_str)
-        except:
-            return {}
+        return memoized_json(self, "parameters_str", {})
 
     @parameters.setter
     def parameters(self, value: Dict[str, Any]):
@@ -234,6 +290,10 @@ class Message(SQLModel, table=True):
 
 class Feedback(SQLModel, table=True):
     __tablename__ = "feedbacks"
+    __table_args__ = (
+        # Message.feedback relationship
+        Index("ix_feedbacks_message_id", "message_id"),
+    )
 
     user_id: str = Field(foreign_key="users.user_id")
     feedback_id: Optional[int] = Field(default=None, primary_key=True)
@@ -245,6 +305,32 @@ class Feedback(SQLModel, table=True):
     
     message: Message = Relationship(back_populates="feedback")
 
+class PromptChunk(SQLModel, table=True):
+    """A distinct piece of a logged prompt, stored once and referenced by hash from messages"""
+    __tablename__ = "prompt_chunks"
+
+    chunk_hash: str = Field(primary_key=True, max_length=64, description="SHA-256 of the chunk text")
+    data: bytes = Field(sa_column=Column(LongBlob, nullable=False), description="zlib compressed chunk text")
+    size: int = Field(description="Length of the uncompressed chunk text")
+    last_referenced_at: datetime = Field(
+        default_factory=datetime.utcnow,
+        index=True,
+        description="When a message last stored a reference to the chunk, the sweep spares recent chunks"
+    )
+
+class LLMResponse(SQLModel, table=True):
+    """A cached Gemini response, kept so warm entries survive an instance restart"""
+    __tablename__ = "llm_responses"
+
+    cache_key: str = Field(primary_key=True, max_length=64, description="SHA-256 of the model, prompt and generation config")
+    model_name: str = Field(max_length=255)
+    prompt_type: Optional[str] = Field(default=None, max_length=255)
+    response: str = Field(sa_column=Column(LongText, nullable=False))
+    input_tokens: int = Field(default=0)
+    output_tokens: int = Field(default=0)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime = Field(index=True)
+
 # Request/Response Models
 class LoginRequest(BaseModel):
     user_id: str = Field(..., description="User ID")
@@ -269,6 +355,17 @@ class MessageRequest(BaseModel):
     prompt_type: str = Field(..., description="Type of prompt")
     raw_prompt: str = Field(..., description="Original prompt")
     parameters: Dict[str, Any] = Field(None, description="Optional parameters for the message")
+    one_shot: bool = Field(
+        False,
+        description="Without message_id: log the message, run the LLM and store its response in one request"
+        )
+
+class ExploreUrlRequest(BaseModel):
+    user_id: str = Field(..., description="User ID")
+    thread_id: int = Field(..., description="Thread ID this message is created in")
+    explore_key: Optional[str] = Field(None, description="Explore key, model:explore; must be the thread's explore_key when given")
+    prompt: str = Field(..., description="The user's (summarized) question")
+    parameters: Optional[Dict[str, Any]] = Field(None, description="Optional generation parameters")
 
 class FeedbackRequest(BaseModel):
     user_id: str = Field(..., description="User ID")
@@ -294,26 +391,46 @@ class SearchResponse(BaseModel):
     data: Dict[str, Any] 
 
 
+# largest page the thread and message listings return
+MAX_PAGE_SIZE = 200
+
 class UserThreadsRequest(BaseModel):
     user_id: str = Field(..., description="User ID")
-    limit: Optional[int] = Field(10, description="Maximum number of threads to return")
-    offset: Optional[int] = Field(0, description="Offset for pagination")    
+    limit: int = Field(10, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of threads to return")
+    offset: int = Field(0, ge=0, description="Offset for pagination")    
+    cursor: Optional[str] = Field(None, description="Keyset cursor returned as next_cursor by the previous page")
 
 class UserThreadsResponse(BaseModel):
     # list of Dict instead of List[Thread] to include custom prop prompt_list
     threads: List[Dict]
-    total_count: int
+    # None when the request sets include_total=false
+    total_count: Optional[int] = None
+    # pass back as cursor to fetch the next page; None on the last page
+    next_cursor: Optional[str] = None
 
 class ThreadMessagesRequest(BaseModel):
     thread_id: int = Field(..., description="Thread ID")
-    limit: Optional[int] = Field(50, description="Maximum number of messages to return")
-    offset: Optional[int] = Field(0, description="Offset for pagination")
+    limit: int = Field(50, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of messages to return")
+    offset: int = Field(0, ge=0, description="Offset for pagination")
+    cursor: Optional[str] = Field(None, description="Keyset cursor returned as next_cursor by the previous page")
 
 class ThreadMessagesResponse(BaseModel):
     # List of Dict instead of List[Message] to include the custom prop "parameter"
     messages: List[Dict]
-    total_count: int
+    # None when the request sets include_total=false
+    total_count: Optional[int] = None
+    # pass back as cursor to fetch the next page; None on the last page
+    next_cursor: Optional[str] = None
 
 class ThreadDeleteRequest(BaseModel):
     user_id: str = Field(..., description="User ID")
     thread_ids: List[int] = Field(..., description="List of thread IDs to mark as deleted")
+
+class ThreadPromptRequest(BaseModel):
+    user_id: str = Field(..., description="User ID, only the user's own thread is updated")
+    prompt: str = Field(..., description="Prompt to append to the thread's prompt_list")
+
+class BatchUpdateRequest(BaseModel):
+    user_id: str = Field(..., description="User ID, only the user's own messages or threads are updated")
+    ids: List[int] = Field(..., description="IDs of the messages or threads to update")
+    fields: Dict[str, Any] = Field(..., description="Fields to set on every one of them")
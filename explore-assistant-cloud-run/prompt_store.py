@@ -0,0 +1,286 @@
+# prompt_store.py
+"""
+Content-addressed, compressed storage for the logged prompt payloads.
+
+Generated prompts repeat the same blocks (the explore's dimension/measure
+listing, the example block) across thousands of messages. With
+PROMPT_CHUNK_STORE=1, the contents and raw_prompt of a message are split
+into chunks at content-defined line boundaries, so a shared block produces
+the same chunks wherever it sits in the prompt. Each distinct chunk is
+stored once, zlib compressed, in prompt_chunks under its SHA-256. The
+message keeps the ordered list of chunk hashes in <field>_ref and the
+plain column is left NULL.
+
+Reads go through load_payloads, which reassembles the text with one batched
+chunk query, and chunks are cached in memory since they never change.
+Chunks no message references anymore are swept after the deleted thread
+purge and after a compaction. A chunk referenced by a write in the last
+PROMPT_CHUNK_GRACE_SECONDS is never swept, so a message that is committed
+while the sweep scans the references keeps its chunks.
+"""
+
+import hashlib
+import logging
+import os
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+from sqlmodel import delete, insert, or_, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from cache import TTLCache, register_cache
+from models import Message, PromptChunk
+
+PROMPT_CHUNK_STORE = os.environ.get("PROMPT_CHUNK_STORE") == "1"
+PROMPT_CHUNK_CACHE_SIZE = int(os.environ.get("PROMPT_CHUNK_CACHE_SIZE", "10000"))
+# seconds after its last reference a chunk is safe from the sweep, longer than any write transaction
+PROMPT_CHUNK_GRACE_SECONDS = int(os.environ.get("PROMPT_CHUNK_GRACE_SECONDS", "3600"))
+
+# the Message columns stored as chunks, and the column holding each one's chunk list
+PAYLOAD_FIELDS = {"contents": "contents_ref", "raw_prompt": "raw_prompt_ref"}
+
+# a chunk ends after a line whose crc32 is divisible by BOUNDARY_MODULUS once it
+# holds at least MIN_CHUNK characters, and is cut at MAX_CHUNK characters regardless
+BOUNDARY_MODULUS = 8
+MIN_CHUNK = 256
+MAX_CHUNK = 8192
+COMPRESSION_LEVEL = 6
+
+# chunk_hash -> text
+chunk_cache = register_cache(TTLCache("prompt_chunks", maxsize=PROMPT_CHUNK_CACHE_SIZE, ttl=24 * 3600))
+
+
+def split_chunks(text: str) -> List[str]:
+    """Split text into chunks that join back to it exactly"""
+    chunks, current, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        current.append(line)
+        size += len(line)
+        at_boundary = size >= MIN_CHUNK and zlib.crc32(line.encode()) % BOUNDARY_MODULUS == 0
+        if at_boundary or size >= MAX_CHUNK:
+            chunks.append("".join(current))
+            current, size = [], 0
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+
+def chunk_hash(chunk: str) -> str:
+    return hashlib.sha256(chunk.encode()).hexdigest()
+
+
+async def store_text(session: AsyncSession, text: str) -> str:
+    """
+    Store the chunks of text that are not stored yet, in the session's transaction.
+    Chunks that are already stored are marked as referenced now, which keeps the
+    sweep away from them.
+
+    Returns:
+        The reference to save on the message: the comma separated chunk hashes
+    """
+    pieces = split_chunks(text)
+    hashes = [chunk_hash(piece) for piece in pieces]
+    chunks = dict(zip(hashes, pieces))
+    now = datetime.utcnow()
+
+    # always checked against the table: the chunk cache may hold chunks of a rolled back write.
+    # The locking read sees a concurrent sweep's delete and holds the sweep off until commit
+    existing = set((await session.exec(
+        select(PromptChunk.chunk_hash).where(PromptChunk.chunk_hash.in_(list(chunks))).with_for_update()
+    )).all())
+    if existing:
+        await session.exec(
+            update(PromptChunk).where(PromptChunk.chunk_hash.in_(existing)).values(last_referenced_at=now)
+        )
+    new_chunks = [
+        {
+            "chunk_hash": h,
+            "data": zlib.compress(chunk.encode(), COMPRESSION_LEVEL),
+            "size": len(chunk),
+            "last_referenced_at": now,
+        }
+        for h, chunk in chunks.items() if h not in existing
+    ]
+    if new_chunks:
+        # a concurrent writer may store the same chunk first
+        await session.exec(
+            insert(PromptChunk).prefix_with("IGNORE", dialect="mysql").prefix_with("OR IGNORE", dialect="sqlite"),
+            params=new_chunks,
+        )
+    for h, chunk in chunks.items():
+        chunk_cache.set(h, chunk)
+    return ",".join(hashes)
+
+
+async def load_texts(session: AsyncSession, refs: Iterable[str]) -> Dict[str, Optional[str]]:
+    """
+    Reassemble the text of chunk references, fetching every uncached chunk in one query.
+
+    Returns:
+        Dict of reference -> text, None for a reference with a chunk that is missing
+    """
+    refs = set(ref for ref in refs if ref)
+    chunks = {}
+    missing = set()
+    for ref in refs:
+        for h in ref.split(","):
+            chunk = chunk_cache.get(h)
+            if chunk is None:
+                missing.add(h)
+            else:
+                chunks[h] = chunk
+
+    if missing:
+        for row in await session.exec(
+            select(PromptChunk.chunk_hash, PromptChunk.data).where(PromptChunk.chunk_hash.in_(missing))
+        ):
+            chunks[row.chunk_hash] = zlib.decompress(row.data).decode()
+            chunk_cache.set(row.chunk_hash, chunks[row.chunk_hash])
+
+    texts = {}
+    for ref in refs:
+        lost = [h for h in ref.split(",") if h not in chunks]
+        if lost:
+            logging.error(f"Prompt chunks missing from prompt_chunks: {lost}")
+            texts[ref] = None
+        else:
+            texts[ref] = "".join(chunks[h] for h in ref.split(","))
+    return texts
+
+
+async def pack_values(session: AsyncSession, values: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Move the payload fields of a Message insert/update into chunk storage.
+    A payload field that is set inline or emptied also clears its reference.
+    """
+    for field, ref_field in PAYLOAD_FIELDS.items():
+        if field not in values:
+            continue
+        if PROMPT_CHUNK_STORE and values[field]:
+            values[ref_field] = await store_text(session, values[field])
+            values[field] = None
+        else:
+            values[ref_field] = None
+    return values
+
+
+async def pack_messages(session: AsyncSession, messages: Sequence[Message]) -> None:
+    """pack_values for Message instances that are about to be inserted"""
+    if not PROMPT_CHUNK_STORE:
+        return
+    for message in messages:
+        packed = await pack_values(session, {field: getattr(message, field) for field in PAYLOAD_FIELDS})
+        for key, value in packed.items():
+            setattr(message, key, value)
+
+
+async def load_payloads(session: AsyncSession, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Fill in the chunk-stored payload fields of message dicts and drop the references.
+    Rows written before the chunk store was enabled keep their plain column, and a
+    payload with a missing chunk is returned as None rather than failing the read.
+    """
+    refs = [row.get(ref_field) for row in rows for ref_field in PAYLOAD_FIELDS.values()]
+    texts = await load_texts(session, refs) if any(refs) else {}
+    for row in rows:
+        for field, ref_field in PAYLOAD_FIELDS.items():
+            ref = row.pop(ref_field, None)
+            if ref:
+                row[field] = texts[ref]
+    return rows
+
+
+async def compact_messages(session: AsyncSession, batch_size: int = 100, max_batches: Optional[int] = None) -> int:
+    """
+    Move the payloads of messages that still store them inline into chunk storage,
+    batch_size messages per transaction.
+
+    Returns:
+        The number of messages compacted
+    """
+    if not PROMPT_CHUNK_STORE:
+        return 0
+    compacted, batches = 0, 0
+    while max_batches is None or batches < max_batches:
+        rows = (await session.exec(
+            select(Message.message_id, *(getattr(Message, field) for field in [*PAYLOAD_FIELDS, *PAYLOAD_FIELDS.values()]))
+            .where(
+                ((Message.contents != None) & (Message.contents != "") & (Message.contents_ref == None))
+                | ((Message.raw_prompt != None) & (Message.raw_prompt != "") & (Message.raw_prompt_ref == None))
+            )
+            .order_by(Message.message_id)
+            .limit(batch_size)
+        )).all()
+        if not rows:
+            break
+        for row in rows:
+            # only the inline payloads, a field that is already packed keeps its reference
+            values = await pack_values(session, {
+                field: getattr(row, field) for field, ref_field in PAYLOAD_FIELDS.items()
+                if getattr(row, field) and getattr(row, ref_field) is None
+            })
+            await session.exec(update(Message).where(Message.message_id == row.message_id).values(**values))
+        await session.commit()
+        compacted += len(rows)
+        batches += 1
+    return compacted
+
+
+async def delete_unreferenced_chunks(
+        session: AsyncSession,
+        batch_size: int = 500,
+        grace_seconds: Optional[int] = None,
+        ) -> int:
+    """
+    Delete the chunks that no message references anymore, after a purge or
+    updates that replaced payloads.
+
+    The reference scan can miss messages committed while it runs, so only
+    chunks that were last referenced more than grace_seconds
+    (PROMPT_CHUNK_GRACE_SECONDS) ago are candidates, and the delete checks
+    that again. A writer that reuses a chunk marks it as referenced in its
+    own transaction, so its chunk is only at risk if that transaction stays
+    open for longer than the grace period.
+
+    Returns:
+        The number of chunks deleted
+    """
+    if grace_seconds is None:
+        grace_seconds = PROMPT_CHUNK_GRACE_SECONDS
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    unreferenced = set((await session.exec(
+        select(PromptChunk.chunk_hash).where(PromptChunk.last_referenced_at < cutoff)
+    )).all())
+    last_id = 0
+    while unreferenced:
+        rows = (await session.exec(
+            select(Message.message_id, *(getattr(Message, ref_field) for ref_field in PAYLOAD_FIELDS.values()))
+            .where(Message.message_id > last_id)
+            .where(or_(*(getattr(Message, ref_field) != None for ref_field in PAYLOAD_FIELDS.values())))
+            .order_by(Message.message_id)
+            .limit(batch_size)
+        )).all()
+        if not rows:
+            break
+        for row in rows:
+            for ref_field in PAYLOAD_FIELDS.values():
+                ref = getattr(row, ref_field)
+                if ref:
+                    unreferenced.difference_update(ref.split(","))
+        last_id = rows[-1].message_id
+
+    unreferenced = list(unreferenced)
+    deleted = 0
+    for start in range(0, len(unreferenced), batch_size):
+        hashes = unreferenced[start:start + batch_size]
+        result = await session.exec(
+            delete(PromptChunk)
+            .where(PromptChunk.chunk_hash.in_(hashes))
+            .where(PromptChunk.last_referenced_at < cutoff)
+        )
+        await session.commit()
+        deleted += result.rowcount
+        for h in hashes:
+            chunk_cache.pop(h)
+    return deleted
@@ -0,0 +1,426 @@
+# search.py
+"""
+Full-text search over the user-visible text of chat messages.
+
+On MySQL the matching and ranking is done by the FULLTEXT index created in
+migration 4. Other backends (sqlite for local testing) fall back to an
+in-memory inverted index built from the user's messages, and with
+SEARCH_INDEX_USERS set those per-user indexes are kept between searches and
+updated incrementally on writes. All paths rank threads by their best
+matching message and cut highlighted snippets for the requested page.
+"""
+
+import html
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from cache import SingleFlight, TTLCache, register_cache
+from models import Message, Thread
+
+# the text rendered in the thread view
+SEARCH_FIELDS = ("message", "summarized_prompt", "summary")
+FULLTEXT_INDEX = "ft_messages_search"
+
+# upper bound on the matched messages ranked per search
+SEARCH_MAX_HITS = int(os.environ.get("SEARCH_MAX_HITS", "1000"))
+SNIPPET_WIDTH = 80
+# users whose search index is kept in memory between searches, 0 disables
+SEARCH_INDEX_USERS = int(os.environ.get("SEARCH_INDEX_USERS", "0"))
+SEARCH_INDEX_TTL = int(os.environ.get("SEARCH_INDEX_TTL", "900"))
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(value: Optional[str]) -> List[str]:
+    return _TOKEN.findall(value.lower()) if value else []
+
+
+class InvertedIndex:
+    """
+    Term -> posting list index over small documents, ranked with TF-IDF.
+
+    A query matches every document containing at least one of its terms,
+    like MySQL's natural language mode.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[Any, int]] = defaultdict(dict)
+        self._terms: Dict[Any, Counter] = {}
+        self._lengths: Dict[Any, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def __contains__(self, doc_id: Any) -> bool:
+        return doc_id in self._terms
+
+    def add(self, doc_id: Any, value: str) -> None:
+        """Index a document, replacing its previous text"""
+        self.remove(doc_id)
+        terms = Counter(tokenize(value))
+        if not terms:
+            return
+        for term, count in terms.items():
+            self._postings[term][doc_id] = count
+        self._terms[doc_id] = terms
+        self._lengths[doc_id] = sum(terms.values())
+
+    def remove(self, doc_id: Any) -> None:
+        terms = self._terms.pop(doc_id, None)
+        if terms is None:
+            return
+        self._lengths.pop(doc_id, None)
+        for term in terms:
+            postings = self._postings[term]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self._postings[term]
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[Tuple[Any, float]]:
+        """
+        Returns:
+            List of (doc_id, score), best match first
+        """
+        scores: Dict[Any, float] = defaultdict(float)
+        total = len(self._terms)
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + total / len(postings))
+            for doc_id, count in postings.items():
+                scores[doc_id] += count / math.sqrt(self._lengths[doc_id]) * idf
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:limit] if limit else ranked
+
+
+def searchable_text(row: Any) -> str:
+    return "\n".join(getattr(row, field) or "" for field in SEARCH_FIELDS)
+
+
+def highlight(value: str, query: str, width: int = SNIPPET_WIDTH) -> Optional[str]:
+    """
+    Cut a snippet around the first query term in value, with every term
+    wrapped in <mark>. The rest of the text is HTML escaped.
+
+    Returns:
+        The snippet, or None when no query term occurs in value
+    """
+    terms = sorted(set(tokenize(query)), key=len, reverse=True)
+    if not value or not terms:
+        return None
+    pattern = re.compile(r"\b(" + "|".join(re.escape(term) for term in terms) + r")\b", re.IGNORECASE)
+    match = pattern.search(value)
+    if match is None:
+        return None
+
+    start = max(0, match.start() - width // 2)
+    end = min(len(value), start + width)
+    start = max(0, end - width)
+    fragment = value[start:end]
+
+    parts, position = [], 0
+    for term_match in pattern.finditer(fragment):
+        parts.append(html.escape(fragment[position:term_match.start()]))
+        parts.append(f"<mark>{html.escape(term_match.group(0))}</mark>")
+        position = term_match.end()
+    parts.append(html.escape(fragment[position:]))
+
+    return ("..." if start > 0 else "") + "".join(parts) + ("..." if end < len(value) else "")
+
+
+def _first_snippet(row: Any, query: str) -> Tuple[Optional[str], Optional[str]]:
+    for field in SEARCH_FIELDS:
+        snippet = highlight(getattr(row, field), query)
+        if snippet:
+            return field, snippet
+    return None, None
+
+
+class ThreadEntry(NamedTuple):
+    thread_id: int
+    explore_key: str
+    created_at: datetime
+
+
+class MessageEntry(NamedTuple):
+    message_id: int
+    thread_id: int
+    actor: str
+    type: Optional[str]
+    created_at: datetime
+    message: Optional[str]
+    summarized_prompt: Optional[str]
+    summary: Optional[str]
+
+
+def _entry(entry_type, row: Any):
+    return entry_type(*(getattr(row, field) for field in entry_type._fields))
+
+
+class UserIndex:
+    """The live threads of one user and an inverted index over their searchable messages"""
+
+    def __init__(self):
+        self.index = InvertedIndex()
+        self.threads: Dict[int, ThreadEntry] = {}
+        self.messages: Dict[int, MessageEntry] = {}
+
+    def add_thread(self, thread: Any) -> None:
+        self.threads[thread.thread_id] = _entry(ThreadEntry, thread)
+
+    def add_message(self, message: Any) -> bool:
+        """
+        Index a new or updated message.
+
+        Returns:
+            False when the message belongs to a thread this index doesn't know
+        """
+        if message.thread_id not in self.threads:
+            return False
+        entry = _entry(MessageEntry, message)
+        value = searchable_text(entry)
+        if value.strip():
+            self.messages[entry.message_id] = entry
+            self.index.add(entry.message_id, value)
+        else:
+            self.messages.pop(entry.message_id, None)
+            self.index.remove(entry.message_id)
+        return True
+
+    def remove_threads(self, thread_ids: Iterable[int]) -> None:
+        thread_ids = set(thread_ids)
+        for thread_id in thread_ids:
+            self.threads.pop(thread_id, None)
+        for message_id in [m.message_id for m in self.messages.values() if m.thread_id in thread_ids]:
+            del self.messages[message_id]
+            self.index.remove(message_id)
+
+    def hits(self, query: str) -> List[Tuple[int, int, float]]:
+        return [
+            (message_id, self.messages[message_id].thread_id, score)
+            for message_id, score in self.index.search(query, SEARCH_MAX_HITS + 1)
+        ]
+
+
+async def load_user_index(session: AsyncSession, user_id: str) -> UserIndex:
+    """Build the search index of a user from their live threads"""
+    user_index = UserIndex()
+    for thread in await session.exec(
+        select(*(getattr(Thread, field) for field in ThreadEntry._fields))
+        .where(Thread.user_id == user_id)
+        .where(Thread.is_deleted == False)
+    ):
+        user_index.add_thread(thread)
+    for message in await session.exec(
+        select(*(getattr(Message, field) for field in MessageEntry._fields))
+        .join(Thread, Thread.thread_id == Message.thread_id)
+        .where(Thread.user_id == user_id)
+        .where(Thread.is_deleted == False)
+    ):
+        user_index.add_message(message)
+    return user_index
+
+
+class SearchIndexRegistry:
+    """
+    Per-user search indexes kept in memory between searches.
+
+    A user's index is built on their first search and then updated in place
+    by the message and thread writes of this instance, so repeated searches
+    (search-as-you-type) never touch the database. Idle users are evicted
+    LRU first, and the TTL bounds how stale an index can get from writes
+    served by other instances.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.cache = register_cache(TTLCache("search_index", maxsize=maxsize, ttl=ttl)) if maxsize > 0 else None
+        self._builds = SingleFlight()
+        # users whose index is being built -> whether a write raced the build
+        self._building: Dict[str, bool] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache is not None
+
+    async def get(self, session: AsyncSession, user_id: str) -> UserIndex:
+        user_index = self.cache.get(user_id)
+        if user_index is None:
+            user_index = await self._builds.do(user_id, lambda: self._build(session, user_id))
+        return user_index
+
+    async def _build(self, session: AsyncSession, user_id: str) -> UserIndex:
+        self._building[user_id] = False
+        try:
+            user_index = await load_user_index(session, user_id)
+        finally:
+            stale = self._building.pop(user_id)
+        if not stale:
+            self.cache.set(user_id, user_index)
+        return user_index
+
+    def _loaded(self, user_id: str) -> Optional[UserIndex]:
+        if not self.enabled:
+            return None
+        if user_id in self._building:
+            self._building[user_id] = True
+        return self.cache.peek(user_id)
+
+    def add_thread(self, thread: Any) -> None:
+        user_index = self._loaded(thread.user_id)
+        if user_index is not None:
+            user_index.add_thread(thread)
+
+    def add_message(self, message: Any) -> None:
+        user_index = self._loaded(message.user_id)
+        if user_index is not None and not user_index.add_message(message):
+            self.invalidate(message.user_id)
+
+    def remove_threads(self, user_id: str, thread_ids: Iterable[int]) -> None:
+        user_index = self._loaded(user_id)
+        if user_index is not None:
+            user_index.remove_threads(thread_ids)
+
+    def invalidate(self, user_id: str) -> None:
+        if self._loaded(user_id) is not None:
+            self.cache.pop(user_id)
+
+
+search_index = SearchIndexRegistry(SEARCH_INDEX_USERS, SEARCH_INDEX_TTL)
+
+
+async def _mysql_hits(session: AsyncSession, user_id: str, query: str) -> List[Tuple[int, int, float]]:
+    columns = ", ".join(f"m.{field}" for field in SEARCH_FIELDS)
+    rows = await session.exec(
+        text(
+            f"SELECT m.message_id, m.thread_id, MATCH({columns}) AGAINST (:query IN NATURAL LANGUAGE MODE) AS score"
+            " FROM messages m JOIN threads t ON t.thread_id = m.thread_id"
+            f" WHERE t.user_id = :user_id AND t.is_deleted = 0 AND MATCH({columns}) AGAINST (:query IN NATURAL LANGUAGE MODE)"
+            " ORDER BY score DESC LIMIT :max_hits"
+        ).bindparams(query=query, user_id=user_id, max_hits=SEARCH_MAX_HITS + 1)
+    )
+    return [(row.message_id, row.thread_id, float(row.score)) for row in rows]
+
+
+async def _load_page(session: AsyncSession, page: Sequence[Tuple[int, float, List[int]]]) -> Tuple[Dict, Dict]:
+    """Load the threads and matched messages of a page, one batched query each"""
+    threads = {
+        thread.thread_id: thread
+        for thread in await session.exec(
+            select(*(getattr(Thread, field) for field in ThreadEntry._fields))
+            .where(Thread.thread_id.in_([thread_id for thread_id, _, _ in page]))
+        )
+    }
+    messages = {
+        message.message_id: message
+        for message in await session.exec(
+            select(*(getattr(Message, field) for field in MessageEntry._fields))
+            .where(Message.message_id.in_([message_id for _, _, matched in page for message_id in matched]))
+        )
+    }
+    return threads, messages
+
+
+def rank_threads(hits: Iterable[Tuple[int, int, float]]) -> List[Tuple[int, float, List[int]]]:
+    """
+    Group message hits by thread, ranking each thread by its best message.
+
+    Returns:
+        List of (thread_id, score, matched message_ids), best thread first
+    """
+    by_thread: Dict[int, List[Tuple[int, float]]] = defaultdict(list)
+    for message_id, thread_id, score in hits:
+        by_thread[thread_id].append((message_id, score))
+
+    ranked = [
+        (thread_id, max(score for _, score in messages), [message_id for message_id, _ in messages])
+        for thread_id, messages in by_thread.items()
+    ]
+    # ties go to the newer thread
+    ranked.sort(key=lambda item: (item[1], item[0]), reverse=True)
+    return ranked
+
+
+def format_matches(
+        query: str,
+        hits: Sequence[Tuple[int, int, float]],
+        page: Sequence[Tuple[int, float, List[int]]],
+        threads: Mapping[int, Any],
+        messages: Mapping[int, Any],
+        ) -> List[Dict[str, Any]]:
+    scores = {message_id: score for message_id, _, score in hits}
+    matches = []
+    for thread_id, score, matched in page:
+        thread = threads[thread_id]
+        thread_messages = []
+        for message_id in matched:
+            message = messages[message_id]
+            field, snippet = _first_snippet(message, query)
+            thread_messages.append({
+                "message_id": message_id,
+                "actor": message.actor,
+                "type": message.type,
+                "field": field,
+                "snippet": snippet,
+                "timestamp": message.created_at.isoformat(),
+                "score": round(scores[message_id], 4),
+            })
+        matches.append({
+            "thread_id": thread_id,
+            "explore_key": thread.explore_key,
+            "created_at": thread.created_at.isoformat(),
+            "score": round(score, 4),
+            "messages": sorted(thread_messages, key=lambda message: message["score"], reverse=True),
+        })
+    return matches
+
+
+async def search_messages(session: AsyncSession, user_id: str, query: str, limit: int = 10, offset: int = 0) -> Dict[str, Any]:
+    """
+    Search the user's live threads for messages matching query.
+
+    Only the best SEARCH_MAX_HITS messages are ranked; truncated is set when
+    more messages matched, and total then counts only the threads of those.
+
+    Returns:
+        Dict with the number of matching threads as total, whether the hits
+        were truncated, and the requested page of matches, best first, each
+        with its matched messages
+    """
+    if not tokenize(query):
+        return {"total": 0, "truncated": False, "matches": []}
+
+    if search_index.enabled:
+        user_index = await search_index.get(session, user_id)
+    elif session.bind.dialect.name != "mysql":
+        user_index = await load_user_index(session, user_id)
+    else:
+        user_index = None
+
+    # one hit past the cap tells whether there were more
+    hits = user_index.hits(query) if user_index is not None else await _mysql_hits(session, user_id, query)
+    truncated = len(hits) > SEARCH_MAX_HITS
+    hits = hits[:SEARCH_MAX_HITS]
+    ranked = rank_threads(hits)
+    page = ranked[offset:offset + limit]
+    if not page:
+        return {"total": len(ranked), "truncated": truncated, "matches": []}
+
+    if user_index is not None:
+        threads, messages = user_index.threads, user_index.messages
+    else:
+        threads, messages = await _load_page(session, page)
+    return {
+        "total": len(ranked),
+        "truncated": truncated,
+        "matches": format_matches(query, hits, page, threads, messages),
+    }
@@ -0,0 +1,276 @@
+# semantic_cache.py
+"""
+Semantic cache of generated explore URLs.
+
+Users ask near-identical questions of the same explore ("top 10 brands by
+sales", "top ten brands by revenue"), and every one of them pays a full
+generateExploreUrl call with the explore's whole field listing in the prompt.
+With SEMANTIC_CACHE_EXPLORES set, the summarized question (raw_prompt) of
+every generated URL is embedded locally and a new question whose cosine
+similarity to a cached one reaches SEMANTIC_CACHE_THRESHOLD is answered
+with the cached URL.
+
+Questions are embedded as TF-IDF weighted character n-grams, hashed into
+SEMANTIC_CACHE_DIM buckets, so one explore's questions form a single
+float32 NumPy matrix and a lookup is one matrix-vector product on the CPU.
+An explore's index is loaded from its logged generateExploreUrl messages on
+first use and then updated by this instance. URLs of chat messages that got
+negative feedback are never served from the cache, and neither is the URL
+of a question whose numbers differ from the new one. Number words up to
+ninety-nine count as their digits, so "top ten" matches "top 10"; larger
+ones ("a hundred", "a dozen") are only compared as text.
+"""
+
+import os
+import re
+import zlib
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import prompt_store
+from cache import SingleFlight, TTLCache, register_cache
+from database import async_engine
+from models import Feedback, Message, Thread
+
+EXPLORE_URL_PROMPT_TYPE = "generateExploreUrl"
+
+# explores whose index is kept in memory, 0 disables the cache
+SEMANTIC_CACHE_EXPLORES = int(os.environ.get("SEMANTIC_CACHE_EXPLORES", "0"))
+SEMANTIC_CACHE_TTL = int(os.environ.get("SEMANTIC_CACHE_TTL", "3600"))
+# minimum cosine similarity for a cached URL to be served
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+# questions kept per explore, the oldest are replaced first
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", "1000"))
+SEMANTIC_CACHE_DIM = int(os.environ.get("SEMANTIC_CACHE_DIM", "2048"))
+
+NGRAM_SIZES = (3, 4, 5)
+
+_WHITESPACE = re.compile(r"\s+")
+_TOGGLE = re.compile(r"&toggle=[^&]*")
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+_UNITS = [
+    "zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten",
+    "eleven", "twelve", "thirteen", "fourteen", "fifteen", "sixteen", "seventeen", "eighteen", "nineteen",
+]
+_TENS = ["twenty", "thirty", "forty", "fifty", "sixty", "seventy", "eighty", "ninety"]
+_NUMBER_WORD = re.compile(
+    rf"\b(?:({'|'.join(_TENS)})(?:[\s-]+({'|'.join(_UNITS[1:10])}))?|({'|'.join(_UNITS)}))\b"
+)
+
+
+def _number_value(match: re.Match) -> str:
+    tens, unit, single = match.groups()
+    if single:
+        return str(_UNITS.index(single))
+    return str(20 + 10 * _TENS.index(tens) + (_UNITS.index(unit) if unit else 0))
+
+
+def normalize(text: str) -> str:
+    """Lower case text with single spaces and number words replaced by digits"""
+    return _NUMBER_WORD.sub(_number_value, _WHITESPACE.sub(" ", text.lower()).strip())
+
+
+def embed(text: str, dim: int = SEMANTIC_CACHE_DIM) -> np.ndarray:
+    """Term frequencies of the character n-grams of text, hashed into dim buckets"""
+    text = f" {normalize(text)} "
+    vector = np.zeros(dim, dtype=np.float32)
+    for size in NGRAM_SIZES:
+        for start in range(len(text) - size + 1):
+            vector[zlib.crc32(text[start:start + size].encode()) % dim] += 1
+    # sublinear tf, so a repeated word doesn't dominate the question
+    return np.log1p(vector, out=vector)
+
+
+def numbers(text: str) -> FrozenSet[str]:
+    """The numbers in a question, which must match exactly: "top 5" is not "top 10", 2023 is not 2024"""
+    return frozenset(_NUMBER.findall(normalize(text)))
+
+
+def url_key(url: Optional[str]) -> str:
+    """The generated query arguments of an LLM response or a saved explore_url, as the extension cleans them"""
+    if not url:
+        return ""
+    if "fields=" in url:
+        url = url[url.index("fields="):]
+    return _TOGGLE.sub("", url.strip().strip("`").strip())
+
+
+class ExploreIndex:
+    """
+    The cached questions of one explore and their URLs.
+
+    Rows of the tf matrix are filled in order and wrap around once
+    capacity is reached. Document frequencies are kept per bucket, so IDF
+    weights are computed at query time from the questions currently held.
+    """
+
+    def __init__(self, capacity: int = SEMANTIC_CACHE_SIZE, dim: int = SEMANTIC_CACHE_DIM):
+        self.capacity = capacity
+        self.dim = dim
+        self.tf = np.zeros((0, dim), dtype=np.float32)
+        self.df = np.zeros(dim, dtype=np.float32)
+        self.prompts: List[str] = []
+        self.numbers: List[FrozenSet[str]] = []
+        self.urls: List[str] = []
+        self.excluded: Set[str] = set()
+        self._next = 0
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def add(self, prompt: str, url: str) -> None:
+        if not prompt or not url_key(url) or url_key(url) in self.excluded:
+            return
+        vector = embed(prompt, self.dim)
+        if len(self.urls) < self.capacity:
+            # grow by doubling rather than reallocating per question
+            if len(self.urls) == self.tf.shape[0]:
+                grown = np.zeros((min(max(2 * self.tf.shape[0], 16), self.capacity), self.dim), dtype=np.float32)
+                grown[:len(self.urls)] = self.tf
+                self.tf = grown
+            row = len(self.urls)
+            self.prompts.append(prompt)
+            self.numbers.append(numbers(prompt))
+            self.urls.append(url)
+        else:
+            row = self._next
+            self.df -= self.tf[row] > 0
+            self.prompts[row], self.numbers[row], self.urls[row] = prompt, numbers(prompt), url
+            self._next = (row + 1) % self.capacity
+        self.tf[row] = vector
+        self.df += vector > 0
+
+    def exclude(self, url: str) -> int:
+        """Drop every question answered with url and never cache it again"""
+        key = url_key(url)
+        if not key:
+            return 0
+        self.excluded.add(key)
+        keep = [row for row, cached in enumerate(self.urls) if url_key(cached) != key]
+        removed = len(self.urls) - len(keep)
+        if removed:
+            self.tf = self.tf[keep].copy()
+            self.df = (self.tf > 0).sum(axis=0).astype(np.float32)
+            self.prompts = [self.prompts[row] for row in keep]
+            self.numbers = [self.numbers[row] for row in keep]
+            self.urls = [self.urls[row] for row in keep]
+            self._next = 0
+        return removed
+
+    def search(self, prompt: str) -> Optional[Tuple[str, float]]:
+        """The URL of the most similar cached question and its cosine similarity"""
+        count = len(self.urls)
+        if not count or not prompt:
+            return None
+        idf = np.log((1 + count) / (1 + self.df)) + 1
+        query = embed(prompt, self.dim) * idf
+        query_norm = np.linalg.norm(query)
+        if not query_norm:
+            return None
+        weighted = self.tf[:count] * idf
+        norms = np.linalg.norm(weighted, axis=1)
+        norms[norms == 0] = 1
+        similarities = weighted @ query / (norms * query_norm)
+        query_numbers = numbers(prompt)
+        similarities[[row for row in range(count) if self.numbers[row] != query_numbers]] = -1
+        best = int(np.argmax(similarities))
+        if similarities[best] < 0:
+            return None
+        return self.urls[best], float(similarities[best])
+
+
+async def load_explore_index(session: AsyncSession, explore_key: str) -> ExploreIndex:
+    """Build the index of an explore from its most recent generated URLs"""
+    index = ExploreIndex()
+    for url in await session.exec(
+        select(Message.explore_url)
+        .join(Feedback, Feedback.message_id == Message.message_id)
+        .join(Thread, Thread.thread_id == Message.thread_id)
+        .where(Thread.explore_key == explore_key)
+        .where(Feedback.is_positive == False)
+    ):
+        if url_key(url):
+            index.excluded.add(url_key(url))
+
+    rows = [row._asdict() for row in await session.exec(
+        select(Message.raw_prompt, Message.raw_prompt_ref, Message.llm_response)
+        .join(Thread, Thread.thread_id == Message.thread_id)
+        .where(Thread.explore_key == explore_key)
+        .where(Message.prompt_type == EXPLORE_URL_PROMPT_TYPE)
+        .where(Message.llm_response != None)
+        .order_by(Message.message_id.desc())
+        .limit(index.capacity)
+    )]
+    await prompt_store.load_payloads(session, rows)
+    for row in reversed(rows):
+        index.add(row["raw_prompt"], row["llm_response"])
+    return index
+
+
+class SemanticCache:
+    """
+    Per-explore question indexes kept in memory, evicted LRU first once
+    maxsize explores are loaded. The TTL bounds how long URLs generated and
+    feedback given on other instances go unseen. An index is loaded with a
+    session of its own, since the requests waiting on the load share it.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, threshold: float):
+        self.cache = register_cache(TTLCache("semantic_explore_urls", maxsize=maxsize, ttl=ttl)) if maxsize > 0 else None
+        self.threshold = threshold
+        self._builds = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache is not None
+
+    async def get(self, explore_key: str) -> ExploreIndex:
+        index = self.cache.get(explore_key)
+        if index is None:
+            index = await self._builds.do(explore_key, lambda: self._build(explore_key))
+        return index
+
+    async def _build(self, explore_key: str) -> ExploreIndex:
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            index = await load_explore_index(session, explore_key)
+        self.cache.set(explore_key, index)
+        return index
+
+    async def lookup(self, explore_key: str, prompt: str) -> Optional[str]:
+        """The cached URL of a question similar enough to prompt, if any"""
+        match = (await self.get(explore_key)).search(prompt)
+        if match is None or match[1] < self.threshold:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return match[0]
+
+    def add(self, explore_key: str, prompt: str, url: str) -> None:
+        index = self.cache.peek(explore_key) if self.enabled else None
+        if index is not None:
+            index.add(prompt, url)
+
+    def exclude(self, explore_key: str, url: str) -> None:
+        index = self.cache.peek(explore_key) if self.enabled else None
+        if index is not None:
+            index.exclude(url)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "explores": len(self.cache) if self.enabled else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_EXPLORES, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD)
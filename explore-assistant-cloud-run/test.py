@@ -1,12 +1,38 @@
+import asyncio
+import json
+import time
 import pytest
-from unittest.mock import patch
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
 from fastapi.testclient import TestClient
-from pydantic import BaseModel, Field
+from looker_sdk.sdk.api40.models import User as LookerUser
+from pydantic import BaseModel, Field, ValidationError
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import delete, func, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import Optional, Dict, Any, List
 from enum import Enum
 
 # import the fastapi main code here
 from main import app
+import helper_functions
+import llm_cache
+import main
+import database
+import migrations
+import models
+import prompt_store
+import search
+import semantic_cache
+from cache import SingleFlight, TTLCache
+from database import create_db_and_tables, get_async_session
+from models import Feedback, Message, PromptChunk, Thread, User, UserThreadsRequest
+from semantic_cache import ExploreIndex
+from write_behind import WriteBehindBuffer
 
 client = TestClient(app)
 
@@ -666,4 +692,1131 @@ def test_search_chats(payload, token, expected_status, expected_response):
         )
 
         assert response.status_code == expected_status
-        assert response.json() == expected_response
\ No newline at end of file
+        assert response.json() == expected_response
+
+
+def test_generate_response_does_not_block_event_loop(monkeypatch):
+    """Concurrent generations should be in flight together, bounded by the semaphore"""
+    in_flight = 0
+    peak = 0
+
+    async def fake_generate_content_async(contents, generation_config):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        response = MagicMock()
+        response.text = f"response to {contents}"
+        return response
+
+    monkeypatch.setattr(helper_functions, "llm_semaphore", asyncio.Semaphore(2))
+
+    async def run():
+        return await asyncio.gather(
+            *(helper_functions.generate_response(f"prompt {i}") for i in range(4))
+        )
+
+    with patch.object(helper_functions.model, "generate_content_async", side_effect=fake_generate_content_async):
+        responses = asyncio.run(run())
+
+    assert responses == [f"response to prompt {i}" for i in range(4)]
+    assert peak == 2
+
+def test_validate_bearer_token_is_cached_and_coalesced():
+    """Repeated and concurrent validations of one token should make a single tokeninfo call"""
+    tokeninfo = MagicMock(status_code=200)
+    tokeninfo.json.return_value = {
+        "azp": helper_functions.OAUTH_CLIENT_ID,
+        "exp": str(int(time.time()) + 3600),
+    }
+
+    async def fake_get(url, params):
+        await asyncio.sleep(0.01)
+        return tokeninfo
+
+    async def run():
+        concurrent = await asyncio.gather(
+            *(helper_functions.validate_bearer_token("cached_token") for _ in range(5))
+        )
+        repeated = await helper_functions.validate_bearer_token("cached_token")
+        return concurrent, repeated
+
+    helper_functions.token_cache.clear()
+    with patch.object(helper_functions.http_client, "get", side_effect=fake_get) as mock_get:
+        concurrent, repeated = asyncio.run(run())
+
+    assert all(concurrent) and repeated
+    assert mock_get.call_count == 1
+
+def test_validate_bearer_token_verifies_id_token_locally():
+    """In jwt mode, Google-style ID tokens are verified against the cached JWKS without tokeninfo"""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public_jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    public_jwk.update({"kid": "test-key", "alg": "RS256", "use": "sig"})
+    helper_functions.jwks_cache.load({"keys": [public_jwk]})
+
+    def make_token(**overrides):
+        now = int(time.time())
+        claims = {
+            "iss": "https://accounts.google.com",
+            "aud": helper_functions.OAUTH_CLIENT_ID,
+            "azp": helper_functions.OAUTH_CLIENT_ID,
+            "iat": now,
+            "exp": now + 3600,
+            **overrides,
+        }
+        return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": "test-key"})
+
+    helper_functions.token_cache.clear()
+    with \
+        patch.object(helper_functions, "TOKEN_VALIDATION_MODE", "jwt"), \
+        patch.object(helper_functions.http_client, "get") as mock_get:
+
+        assert asyncio.run(helper_functions.validate_bearer_token(make_token()))
+        assert not asyncio.run(helper_functions.validate_bearer_token(make_token(azp="other-client")))
+        assert not asyncio.run(helper_functions.validate_bearer_token(make_token(exp=int(time.time()) - 60)))
+        assert not asyncio.run(helper_functions.validate_bearer_token(make_token(iss="https://evil.example.com")))
+
+        mock_get.assert_not_called()
+
+def test_verify_looker_user_uses_group_cache():
+    """Prefetched group members and previously seen users should not hit the Looker API again"""
+    helper_functions.looker_user_cache.clear()
+    with \
+        patch.object(helper_functions, "RESTRICT_GROUP_ACCESS", True), \
+        patch.object(helper_functions, "RESTRICT_GROUP_ID", "25"), \
+        patch.object(helper_functions.sdk, "all_group_users") as mock_all_group_users, \
+        patch.object(helper_functions.sdk, "user") as mock_user:
+
+        mock_all_group_users.return_value = [
+            LookerUser(id="1", group_ids=["25"]),
+            LookerUser(id="2", group_ids=["1", "25"]),
+        ]
+        mock_user.return_value = LookerUser(id="3", group_ids=["25"])
+
+        async def run():
+            prefetched = await helper_functions.prefetch_group_members()
+            results = [
+                await helper_functions.verify_looker_user("1"),
+                await helper_functions.verify_looker_user("2"),
+                await helper_functions.verify_looker_user("3"),
+                await helper_functions.verify_looker_user("3"),
+            ]
+            return prefetched, results
+
+        prefetched, results = asyncio.run(run())
+
+    assert prefetched == 2
+    assert all(results)
+    mock_user.assert_called_once()
+
+@pytest.fixture
+def sqlite_session(tmp_path):
+    """Factory for async sessions on a fresh aiosqlite database with all tables created"""
+    test_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+    asyncio.run(create_db_and_tables(test_engine))
+    yield lambda: AsyncSession(test_engine, expire_on_commit=False)
+    asyncio.run(test_engine.dispose())
+
+@pytest.fixture
+def seeded_thread(sqlite_session):
+    """User "1" with one thread on model:explore in the sqlite database; returns the thread_id"""
+    async def seed():
+        async with sqlite_session() as session:
+            await helper_functions.create_new_user(session, "1", "Test User", "test@example.com")
+            return await helper_functions.create_chat_thread(session, "1", "model:explore")
+
+    return asyncio.run(seed())
+
+@pytest.fixture
+def client_with_sqlite(sqlite_session):
+    """The test client with request sessions on the sqlite database and every bearer token accepted"""
+    async def override_session():
+        async with sqlite_session() as session:
+            yield session
+
+    app.dependency_overrides[get_async_session] = override_session
+    try:
+        with patch('main.validate_bearer_token', return_value=True):
+            yield client
+    finally:
+        app.dependency_overrides.pop(get_async_session)
+
+async def load_message(sqlite_session, message_id):
+    async with sqlite_session() as session:
+        return (await session.exec(select(Message).where(Message.message_id == message_id))).one()
+
+def test_async_db_helpers_with_aiosqlite(sqlite_session, seeded_thread):
+    """The async DB helpers should run end to end against a local aiosqlite database, sharing one session"""
+    async def run():
+        async with sqlite_session() as session:
+            message_id = await helper_functions.add_message(
+                session,
+                user_id="1",
+                thread_id=seeded_thread,
+                actor="user",
+                contents="show me sales",
+                prompt_type="chatMessage",
+                raw_prompt="show me sales",
+                parameters={"max_output_tokens": 1000},
+            )
+            await helper_functions._update_message(session, message_id=message_id, type="text", message="show me sales")
+            threads, thread_count, _ = await helper_functions._get_user_threads(session, "1")
+            messages, message_count, _ = await helper_functions._get_thread_messages(session, seeded_thread)
+        return threads, thread_count, messages, message_count
+
+    threads, thread_count, messages, message_count = asyncio.run(run())
+
+    assert thread_count == 1 and threads[0]["explore_key"] == "model:explore"
+    assert message_count == 1
+    assert messages[0]["message"] == "show me sales"
+    assert messages[0]["parameters"] == {"max_output_tokens": 1000}
+
+def test_thread_listing_keyset_pagination(sqlite_session, seeded_thread):
+    """Following next_cursor should walk every thread exactly once, newest first"""
+    async def run():
+        async with sqlite_session() as session:
+            created = [seeded_thread] + [
+                await helper_functions.create_chat_thread(session, "1", f"model:explore_{i}") for i in range(6)
+            ]
+
+            pages, cursor = [], None
+            while True:
+                threads, total_count, cursor = await helper_functions._get_user_threads(
+                    session, "1", limit=3, cursor=cursor, include_total=False
+                )
+                assert total_count is None
+                pages.append([thread["thread_id"] for thread in threads])
+                if not cursor:
+                    return created, pages
+
+    created, pages = asyncio.run(run())
+
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [thread_id for page in pages for thread_id in page] == sorted(created, reverse=True)
+
+@pytest.mark.parametrize("path", ["/user/thread?user_id=1", "/thread/1/messages"])
+@pytest.mark.parametrize("limit", ["0", "201", "null", "-1"])
+def test_listing_limit_is_bounded(path, limit):
+    """A missing, non-positive or oversized page size is rejected before it reaches the query"""
+    with patch('main.validate_bearer_token', return_value=True):
+        response = client.get(f"{path}{'&' if '?' in path else '?'}limit={limit}", headers={"Authorization": "Bearer valid_token"})
+
+    assert response.status_code == 422
+    with pytest.raises(ValidationError):
+        UserThreadsRequest(user_id="1", limit=None)
+
+def test_thread_messages_leave_out_heavy_columns(sqlite_session, seeded_thread):
+    """Message listings should only carry the LONGTEXT payloads that are asked for through include"""
+    async def run():
+        async with sqlite_session() as session:
+            await helper_functions.add_message(
+                session,
+                user_id="1",
+                thread_id=seeded_thread,
+                actor="user",
+                message="show me sales",
+                contents="x" * 10000,
+                raw_prompt="full prompt",
+                llm_response="full response",
+                prompt_type="chatMessage",
+                parameters={"max_output_tokens": 1000},
+            )
+            default, _, _ = await helper_functions._get_thread_messages(session, seeded_thread)
+            opted_in, _, _ = await helper_functions._get_thread_messages(session, seeded_thread, include=["llm_response"])
+            return default[0], opted_in[0]
+
+    default, opted_in = asyncio.run(run())
+
+    assert default["message"] == "show me sales"
+    assert default["parameters"] == {"max_output_tokens": 1000}
+    assert not {"contents", "raw_prompt", "llm_response"} & default.keys()
+    assert opted_in["llm_response"] == "full response"
+    assert "contents" not in opted_in
+
+    with pytest.raises(ValueError):
+        helper_functions._message_fields(["password"])
+
+@pytest.mark.parametrize(
+    "token, expected_status",
+    [
+        ("admin_token", 200),
+        ("valid_token", 403),
+    ]
+)
+def test_pool_stats_endpoint(token, expected_status):
+    with patch('main.ADMIN_TOKEN', "admin_token"):
+        response = client.get(
+            "/admin/db/pool",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+
+    assert response.status_code == expected_status
+    if expected_status == 200:
+        data = response.json()["data"]
+        assert {"checked_out", "overflow", "wait_time_avg_ms", "connect_time_avg_ms", "invalidations"} <= data.keys()
+
+def test_pool_wait_time_leaves_out_connect_time(tmp_path, monkeypatch):
+    """Waiting for the only pooled connection counts as wait time, opening it only as connect time"""
+    metrics = database.PoolMetrics()
+    monkeypatch.setattr(database, "pool_metrics", metrics)
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", poolclass=database.InstrumentedAsyncPool, pool_size=1, max_overflow=0
+    )
+    database.instrument_pool(engine)
+    # a slow connect
+    event.listen(engine.sync_engine, "do_connect", lambda *args: time.sleep(0.05))
+
+    async def use_connection(delay, hold):
+        await asyncio.sleep(delay)
+        async with engine.connect() as conn:
+            await conn.exec_driver_sql("SELECT 1")
+            await asyncio.sleep(hold)
+
+    async def run():
+        await asyncio.gather(use_connection(0, 0.1), use_connection(0.01, 0))
+        await engine.dispose()
+
+    asyncio.run(run())
+
+    assert (metrics.checkouts, metrics.connects) == (2, 1)
+    assert metrics.connect_time_max >= 0.05
+    # only the second checkout waited, the first one's connect isn't wait time
+    assert metrics.wait_time_max >= 0.08
+    assert metrics.wait_time_total - metrics.wait_time_max < 0.01
+
+def test_migrations_create_and_check_indexes(tmp_path):
+    """Migrations should be idempotent and the index check should report dropped indexes"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+
+    applied = migrations.upgrade(engine)
+    assert [m.version for m in applied] == [m.version for m in migrations.MIGRATIONS]
+    assert migrations.missing_indexes(engine) == []
+    assert migrations.upgrade(engine) == []
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ix_messages_thread_id_prompt_type_created_at")
+
+    missing = migrations.missing_indexes(engine)
+    assert len(missing) == 1 and "ix_messages_thread_id_prompt_type_created_at" in missing[0]
+
+def test_counters_are_maintained_and_reconciled(sqlite_session, seeded_thread):
+    """Thread and message totals come from maintained counters, prompt_type updates and
+    write-behind inserts keep them in step, and reconciliation fixes drift"""
+    async def run():
+        async with sqlite_session() as session:
+            thread_ids = [seeded_thread] + [await helper_functions.create_chat_thread(session, "1", "model:explore") for _ in range(2)]
+            message_ids = [
+                await helper_functions.add_message(
+                    session, user_id="1", thread_id=thread_ids[0], actor="user",
+                    contents="c", prompt_type=prompt_type, raw_prompt="r",
+                )
+                for prompt_type in ["chatMessage", "chatMessage", "summarizePrompts"]
+            ]
+            await helper_functions.soft_delete_specific_threads(session, "1", [thread_ids[2]])
+
+            _, thread_total, _ = await helper_functions._get_user_threads(session, "1")
+            _, message_total, _ = await helper_functions._get_thread_messages(session, thread_ids[0])
+
+            await helper_functions._update_messages(session, message_ids[:2], {"prompt_type": "generateExploreUrl"})
+            await helper_functions._update_message(session, message_id=message_ids[2], prompt_type="chatMessage")
+            message_log = WriteBehindBuffer(sqlite_session, Message, prepare=helper_functions.prepare_logged_messages)
+            for prompt_type in ["chatMessage", "chatMessage", "generateExploreUrl"]:
+                await message_log.put(helper_functions.new_message(user_id="1", thread_id=thread_ids[1], actor="system", prompt_type=prompt_type))
+            await message_log.close()
+            session.expunge_all()
+            counts = (await session.exec(select(Thread.chat_message_count).order_by(Thread.thread_id))).all()
+
+            # simulate drift, then reconcile
+            await session.exec(update(User).values(active_thread_count=42))
+            await session.commit()
+            fixed = await helper_functions.reconcile_counters(session)
+            _, reconciled_total, _ = await helper_functions._get_user_threads(session, "1")
+        return thread_total, message_total, counts, fixed, reconciled_total
+
+    thread_total, message_total, counts, fixed, reconciled_total = asyncio.run(run())
+
+    assert thread_total == 2
+    assert message_total == 2
+    assert counts == [1, 2, 0]
+    assert fixed == {"users": 1, "threads": 0}
+    assert reconciled_total == 2
+
+def test_search_thread_history_ranks_and_highlights(sqlite_session, seeded_thread, monkeypatch):
+    """Search should rank threads by relevance, highlight matches, skip deleted threads and flag capped hits"""
+    async def run():
+        async with sqlite_session() as session:
+            thread_ids = [seeded_thread] + [await helper_functions.create_chat_thread(session, "1", "model:explore") for _ in range(2)]
+            texts = [
+                "show me total sales by region",
+                "sales sales: compare monthly sales for the <west> region",
+                "sales in the deleted thread",
+            ]
+            for thread_id, text in zip(thread_ids, texts):
+                await helper_functions.add_message(
+                    session, user_id="1", thread_id=thread_id, actor="user", type="text",
+                    message=text, contents="sales " * 100, prompt_type="chatMessage",
+                )
+            await helper_functions.soft_delete_specific_threads(session, "1", [thread_ids[2]])
+
+            results = await helper_functions.search_thread_history(session, "1", "Sales")
+            empty = await helper_functions.search_thread_history(session, "1", "inventory")
+            monkeypatch.setattr(search, "SEARCH_MAX_HITS", 1)
+            capped = await helper_functions.search_thread_history(session, "1", "Sales")
+            return thread_ids, results, empty, capped
+
+    thread_ids, results, empty, capped = asyncio.run(run())
+
+    assert results["total"] == 2 and not results["truncated"]
+    assert capped["total"] == 1 and capped["truncated"]
+    assert [match["thread_id"] for match in results["matches"]] == [thread_ids[1], thread_ids[0]]
+    snippet = results["matches"][0]["messages"][0]["snippet"]
+    assert "<mark>sales</mark>" in snippet and "&lt;west&gt;" in snippet
+    assert results["matches"][0]["messages"][0]["field"] == "message"
+    assert empty == {"total": 0, "truncated": False, "matches": []}
+
+def test_search_index_is_kept_and_updated_in_memory(sqlite_session, seeded_thread, monkeypatch):
+    """With the per-user index enabled, repeat searches skip the database and see this instance's writes"""
+    registry = search.SearchIndexRegistry(maxsize=2, ttl=60)
+    monkeypatch.setattr(search, "search_index", registry)
+    monkeypatch.setattr(helper_functions, "search_index", registry)
+
+    async def run():
+        async with sqlite_session() as session:
+            await helper_functions.add_message(session, user_id="1", thread_id=seeded_thread, actor="user", message="sales by region")
+
+            assert (await search.search_messages(session, "1", "sales"))["total"] == 1
+
+            # written after the index was built, applied incrementally
+            second = await helper_functions.create_chat_thread(session, "1", "model:explore")
+            message_id = await helper_functions.add_message(session, user_id="1", thread_id=second, actor="user", message="orders")
+            await helper_functions._update_message(session, message_id=message_id, message="orders and sales")
+            await helper_functions.soft_delete_specific_threads(session, "1", [seeded_thread])
+
+        # no session: the warm index answers on its own
+        return second, await search.search_messages(None, "1", "sales")
+
+    second, results = asyncio.run(run())
+
+    assert results["total"] == 1
+    assert results["matches"][0]["thread_id"] == second
+    assert results["matches"][0]["messages"][0]["snippet"] == "orders and <mark>sales</mark>"
+    assert registry.cache.stats()["misses"] == 1
+
+def test_thread_snapshot_is_batched_cached_and_invalidated(sqlite_session, seeded_thread, monkeypatch):
+    """A snapshot loads in a fixed number of queries, is cached, and a feedback write drops the cached copy"""
+    monkeypatch.setattr(helper_functions, "thread_snapshot_cache", TTLCache("thread_snapshots", ttl=60))
+
+    async def run():
+        async with sqlite_session() as session:
+            message_ids = []
+            for text in ["first", "second", "third"]:
+                message_ids.append(await helper_functions.add_message(
+                    session, user_id="1", thread_id=seeded_thread, actor="user", type="text",
+                    message=text, prompt_type="chatMessage", contents="x" * 1000,
+                ))
+            # logging rows are not part of the visible thread
+            await helper_functions.add_message(session, user_id="1", thread_id=seeded_thread, actor="system", prompt_type="generateExploreUrl")
+            await helper_functions.add_feedback(session, user_id="1", message_id=message_ids[0], feedback_text="good", is_positive=True)
+
+            statements = []
+            event.listen(session.bind.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+            first = json.loads(await helper_functions.get_thread_snapshot(session, seeded_thread))
+            cached = json.loads(await helper_functions.get_thread_snapshot(session, seeded_thread))
+            queries = len(statements)
+
+            await helper_functions.add_feedback(session, user_id="1", message_id=message_ids[1], feedback_text="bad", is_positive=False)
+            refreshed = json.loads(await helper_functions.get_thread_snapshot(session, seeded_thread))
+            missing = await helper_functions.get_thread_snapshot(session, seeded_thread + 1)
+            return first, cached, queries, refreshed, missing
+
+    first, cached, queries, refreshed, missing = asyncio.run(run())
+
+    assert queries == 3
+    assert first == cached
+    assert first["thread"]["thread_id"] == seeded_thread
+    assert [m["message"] for m in first["messages"]] == ["first", "second", "third"]
+    assert "contents" not in first["messages"][0]
+    assert first["messages"][0]["feedback"]["feedback_text"] == "good"
+    assert first["messages"][1]["feedback"] is None
+    assert refreshed["messages"][1]["feedback"]["is_positive"] is False
+    assert missing is None
+
+def test_soft_delete_and_chunked_purge(sqlite_session, seeded_thread):
+    """Soft delete counts only live threads; the purge removes expired threads with their messages and feedback in chunks"""
+    async def run():
+        async with sqlite_session() as session:
+            thread_ids = [seeded_thread] + [await helper_functions.create_chat_thread(session, "1", "model:explore") for _ in range(2)]
+            for thread_id in thread_ids:
+                for _ in range(5):
+                    message_id = await helper_functions.add_message(session, user_id="1", thread_id=thread_id, actor="user", prompt_type="chatMessage")
+                    await helper_functions.add_feedback(session, user_id="1", message_id=message_id, feedback_text="ok", is_positive=True)
+
+            deleted = await helper_functions.soft_delete_specific_threads(session, "1", thread_ids[:2])
+            deleted_again = await helper_functions.soft_delete_specific_threads(session, "1", thread_ids[:2])
+
+            # only the first deleted thread is past retention
+            await session.exec(
+                update(Thread).where(Thread.thread_id == thread_ids[0]).values(deleted_at=datetime.utcnow() - timedelta(days=31))
+            )
+            await session.commit()
+            purged = await helper_functions.purge_deleted_threads(session, retention_days=30, batch_size=2)
+
+            remaining_threads = (await session.exec(select(Thread.thread_id).order_by(Thread.thread_id))).all()
+            remaining_messages = (await session.exec(select(func.count()).select_from(Message))).one()
+            remaining_feedbacks = (await session.exec(select(func.count()).select_from(Feedback))).one()
+            return thread_ids, deleted, deleted_again, purged, remaining_threads, remaining_messages, remaining_feedbacks
+
+    thread_ids, deleted, deleted_again, purged, remaining_threads, remaining_messages, remaining_feedbacks = asyncio.run(run())
+
+    assert deleted["affected_count"] == 2
+    assert deleted_again["affected_count"] == 0
+    assert purged == {"threads": 1, "messages": 5, "feedbacks": 5, "chunks": 0}
+    assert remaining_threads == thread_ids[1:]
+    assert (remaining_messages, remaining_feedbacks) == (10, 10)
+
+def test_one_shot_message_round_trip(sqlite_session, seeded_thread, client_with_sqlite):
+    """one_shot logs the message, runs the LLM and stores the response in a single request"""
+    with patch('main.generate_response', return_value="fields=orders.count") as mock_generate_response:
+        response = client_with_sqlite.post(
+            "/message",
+            json={
+                "user_id": "1",
+                "thread_id": seeded_thread,
+                "actor": "system",
+                "contents": "prompt",
+                "prompt_type": "generateExploreUrl",
+                "raw_prompt": "show me orders",
+                "parameters": {"max_output_tokens": 1000},
+                "one_shot": True,
+            },
+            headers={"Authorization": "Bearer valid_token"}
+        )
+
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert data["response"] == "fields=orders.count"
+    mock_generate_response.assert_called_once()
+    assert mock_generate_response.call_args.args == ("prompt", {"max_output_tokens": 1000})
+    message = asyncio.run(load_message(sqlite_session, data["message_id"]))
+    assert (message.raw_prompt, message.llm_response) == ("show me orders", "fields=orders.count")
+
+def test_partial_and_batch_updates(sqlite_session, seeded_thread):
+    """Updates are a single UPDATE returning the set fields, and batch variants touch many rows at once"""
+    async def run():
+        async with sqlite_session() as session:
+            thread_ids = [seeded_thread, await helper_functions.create_chat_thread(session, "1", "model:explore")]
+            message_ids = [
+                await helper_functions.add_message(session, user_id="1", thread_id=seeded_thread, actor="user")
+                for _ in range(3)
+            ]
+
+            statements = []
+            event.listen(session.bind.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+            updated = await helper_functions._update_message(
+                session, message_id=message_ids[0], summarized_prompt="orders by month", parameters={"top_k": 1}
+            )
+            update_statements = list(statements)
+
+            batch_count = await helper_functions._update_messages(session, message_ids[1:], {"type": "explore"})
+            thread = await helper_functions._update_thread(session, thread_id=seeded_thread, prompt_list=["a", "b"])
+            threads_count = await helper_functions._update_threads(session, thread_ids, {"model_name": "model"})
+
+            with pytest.raises(helper_functions.DatabaseError):
+                await helper_functions._update_message(session, message_id=999, type="text")
+            with pytest.raises(ValueError):
+                await helper_functions._update_thread(session, thread_id=seeded_thread, not_a_column=1)
+
+            session.expunge_all()
+            message = await session.get(Message, message_ids[0])
+            types = (await session.exec(select(Message.type).where(Message.message_id.in_(message_ids[1:])))).all()
+            stored_thread = await session.get(Thread, seeded_thread)
+            return updated, update_statements, batch_count, thread, threads_count, message, types, stored_thread
+
+    updated, update_statements, batch_count, thread, threads_count, message, types, stored_thread = asyncio.run(run())
+
+    assert len(update_statements) == 1 and update_statements[0].startswith("UPDATE messages")
+    assert updated["summarized_prompt"] == "orders by month"
+    assert message.summarized_prompt == "orders by month" and message.parameters == {"top_k": 1}
+    assert batch_count == 2 and types == ["explore", "explore"]
+    assert thread == {"thread_id": stored_thread.thread_id, "prompt_list": ["a", "b"]}
+    assert stored_thread.prompt_list == ["a", "b"] and stored_thread.model_name == "model"
+    assert threads_count == 2
+
+def test_updates_only_touch_updatable_fields_of_the_users_rows(sqlite_session, seeded_thread, client_with_sqlite):
+    """Protected fields are rejected with a 400, another user's ids are left alone and is_deleted goes through the soft delete"""
+    async def seed():
+        async with sqlite_session() as session:
+            await helper_functions.create_new_user(session, "2", "Test User", "2@example.com")
+            thread_ids = [seeded_thread, await helper_functions.create_chat_thread(session, "2", "model:explore")]
+            message_ids = [
+                await helper_functions.add_message(session, user_id=user_id, thread_id=thread_id, actor="user")
+                for user_id, thread_id in zip(("1", "2"), thread_ids)
+            ]
+            return thread_ids, message_ids
+
+    thread_ids, message_ids = asyncio.run(seed())
+
+    headers = {"Authorization": "Bearer valid_token"}
+    rejected = [
+        client_with_sqlite.put("/threads/update", json={"user_id": "1", "ids": thread_ids, "fields": {"user_id": "1"}}, headers=headers),
+        client_with_sqlite.put("/messages/update", json={"user_id": "1", "ids": message_ids, "fields": {"thread_id": thread_ids[0]}}, headers=headers),
+        client_with_sqlite.put("/thread/update", json={"thread_id": thread_ids[0], "user_id": "1", "created_at": "2020-01-01"}, headers=headers),
+        client_with_sqlite.put("/message/update", json={"message_id": message_ids[0], "is_deleted": True}, headers=headers),
+        client_with_sqlite.put("/threads/update", json={"ids": thread_ids, "fields": {"model_name": "m"}}, headers=headers),
+    ]
+    threads = client_with_sqlite.put("/threads/update", json={"user_id": "1", "ids": thread_ids, "fields": {"model_name": "m"}}, headers=headers)
+    messages = client_with_sqlite.put("/messages/update", json={"user_id": "1", "ids": message_ids, "fields": {"summary": "s"}}, headers=headers)
+    other_thread = client_with_sqlite.put("/thread/update", json={"thread_id": thread_ids[1], "user_id": "1", "model_name": "m"}, headers=headers)
+    deleted = client_with_sqlite.put("/threads/update", json={"user_id": "1", "ids": thread_ids, "fields": {"is_deleted": True}}, headers=headers)
+
+    async def read():
+        async with sqlite_session() as session:
+            stored_threads = (await session.exec(select(Thread).order_by(Thread.thread_id))).all()
+            summaries = (await session.exec(select(Message.summary).order_by(Message.message_id))).all()
+            users = (await session.exec(select(User).order_by(User.user_id))).all()
+            return stored_threads, summaries, users
+
+    stored_threads, summaries, users = asyncio.run(read())
+
+    assert [response.status_code for response in rejected] == [400, 400, 400, 400, 422]
+    assert threads.json()["data"]["updated_count"] == 1 and messages.json()["data"]["updated_count"] == 1
+    assert other_thread.status_code == 500
+    assert deleted.json()["data"]["updated_count"] == 1
+    assert [thread.model_name for thread in stored_threads] == ["m", None]
+    assert [thread.is_deleted for thread in stored_threads] == [True, False]
+    assert summaries == ["s", None]
+    assert [user.active_thread_count for user in users] == [0, 1]
+
+def test_write_behind_buffer_batches_and_flushes_on_close(sqlite_session, seeded_thread):
+    """Queued log rows are inserted in batches, the queue applies backpressure and close() flushes the rest"""
+    async def run():
+        buffer = WriteBehindBuffer(sqlite_session, Message, max_rows=2, batch_size=2, flush_interval=0.05)
+        rows = [
+            helper_functions.new_message(
+                user_id="1", thread_id=seeded_thread, actor="system", prompt_type="generateExploreUrl",
+                contents=f"prompt {i}", llm_response=f"response {i}", parameters={"max_output_tokens": 1000},
+            )
+            for i in range(5)
+        ]
+
+        # not started yet: the third row has to wait for room in the queue
+        await buffer.put(rows[0])
+        await buffer.put(rows[1])
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(buffer.put(rows[2]), 0.05)
+
+        buffer.start()
+        for row in rows[2:]:
+            await buffer.put(row)
+        await buffer.close()
+
+        async with sqlite_session() as session:
+            stored = (await session.exec(select(Message).order_by(Message.message_id))).all()
+        return buffer.stats(), stored
+
+    stats, stored = asyncio.run(run())
+
+    assert [message.contents for message in stored] == [f"prompt {i}" for i in range(5)]
+    assert stored[0].parameters == {"max_output_tokens": 1000}
+    assert stats["flushed"] == 5 and stats["dropped"] == 0 and stats["queued"] == 0
+    assert stats["batches"] <= 3
+
+def test_write_behind_buffer_retries_failed_batches_and_reports_flushes(sqlite_session, seeded_thread, monkeypatch):
+    """A failed batch is retried from the queued rows, then inserted row by row, and committed rows are reported"""
+    monkeypatch.setattr(prompt_store, "PROMPT_CHUNK_STORE", True)
+    failures = ["flaky"]
+    flushed = []
+
+    async def prepare(session, messages):
+        await helper_functions.prepare_logged_messages(session, messages)
+        # fails after the payloads were packed
+        if failures:
+            raise RuntimeError(failures.pop())
+        if any(message.actor == "bad" for message in messages):
+            raise RuntimeError("bad row")
+
+    async def run():
+        buffer = WriteBehindBuffer(
+            sqlite_session, Message, batch_size=2, prepare=prepare,
+            on_flushed=lambda messages: flushed.append([message.contents for message in messages]), retry_delay=0,
+        )
+        for i, actor in enumerate(["system", "system", "bad", "system"]):
+            await buffer.put(helper_functions.new_message(
+                user_id="1", thread_id=seeded_thread, actor=actor, prompt_type="chatMessage", contents=f"prompt {i}",
+            ))
+        await buffer.close()
+
+        async with sqlite_session() as session:
+            stored, _, _ = await helper_functions._get_thread_messages(session, seeded_thread, include=["contents"])
+            count = (await session.exec(select(Thread.chat_message_count).where(Thread.thread_id == seeded_thread))).one()
+        return buffer.stats(), stored, count
+
+    stats, stored, count = asyncio.run(run())
+
+    assert sorted(message["contents"] for message in stored) == ["prompt 0", "prompt 1", "prompt 3"]
+    assert count == 3
+    assert flushed == [["prompt 0", "prompt 1"], ["prompt 3"]]
+    assert (stats["flushed"], stats["retries"], stats["dropped"]) == (3, 4, 1)
+
+def test_prompt_chunk_store_dedupes_and_reassembles(sqlite_session, seeded_thread, monkeypatch):
+    """Shared prompt blocks are stored once, compressed, and listings return the original text"""
+    fields = "".join(f"order_items.field_{i} - dimension - description of field {i}\n" for i in range(300))
+    prompts = [f"Question: {question}\n\nFields:\n{fields}\nExamples: none\n" for question in ["sales by month", "top brands", "inline"]]
+
+    async def run():
+        async with sqlite_session() as session:
+            # written before the store was turned on
+            inline_id = await helper_functions.add_message(
+                session, user_id="1", thread_id=seeded_thread, actor="system", prompt_type="chatMessage", contents=prompts[2]
+            )
+
+            monkeypatch.setattr(prompt_store, "PROMPT_CHUNK_STORE", True)
+            for prompt in prompts[:2]:
+                await helper_functions.add_message(
+                    session, user_id="1", thread_id=seeded_thread, actor="system", prompt_type="chatMessage",
+                    contents=prompt, raw_prompt=prompt,
+                )
+            compacted = await prompt_store.compact_messages(session, batch_size=10)
+
+            stored = (await session.exec(select(Message.contents, Message.contents_ref))).all()
+            chunk_count = (await session.exec(select(func.count()).select_from(PromptChunk))).one()
+            stored_bytes = (await session.exec(select(func.sum(func.length(PromptChunk.data))))).one()
+
+            monkeypatch.setattr(prompt_store, "chunk_cache", TTLCache("prompt_chunks"))
+            messages, _, _ = await helper_functions._get_thread_messages(session, seeded_thread, include=["contents", "raw_prompt"])
+            return inline_id, compacted, stored, chunk_count, stored_bytes, messages
+
+    inline_id, compacted, stored, chunk_count, stored_bytes, messages = asyncio.run(run())
+
+    assert compacted == 1
+    assert all(contents is None and ref for contents, ref in stored)
+    assert stored_bytes < len(fields)
+    # the field listing is shared, so far fewer chunks than three full prompts would need
+    assert chunk_count < 3 * len(prompt_store.split_chunks(prompts[0])) - 5
+    by_id = {message["message_id"]: message for message in messages}
+    assert by_id[inline_id]["contents"] == prompts[2]
+    assert sorted(message["contents"] for message in messages) == sorted(prompts)
+    assert "contents_ref" not in messages[0]
+
+def test_compaction_keeps_packed_refs_and_purge_deletes_orphaned_chunks(sqlite_session, seeded_thread, monkeypatch):
+    """Compaction only packs inline payloads, the purge deletes the chunks only purged messages referenced,
+    recently referenced chunks are spared and a missing chunk doesn't fail the read"""
+    shared = "".join(f"order_items.field_{i} - dimension\n" for i in range(100))
+    kept_prompt, purged_prompt = (f"{shared}Question: {question}\n" * 3 for question in ("kept", "purged"))
+
+    async def run():
+        async with sqlite_session() as session:
+            purged_thread = await helper_functions.create_chat_thread(session, "1", "model:explore")
+
+            monkeypatch.setattr(prompt_store, "PROMPT_CHUNK_STORE", True)
+            kept_id = await helper_functions.add_message(
+                session, user_id="1", thread_id=seeded_thread, actor="system", prompt_type="chatMessage",
+                contents=kept_prompt, raw_prompt=kept_prompt,
+            )
+            await helper_functions.add_message(
+                session, user_id="1", thread_id=purged_thread, actor="system", prompt_type="chatMessage",
+                contents=purged_prompt, raw_prompt=purged_prompt,
+            )
+            # contents rewritten inline while the store was off, raw_prompt stays packed
+            monkeypatch.setattr(prompt_store, "PROMPT_CHUNK_STORE", False)
+            await helper_functions._update_message(session, message_id=kept_id, contents=kept_prompt)
+            monkeypatch.setattr(prompt_store, "PROMPT_CHUNK_STORE", True)
+            compacted = await prompt_store.compact_messages(session)
+            packed = (await session.exec(
+                select(Message.contents, Message.contents_ref, Message.raw_prompt_ref).where(Message.message_id == kept_id)
+            )).one()
+
+            chunks_before = set((await session.exec(select(PromptChunk.chunk_hash))).all())
+            # past the grace period
+            referenced_long_ago = datetime.utcnow() - timedelta(hours=2)
+            await session.exec(update(PromptChunk).values(last_referenced_at=referenced_long_ago))
+            await helper_functions.soft_delete_specific_threads(session, "1", [purged_thread])
+            await session.exec(update(Thread).values(deleted_at=datetime.utcnow() - timedelta(days=31)))
+            await session.commit()
+            purged = await helper_functions.purge_deleted_threads(session, retention_days=30)
+            chunks_after = set((await session.exec(select(PromptChunk.chunk_hash))).all())
+
+            # an old chunk reused by a write whose message isn't committed yet
+            orphan_ref = await prompt_store.store_text(session, "an orphaned payload\n")
+            await session.exec(update(PromptChunk).where(PromptChunk.chunk_hash == orphan_ref).values(last_referenced_at=referenced_long_ago))
+            await session.commit()
+            await prompt_store.store_text(session, "an orphaned payload\n")
+            await session.commit()
+            spared = await prompt_store.delete_unreferenced_chunks(session)
+            swept = await prompt_store.delete_unreferenced_chunks(session, grace_seconds=0)
+
+            monkeypatch.setattr(prompt_store, "chunk_cache", TTLCache("prompt_chunks"))
+            messages, _, _ = await helper_functions._get_thread_messages(session, seeded_thread, include=["contents", "raw_prompt"])
+
+            await session.exec(delete(PromptChunk).where(PromptChunk.chunk_hash == packed.contents_ref.split(",")[0]))
+            await session.commit()
+            monkeypatch.setattr(prompt_store, "chunk_cache", TTLCache("prompt_chunks"))
+            damaged, _, _ = await helper_functions._get_thread_messages(session, seeded_thread, include=["contents"])
+            return compacted, packed, chunks_before, purged, chunks_after, (spared, swept), messages, damaged
+
+    compacted, packed, chunks_before, purged, chunks_after, (spared, swept), messages, damaged = asyncio.run(run())
+
+    assert compacted == 1
+    assert packed.contents is None and packed.contents_ref and packed.raw_prompt_ref
+    assert purged["messages"] == 1 and purged["chunks"] == len(chunks_before - chunks_after) > 0
+    assert chunks_after == set(packed.contents_ref.split(",")) | set(packed.raw_prompt_ref.split(","))
+    assert (spared, swept) == (0, 1)
+    assert messages[0]["contents"] == kept_prompt and messages[0]["raw_prompt"] == kept_prompt
+    assert damaged[0]["message_id"] == messages[0]["message_id"] and damaged[0]["contents"] is None
+
+def test_json_columns_parse_once_and_append_in_the_database(sqlite_session, seeded_thread, client_with_sqlite, monkeypatch):
+    """JSON columns are parsed once per value, and appending a prompt is a single UPDATE of the user's own thread
+    without reading the list back"""
+    parsed = []
+    real_loads = models.json.loads
+    monkeypatch.setattr(models.json, "loads", lambda value: parsed.append(value) or real_loads(value))
+
+    async def run():
+        async with sqlite_session() as session:
+            thread = await session.get(Thread, seeded_thread)
+            thread.prompt_list = ["first"]
+            session.add(thread)
+            await session.commit()
+
+            appended = await helper_functions.append_thread_prompt(session, "1", seeded_thread, 'second "quoted"')
+            missing = await helper_functions.append_thread_prompt(session, "1", seeded_thread + 1, "none")
+            not_owned = await helper_functions.append_thread_prompt(session, "2", seeded_thread, "none")
+            stored = (await session.exec(select(Thread.prompt_list_str).where(Thread.thread_id == seeded_thread))).one()
+            await session.refresh(thread)
+            return thread, appended, missing, not_owned, stored
+
+    thread, appended, missing, not_owned, stored = asyncio.run(run())
+    responses = [
+        client_with_sqlite.post(f"/thread/{seeded_thread}/prompts", json=payload, headers={"Authorization": "Bearer valid_token"})
+        for payload in [{"user_id": "2", "prompt": "none"}, {"prompt": "none"}]
+    ]
+
+    assert (appended, missing, not_owned) == (1, 0, 0)
+    assert [response.status_code for response in responses] == [404, 422]
+    assert json.loads(stored) == ["first", 'second "quoted"']
+    parsed.clear()
+    assert thread.prompt_list == ["first", 'second "quoted"']
+    assert thread.prompt_list is thread.prompt_list
+    assert len(parsed) == 1
+    # assigning serializes and the next read parses the new value
+    thread.prompt_list = ["replaced"]
+    assert thread.prompt_list_str == '["replaced"]'
+    assert thread.prompt_list == ["replaced"]
+
+def test_llm_response_cache_hits_memory_then_database(sqlite_session, monkeypatch):
+    """Once opted in, repeated prompts are answered from memory, then from llm_responses, unless bypassed or their TTL is 0"""
+    calls = []
+
+    class FakeModel:
+        async def generate_content_async(self, contents, generation_config):
+            calls.append(contents)
+            usage = SimpleNamespace(prompt_token_count=100, candidates_token_count=20)
+            return SimpleNamespace(text=f"answer {len(calls)}", _raw_response=SimpleNamespace(usage_metadata=usage))
+
+    monkeypatch.setattr(helper_functions, "model", FakeModel())
+    monkeypatch.setattr(llm_cache, "response_cache", TTLCache("llm_responses", ttl=3600))
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_PERSIST", True)
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_TTL", 3600)
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_PROMPT_TTLS", {**llm_cache.DEFAULT_PROMPT_TTLS, "summarizePrompts": 0})
+    monkeypatch.setattr(llm_cache, "saved_input_tokens", 0)
+
+    async def run():
+        async with sqlite_session() as session:
+            generate = helper_functions.generate_response
+            first = await generate("Summarize  this\n", None, prompt_type="chatMessage", session=session)
+            # same prompt up to whitespace
+            second = await generate("Summarize this", None, prompt_type="chatMessage", session=session)
+            other_config = await generate("Summarize this", {"temperature": 0.9}, prompt_type="chatMessage", session=session)
+            bypassed = await generate("Summarize this", None, prompt_type="chatMessage", use_cache=False, session=session)
+            uncached = [await generate("Title", None, prompt_type="summarizePrompts", session=session) for _ in range(2)]
+            # generated URLs are not cached by default
+            uncached += [await generate("Top brands", None, prompt_type="generateExploreUrl", session=session) for _ in range(2)]
+
+            # a new instance only has the database tier
+            llm_cache.response_cache.clear()
+            restored = await generate("Summarize this", None, prompt_type="chatMessage", session=session)
+            return first, second, other_config, bypassed, uncached, restored
+
+    first, second, other_config, bypassed, uncached, restored = asyncio.run(run())
+
+    assert first == second == "answer 1"
+    assert other_config == "answer 2"
+    assert bypassed == "answer 3"
+    assert uncached == ["answer 4", "answer 5", "answer 6", "answer 7"]
+    # the bypassed call refreshed the cached response
+    assert restored == "answer 3"
+    assert len(calls) == 7
+    stats = llm_cache.stats()
+    assert stats["persistent_hits"] == 1
+    assert stats["saved_input_tokens"] == 200
+
+def test_message_endpoint_honours_llm_cache_bypass_header(seeded_thread, client_with_sqlite):
+    """The X-LLM-Cache: bypass header turns the response cache off for that request only"""
+    payload = {
+        "user_id": "1", "thread_id": seeded_thread, "actor": "user", "prompt_type": "chatMessage",
+        "contents": "hi", "raw_prompt": "hi", "one_shot": True,
+    }
+    headers = {"Authorization": "Bearer valid_token"}
+    with patch('main.generate_response', return_value="ok") as mock_generate_response:
+        responses = [
+            client_with_sqlite.post("/message", json=payload, headers=headers),
+            client_with_sqlite.post("/message", json=payload, headers={**headers, "X-LLM-Cache": "bypass"}),
+        ]
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert [call.kwargs["use_cache"] for call in mock_generate_response.call_args_list] == [True, False]
+    assert mock_generate_response.call_args.kwargs["prompt_type"] == "chatMessage"
+
+def test_semantic_cache_serves_similar_explore_questions(sqlite_session, seeded_thread, monkeypatch):
+    """Similar questions on the same explore get the cached URL, unless the numbers differ or the URL was rejected"""
+    cache = semantic_cache.SemanticCache(maxsize=10, ttl=3600, threshold=0.65)
+    monkeypatch.setattr(helper_functions, "semantic_cache", cache)
+    # indexes are loaded with a session of their own
+    monkeypatch.setattr(semantic_cache, "async_engine", sqlite_session().bind)
+
+    async def run():
+        async with sqlite_session() as session:
+            other_thread_id = await helper_functions.create_chat_thread(session, "1", "model:other")
+            for prompt, url in [
+                ("top 10 brands by sales", "fields=products.brand,orders.total_sales&limit=10"),
+                ("orders per month in 2023", "fields=orders.created_month,orders.count"),
+            ]:
+                await helper_functions.add_message(
+                    session, user_id="1", thread_id=seeded_thread, actor="system", prompt_type="generateExploreUrl",
+                    contents="big prompt", raw_prompt=prompt, llm_response=url,
+                )
+            # the user rejected the monthly orders URL
+            rated_id = await helper_functions.add_message(
+                session, user_id="1", thread_id=seeded_thread, actor="user", prompt_type="chatMessage",
+                explore_url="fields=orders.created_month,orders.count&toggle=dat,pik,vis",
+            )
+
+            lookup = helper_functions.lookup_explore_url
+            lookups = {
+                "similar": await lookup(session, seeded_thread, "Top 10 brands by total sales"),
+                "number words": await lookup(session, seeded_thread, "top ten brands by sales"),
+                "different": await lookup(session, seeded_thread, "average order value by state"),
+                "other numbers": await lookup(session, seeded_thread, "orders per month in 2024"),
+                "other explore": await lookup(session, other_thread_id, "top 10 brands by sales"),
+                "bypassed": await lookup(session, seeded_thread, "top 10 brands by sales", use_cache=False),
+                "before feedback": await lookup(session, seeded_thread, "orders per month in 2023"),
+            }
+            await helper_functions.add_feedback(
+                session, user_id="1", message_id=rated_id, feedback_text="wrong", is_positive=False,
+            )
+            lookups["after feedback"] = await lookup(session, seeded_thread, "orders per month in 2023")
+
+            # a reloaded index leaves the rejected URL out too
+            cache.cache.clear()
+            lookups["reloaded"] = await lookup(session, seeded_thread, "orders per month in 2023")
+            return lookups
+
+    lookups = asyncio.run(run())
+
+    assert lookups["similar"] == ("model:explore", "fields=products.brand,orders.total_sales&limit=10")
+    assert lookups["number words"] == lookups["similar"]
+    assert lookups["different"] == ("model:explore", None)
+    assert lookups["other numbers"] == ("model:explore", None)
+    assert lookups["other explore"] == ("model:other", None)
+    assert lookups["bypassed"] == ("model:explore", None)
+    assert lookups["before feedback"] == ("model:explore", "fields=orders.created_month,orders.count")
+    assert lookups["after feedback"] == ("model:explore", None)
+    assert lookups["reloaded"] == ("model:explore", None)
+    assert cache.stats()["hits"] == 3
+
+def test_explore_index_wraps_around_at_capacity():
+    """Past capacity the oldest question is replaced and the document frequencies follow"""
+    index = ExploreIndex(capacity=2, dim=256)
+    for i, prompt in enumerate(["count of users", "revenue by country", "average basket size"]):
+        index.add(prompt, f"fields=url_{i}")
+
+    assert len(index) == 2
+    assert index.search("average basket size") == ("fields=url_2", pytest.approx(1.0))
+    assert index.search("count of users")[0] != "fields=url_0"
+    assert (index.df == (index.tf > 0).sum(axis=0)).all()
+
+def test_single_flight_shares_results_failures_and_cancellation():
+    """Concurrent callers of a key share one call, its result or failure, and an abandoned call is cancelled"""
+    async def run():
+        flights = SingleFlight(cancel_abandoned=True)
+        started = []
+        release = asyncio.Event()
+
+        async def work(value):
+            started.append(value)
+            await release.wait()
+            if isinstance(value, Exception):
+                raise value
+            return value
+
+        # concurrent callers share one call, and one of them giving up doesn't cancel it
+        waiters = [asyncio.ensure_future(flights.do("a", lambda: work("result"))) for _ in range(3)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        release.clear()
+
+        failures = [asyncio.ensure_future(flights.do("b", lambda: work(ValueError("boom")))) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        errors = await asyncio.gather(*failures, return_exceptions=True)
+        release.clear()
+
+        # once every caller is gone the call is cancelled and the next caller starts over
+        abandoned = asyncio.ensure_future(flights.do("c", lambda: work("stale")))
+        await asyncio.sleep(0)
+        abandoned.cancel()
+        await asyncio.sleep(0)
+        fresh = asyncio.ensure_future(flights.do("c", lambda: work("fresh")))
+        await asyncio.sleep(0)
+        release.set()
+        return results, errors, await fresh, started, flights.stats()
+
+    results, errors, fresh, started, stats = asyncio.run(run())
+
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert results[1:] == ["result", "result"]
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert fresh == "fresh"
+    assert started.count("result") == 1 and "stale" in started
+    assert stats == {"in_flight": 0, "calls": 4, "shared": 3, "failed": 1, "abandoned": 1}
+
+def test_identical_generations_share_one_model_call(monkeypatch):
+    """Concurrent identical prompts share one model call, and a cache bypass always gets its own"""
+    calls = []
+
+    class SlowModel:
+        async def generate_content_async(self, contents, generation_config):
+            calls.append(contents)
+            await asyncio.sleep(0.05)
+            usage = SimpleNamespace(prompt_token_count=10, candidates_token_count=2)
+            return SimpleNamespace(text=f"answer to {contents}", _raw_response=SimpleNamespace(usage_metadata=usage))
+
+    monkeypatch.setattr(helper_functions, "model", SlowModel())
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_TTL", 0)
+
+    async def run():
+        return await asyncio.gather(
+            helper_functions.generate_response("same prompt"),
+            helper_functions.generate_response("same prompt"),
+            helper_functions.generate_response("same prompt", {"temperature": 0.9}),
+            helper_functions.generate_response("same prompt", use_cache=False),
+        )
+
+    responses = asyncio.run(run())
+
+    assert responses == ["answer to same prompt"] * 4
+    assert calls == ["same prompt"] * 3
+
+def test_message_stream_relays_chunks_and_stores_the_response(sqlite_session, seeded_thread, client_with_sqlite, monkeypatch):
+    """Chunks are relayed as SSE events, the semaphore is released before the client has read them all,
+    and the response is stored through the stream's own session"""
+    class StreamingModel:
+        async def generate_content_async(self, contents, generation_config, stream=False):
+            assert stream
+
+            async def chunks():
+                for i, text in enumerate(["The explore ", "covers ", "orders."]):
+                    usage = SimpleNamespace(prompt_token_count=50, candidates_token_count=i + 1)
+                    yield SimpleNamespace(text=text, _raw_response=SimpleNamespace(usage_metadata=usage))
+            return chunks()
+
+    monkeypatch.setattr(helper_functions, "model", StreamingModel())
+    monkeypatch.setattr(helper_functions, "llm_semaphore", asyncio.Semaphore(1))
+    monkeypatch.setattr(llm_cache, "LLM_CACHE_TTL", 0)
+    monkeypatch.setattr(main, "async_engine", sqlite_session().bind)
+
+    async def read_slowly():
+        stream = helper_functions.generate_response_stream("summarize the explore", use_cache=False)
+        first = await stream.__anext__()
+        await asyncio.sleep(0.01)
+        released = not helper_functions.llm_semaphore.locked()
+        return [first] + [text async for text in stream], released
+
+    texts, released = asyncio.run(read_slowly())
+    assert texts == ["The explore ", "covers ", "orders."] and released
+
+    response = client_with_sqlite.post(
+        "/message/stream",
+        json={
+            "user_id": "1",
+            "thread_id": seeded_thread,
+            "actor": "system",
+            "contents": "summarize the explore",
+            "prompt_type": "summarizeExplore",
+            "raw_prompt": "",
+        },
+        headers={"Authorization": "Bearer valid_token"}
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [
+        (block.split("\n")[0].removeprefix("event: "), json.loads(block.split("\n")[1].removeprefix("data: ")))
+        for block in response.text.strip().split("\n\n")
+    ]
+    assert events[:3] == [("chunk", {"text": "The explore "}), ("chunk", {"text": "covers "}), ("chunk", {"text": "orders."})]
+    assert events[3][0] == "done"
+    assert events[3][1]["response"] == "The explore covers orders."
+    assert asyncio.run(load_message(sqlite_session, events[3][1]["message_id"])).llm_response == "The explore covers orders."
+
+def test_explore_url_prompt_is_assembled_on_the_server(sqlite_session, seeded_thread, client_with_sqlite, monkeypatch):
+    """The prompt is built for the thread's explore, and a mismatched or malformed explore_key is a 400"""
+    loads = []
+
+    def load_fields(model_name, explore_name):
+        loads.append((model_name, explore_name))
+        return (
+            [
+                SimpleNamespace(name="products.brand", type="string", label="Brand", description=None, tags=[], hidden=False),
+                SimpleNamespace(name="orders.secret", type="string", label="Secret", description=None, tags=[], hidden=True),
+            ],
+            [SimpleNamespace(name="orders.total_sales", type="sum", label="Total Sales", description="Revenue", tags=["money"], hidden=False)],
+        )
+
+    builder = main.explore_prompt_builder
+    monkeypatch.setattr(builder, "load_fields", load_fields)
+    monkeypatch.setattr(builder, "load_examples", lambda explore_key: [{"input": "sales by brand", "output": "fields=products.brand,orders.total_sales"}])
+    builder.cache.clear()
+
+    async def seed():
+        async with sqlite_session() as session:
+            return await helper_functions.create_chat_thread(session, "1", "explore")
+
+    malformed_thread_id = asyncio.run(seed())
+
+    payloads = [
+        {"user_id": "1", "thread_id": seeded_thread, "explore_key": "model:explore", "prompt": "top brands by sales"},
+        # the explore_key defaults to the thread's
+        {"user_id": "1", "thread_id": seeded_thread, "prompt": "sales per brand"},
+        {"user_id": "1", "thread_id": seeded_thread, "explore_key": "model:other_explore", "prompt": "top brands by sales"},
+        {"user_id": "1", "thread_id": malformed_thread_id, "prompt": "top brands by sales"},
+        {"user_id": "2", "thread_id": seeded_thread, "prompt": "top brands by sales"},
+    ]
+    try:
+        with patch('main.generate_response', return_value="fields=products.brand,orders.total_sales") as mock_generate_response:
+            responses = [
+                client_with_sqlite.post("/message/explore_url", json=payload, headers={"Authorization": "Bearer valid_token"})
+                for payload in payloads
+            ]
+    finally:
+        builder.cache.clear()
+
+    assert [response.status_code for response in responses] == [200, 200, 400, 400, 404]
+    assert mock_generate_response.call_count == 2
+    # the prefix is built once and shared
+    assert loads == [("model", "explore")]
+    contents, parameters = mock_generate_response.call_args_list[0].args
+    assert parameters == {"max_output_tokens": 1000}
+    assert "name: products.brand, type: string, label: Brand" in contents
+    assert "name: orders.total_sales, type: sum, label: Total Sales, description: Revenue, tags: money" in contents
+    assert "orders.secret" not in contents
+    assert 'input: "sales by brand" ; output: fields=products.brand,orders.total_sales' in contents
+    assert contents.rstrip().endswith("top brands by sales\n\nOutput\n----------")
+    assert mock_generate_response.call_args.kwargs["prompt_type"] == "generateExploreUrl"
+    message = asyncio.run(load_message(sqlite_session, responses[0].json()["data"]["message_id"]))
+    assert (message.raw_prompt, message.prompt_type, message.contents) == ("top brands by sales", "generateExploreUrl", contents)
@@ -0,0 +1,151 @@
+# write_behind.py
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlmodel import SQLModel, insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+# queued by close() so the flush loop drains what is ahead of it and stops
+_STOP = object()
+
+
+class WriteBehindBuffer:
+    """
+    Queue of rows that are inserted in the background instead of on the request path.
+
+    Rows are collected until batch_size rows are queued or flush_interval
+    seconds have passed since the first one, then written with one multi-row
+    INSERT. The queue holds at most max_rows rows: once it is full, put()
+    waits for the next flush (backpressure) rather than growing without bound.
+    close() flushes everything still queued.
+
+    A batch that fails to insert is retried up to max_retries times, with a
+    doubling delay, and then inserted row by row, so only the rows that can't
+    be inserted at all are logged and counted as dropped. prepare, when
+    given, runs on a copy of each batch in the flush session right before the
+    INSERT, and on_flushed gets the rows of every batch once it is committed.
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable[[], AsyncSession],
+        model: type,
+        max_rows: int = 10000,
+        batch_size: int = 200,
+        flush_interval: float = 1.0,
+        prepare: Optional[Callable[[AsyncSession, List[SQLModel]], Awaitable[None]]] = None,
+        on_flushed: Optional[Callable[[List[SQLModel]], None]] = None,
+        max_retries: int = 3,
+        retry_delay: float = 0.5,
+    ):
+        self.session_factory = session_factory
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.prepare = prepare
+        self.on_flushed = on_flushed
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_rows)
+        self._task: Optional[asyncio.Task] = None
+        # autoincrement keys are left to the database
+        self._exclude = {column.key for column in model.__table__.primary_key.columns}
+        self.flushed = 0
+        self.batches = 0
+        self.retries = 0
+        self.dropped = 0
+
+    async def put(self, row: SQLModel) -> None:
+        """Queue a model instance for insertion, waiting while the queue is full"""
+        await self._queue.put(row)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Flush every queued row and stop the background loop"""
+        if self._task is not None:
+            await self._queue.put(_STOP)
+            await self._task
+            self._task = None
+        # rows put after the stop marker
+        rows = []
+        while not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        for start in range(0, len(rows), self.batch_size):
+            await self._flush(rows[start:start + self.batch_size])
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            row = await self._queue.get()
+            if row is _STOP:
+                return
+            batch = [row]
+            deadline = loop.time() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is _STOP:
+                    stop = True
+                    break
+                batch.append(row)
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _insert(self, rows: List[SQLModel]) -> None:
+        # prepare may rewrite the rows, a retry starts over from the queued ones
+        batch = [row.model_copy() for row in rows]
+        async with self.session_factory() as session:
+            if self.prepare is not None:
+                await self.prepare(session, batch)
+            await session.exec(
+                insert(self.model),
+                params=[row.model_dump(exclude=self._exclude) for row in batch],
+            )
+            await session.commit()
+        self.flushed += len(rows)
+        self.batches += 1
+        if self.on_flushed is not None:
+            self.on_flushed(rows)
+
+    async def _flush(self, rows: List[SQLModel]) -> None:
+        if not rows:
+            return
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                await self._insert(rows)
+                return
+            except Exception as e:
+                logging.warning(f"Write-behind flush of {len(rows)} {self.model.__name__} rows failed (attempt {attempt + 1}): {e}")
+
+        # one bad row shouldn't cost the whole batch
+        for row in rows:
+            try:
+                await self._insert([row])
+            except Exception as e:
+                self.dropped += 1
+                logging.error(f"Write-behind insert of a {self.model.__name__} row failed, dropping it: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize(),
+            "max_rows": self._queue.maxsize,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "retries": self.retries,
+            "dropped": self.dropped,
+        }
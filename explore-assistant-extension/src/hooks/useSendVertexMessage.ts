@@ -8,7 +8,6 @@ import process from 'process'
 import { useErrorBoundary } from 'react-error-boundary'
 import { AssistantState } from '../slices/assistantSlice'
 import { isTokenExpired } from '../components/Auth/AuthProvider'
-import useSendMessageId from './useSendMessageId'
 
 const unquoteResponse = (response: string | null | undefined) => {
   if(!response) {
@@ -99,7 +98,6 @@ const useSendVertexMessage = () => {
 
   const currentExploreKey = currentExplore.exploreKey
   const exploreRefinementExamples = examples.exploreRefinementExamples[currentExploreKey]
-  const { getMessageId } = useSendMessageId();
 
   const vertextBigQuery = async (
     contents: string,
@@ -143,10 +141,9 @@ const useSendVertexMessage = () => {
       console.log(currentExploreKey)
       
 
-    const messageId = await getMessageId(contents, prompt_type, raw_prompt, parameters, "system");
-
+    // one_shot: the backend logs the message and runs the LLM in the same request
     const body = JSON.stringify({
-      message_id: messageId,
+      one_shot: true,
       user_id: me.id,
       thread_id: currentThreadID,
       contents: contents,
@@ -187,6 +184,36 @@ const useSendVertexMessage = () => {
     }, [currentExploreThread]
   )
 
+  // generateExploreUrl through the backend, which assembles the prompt from the thread's explore
+  // (lookml fields + examples), so only the question is sent; the explore key is checked against the thread's
+  const vertexExploreUrl = useCallback(
+    async (prompt: string) => {
+    const responseData = await fetch(`${VERTEX_AI_ENDPOINT}/message/explore_url`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${access_token}`
+      },
+
+      body: JSON.stringify({
+        user_id: me.id,
+        thread_id: currentExploreThread?.uuid,
+        explore_key: currentExploreThread?.exploreKey,
+        prompt: prompt,
+      }),
+    })
+    if (!responseData.ok) {
+      const error = await responseData.text()
+      throw new Error(`Server responded with ${responseData.status}: ${error}`)
+    }
+
+    const responseString = await responseData.text()
+    const response = parseJSONResponse(responseString, 'response')
+    return response.trim()
+
+    }, [currentExploreThread]
+  )
+
   // this function is the entrypoint whenever user sends a chat. 
   // the result summarized prompt from vertex will be passed onto next 2 functions :
   // 1. isSummarizationPrompt for categorization.
@@ -401,7 +428,14 @@ ${exploreRefinementExamples && exploreRefinementExamples
           max_output_tokens: 1000,
         }
         // console.log(contents)
-        const response = await sendMessage(contents, prompt, 'generateExploreUrl',parameters)
+        const useBigQuery = VERTEX_BIGQUERY_LOOKER_CONNECTION_NAME && VERTEX_BIGQUERY_MODEL_ID
+        const response = VERTEX_AI_ENDPOINT && !useBigQuery
+          ? await sendExploreUrlMessage(prompt)
+          : await sendMessage(contents, prompt, 'generateExploreUrl',parameters)
+        if (!response) {
+          // the error was already shown
+          return
+        }
 
         const cleanResponse = unquoteResponse(response)
         // console.log(cleanResponse)
@@ -449,6 +483,15 @@ ${exploreRefinementExamples && exploreRefinementExamples
     }
   }
 
+  const sendExploreUrlMessage = async (prompt: string) => {
+    try {
+      return await vertexExploreUrl(prompt)
+    } catch (error) {
+      showBoundary(error)
+      return
+    }
+  }
+
   return {
     generateExploreUrl,
     sendMessage,